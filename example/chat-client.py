@@ -6,6 +6,7 @@ class ChatClientConnection(tp.TinyProtoConnection):
         '__msg_inbox', '__msg_inbox_lock',
         '__msg_outbox', '__msg_outbox_lock',
         '__transaction_lock',
+        'chat_client',
     )
 
     def __init__(self, *args, **kwargs):
@@ -16,6 +17,7 @@ class ChatClientConnection(tp.TinyProtoConnection):
         self.__msg_inbox_lock = Lock()
         self.__msg_outbox_lock = Lock()
         self.__transaction_lock = Lock()
+        self.chat_client = None
 
     @property
     def Inbox(self):
@@ -38,10 +40,15 @@ class ChatClientConnection(tp.TinyProtoConnection):
     def Outbox(self, newval):
         with self.__msg_outbox_lock:
             self.__msg_outbox.append(newval)
+        # connection loop sends it right away
+        self.wake()
 
 
     def transmission_received(self, msg):
         self.Inbox = msg.decode()
+        # client loop prints it
+        if self.chat_client is not None:
+            self.chat_client.wake()
 
     def loop_pass(self):
         with self.__transaction_lock:
@@ -58,6 +65,11 @@ class ChatClient(tp.TinyProtoClient):
         t = Thread(target = self.start)
         t.start()
 
+    def connect_to(self, connection_details):
+        cuid = super().connect_to(connection_details)
+        self.active_connections[cuid].chat_client = self
+        return cuid
+
     def loop_pass(self):
         for conn_id, conn_o in self.active_connections.items():
             pending_msgs = conn_o.Inbox
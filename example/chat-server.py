@@ -5,18 +5,15 @@ from threading import Lock
 class ChatSrvConnection(tp.TinyProtoConnection):
     __slots__ = (
         '__msg_inbox', '__msg_inbox_lock',
-        '__msg_outbox', '__msg_outbox_lock',
-        '__transaction_lock',
+        'chat_server',
     )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.__msg_inbox = []
-        self.__msg_outbox = []
         self.__msg_inbox_lock = Lock()
-        self.__msg_outbox_lock = Lock()
-        self.__transaction_lock = Lock()
+        self.chat_server = None
 
     @property
     def Inbox(self):
@@ -29,25 +26,10 @@ class ChatSrvConnection(tp.TinyProtoConnection):
         with self.__msg_inbox_lock:
             self.__msg_inbox.append(newval)
 
-    @property
-    def Outbox(self):
-        with self.__msg_outbox_lock:
-            res = self.__msg_outbox
-            self.__msg_outbox = []
-            return res
-    @Outbox.setter
-    def Outbox(self, newval):
-        with self.__msg_outbox_lock:
-            self.__msg_outbox.append(newval)
-
     def transmission_received(self, msg):
         self.Inbox = msg.decode()
-
-    def loop_pass(self):
-        with self.__transaction_lock:
-            pending_msgs = self.Outbox
-            for msg in pending_msgs:
-                self.transmit(msg.encode())
+        # server loop passes it on to other connections
+        self.chat_server.wake()
 
 
 
@@ -56,6 +38,7 @@ class ChatSrv(tp.TinyProtoServer):
         super().__init__(*args, **kwargs)
 
     def conn_init(self, conn_id, conn_o):
+        conn_o.chat_server = self
         print('[INFO] New connection opened from {}'.format(conn_o.socket_o.getpeername()))
         self.broadcast_msgs(conn_id, ('**joined the chat', ))
     def conn_shutdown(self, conn_id, conn_o):
@@ -68,13 +51,10 @@ class ChatSrv(tp.TinyProtoServer):
             self.broadcast_msgs(conn_id, pending_msgs)
 
     def broadcast_msgs(self, originating_conn_id, msgs):
-        for conn_id, conn_o in self.active_connections.items():
-            if conn_id == originating_conn_id:
-                continue
-
-            for m in msgs:
-                formatted_m = '[{}] {}'.format(originating_conn_id, m)
-                conn_o.Outbox = formatted_m
+        # every connection sends it from its own loop, so a slow client doesn't hold back the others
+        for m in msgs:
+            formatted_m = '[{}] {}'.format(originating_conn_id, m)
+            self.broadcast(formatted_m.encode(), exclude=(originating_conn_id, ))
 
 
 
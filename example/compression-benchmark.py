@@ -0,0 +1,57 @@
+'''Measures where CompressionPlugin starts to pay off.
+
+For every message size it compares the time needed to compress and
+decompress a message with the time saved on the wire at a given link
+speed. Break-even size is the smallest message for which compression
+is faster overall.
+
+    python compression-benchmark.py [link speed in Mbit/s]
+'''
+import json
+import sys
+import time
+import tinyproto as tp
+
+SIZES = (32, 64, 128, 256, 512, 1024, 4096, 16384, 65536)
+ROUNDS = 200
+
+
+def sample_message(size):
+    'Builds JSON message of given size, similar to what small applications usually send'
+    records = []
+    msg = b''
+    while len(msg) < size:
+        records.append({'id': len(records), 'user': 'user{}'.format(len(records) * 7919 % 1000), 'action': 'update', 'status': 'ok'})
+        msg = json.dumps(records).encode()
+    return msg[:size]
+
+
+def measure(plugin, msg):
+    start = time.perf_counter()
+    for x in range(ROUNDS):
+        wire = plugin.msg_transmit(msg)
+        plugin.msg_receive(wire)
+    return (time.perf_counter() - start) / ROUNDS, len(wire)
+
+
+if __name__ == '__main__':
+    link_mbit = float(sys.argv[1]) if len(sys.argv) > 1 else 100.0
+    bytes_per_second = link_mbit * 1000000 / 8
+    dictionary = sample_message(256)
+    plugins = (
+        ('zlib', tp.CompressionPlugin('zlib', threshold=0)),
+        ('zlib+dict', tp.CompressionPlugin('zlib', threshold=0, dictionary=dictionary)),
+        ('lzma', tp.CompressionPlugin('lzma', threshold=0)),
+    )
+    print('link speed {} Mbit/s'.format(link_mbit))
+    print('{:>10} {:>8} {:>10} {:>12} {:>12}'.format('algorithm', 'size', 'wire size', 'cpu us', 'saved us'))
+    for name, plugin in plugins:
+        break_even = None
+        for size in SIZES:
+            msg = sample_message(size)
+            cpu_time, wire_size = measure(plugin, msg)
+            saved_time = (size - wire_size) / bytes_per_second
+            if break_even is None and saved_time > cpu_time:
+                break_even = size
+            print('{:>10} {:>8} {:>10} {:>12.1f} {:>12.1f}'.format(name, size, wire_size, cpu_time * 1e6, saved_time * 1e6))
+        print('{:>10} break-even size: {}'.format(name, break_even if break_even is not None else 'above {}'.format(SIZES[-1])))
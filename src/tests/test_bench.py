@@ -0,0 +1,49 @@
+import unittest
+import os
+import json
+import tempfile
+from tinyproto import CompressionPlugin
+from tinyproto.bench import run_benchmark, plugin_chain, main
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_plugin_chain_names_are_resolved(self):
+        "plugin chain names should be turned into plugin lists, and unknown ones rejected"
+        self.assertEqual(plugin_chain('none'), [])
+        chain = plugin_chain('zlib+lzma')
+        self.assertEqual([type(p) for p in chain], [CompressionPlugin, CompressionPlugin])
+        self.assertEqual([p.algorithm for p in chain], ['zlib', 'lzma'])
+        with self.assertRaises(ValueError):
+            plugin_chain('zlib+rot13')
+
+    def test_benchmark_reports_every_size_and_chain(self):
+        "benchmark should drive a loopback server and report throughput, latency and memory for every case"
+        results = run_benchmark(sizes=(64, 4096), chains=('none', 'zlib'), clients=2, duration=0.2)
+        self.assertEqual([(r['plugins'], r['size']) for r in results['results']], [('none', 64), ('none', 4096), ('zlib', 64), ('zlib', 4096)])
+        for case in results['results']:
+            self.assertGreater(case['messages'], 0)
+            self.assertGreater(case['msgs_per_s'], 0)
+            self.assertAlmostEqual(case['mb_per_s'], case['msgs_per_s'] * case['size'] / 1e6)
+            self.assertLessEqual(case['latency_seconds']['p50'], case['latency_seconds']['p999'])
+            self.assertGreater(case['rss_bytes'], 0)
+        json.dumps(results)
+
+    def test_benchmark_compares_transports(self):
+        "benchmark should run every case over each of the given transports"
+        results = run_benchmark(sizes=(64, ), clients=1, duration=0.1, transports=('tcp', 'unix'))
+        self.assertEqual([r['transport'] for r in results['results']], ['tcp', 'unix'])
+        for case in results['results']:
+            self.assertGreater(case['messages'], 0)
+        with self.assertRaises(ValueError):
+            run_benchmark(sizes=(64, ), clients=1, duration=0.1, transports=('carrier-pigeon', ))
+
+    def test_entry_point_writes_json(self):
+        "entry point should write results as JSON into the output file"
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            self.assertEqual(main(['-c', '1', '-s', '128', '-d', '0.1', '-o', output]), 0)
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual(results['config']['clients'], 1)
+        self.assertEqual(len(results['results']), 1)
+        self.assertEqual(results['results'][0]['size'], 128)
@@ -0,0 +1,109 @@
+import unittest
+import unittest.mock
+import socket
+import threading
+from tinyproto import TinyProtoConnection, TinyProtoError
+from tinyproto.connection import CTRL_CHANNEL, CHANNEL_FINAL, CHANNEL_FRAME_SIZE, CAP_PIPELINE
+
+
+def pipelined_pair():
+    s1, s2 = socket.socketpair()
+    c1 = TinyProtoConnection(s1)
+    c2 = TinyProtoConnection(s2)
+    c1.capabilities = CAP_PIPELINE
+    c2.capabilities = CAP_PIPELINE
+    return c1, c2
+
+
+class TestChannel(unittest.TestCase):
+    def test_channel_requires_pipelined_framing(self):
+        "transmit on a channel should be refused with classic framing"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+        connection_object = TinyProtoConnection(socket_mock)
+
+        with self.assertRaises(TinyProtoError):
+            connection_object.open_channel(1).transmit(b'classic')
+        socket_mock.sendmsg.assert_not_called()
+
+    def test_channel_ids_are_allocated_by_role(self):
+        "connecting end should allocate odd channel ids and accepting end even ones"
+        accepting = TinyProtoConnection(unittest.mock.MagicMock(spec=socket.socket))
+        connecting = TinyProtoConnection(unittest.mock.MagicMock(spec=socket.socket), remote_details=unittest.mock.MagicMock())
+
+        self.assertEqual([accepting.open_channel().channel_id for x in range(2)], [2, 4])
+        self.assertEqual([connecting.open_channel().channel_id for x in range(2)], [1, 3])
+        self.assertIs(accepting.open_channel(7), accepting.open_channel(7))
+        with self.assertRaises(ValueError):
+            accepting.open_channel(0)
+
+    def test_large_message_is_split_into_channel_frames(self):
+        "channel message above frame size should be sent as multiple frames, only the last one marked final"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+        socket_mock.sendmsg.side_effect = lambda buffers: sum(len(b) for b in buffers)
+        connection_object = TinyProtoConnection(socket_mock)
+        connection_object.capabilities = CAP_PIPELINE
+
+        connection_object.open_channel(5).transmit(bytes(CHANNEL_FRAME_SIZE + 10))
+
+        self.assertEqual(socket_mock.sendmsg.call_count, 2)
+        headers = [bytes(c[1][0][0]) for c in socket_mock.sendmsg.mock_calls]
+        self.assertEqual(headers, [
+            ((CTRL_CHANNEL << 24) | 5).to_bytes(4, 'big'),
+            ((CTRL_CHANNEL << 24) | CHANNEL_FINAL | 5).to_bytes(4, 'big')
+        ])
+        self.assertEqual([len(c[1][0][2]) for c in socket_mock.sendmsg.mock_calls], [CHANNEL_FRAME_SIZE, 10])
+
+    def test_channels_are_delivered_separately(self):
+        "messages on different channels should arrive on matching channels, and regular messages through receive"
+        c1, c2 = pipelined_pair()
+
+        def sender():
+            c1.open_channel(1).transmit(b'control')
+            c1.transmit(b'regular')
+            c1.open_channel(3).transmit(b'bulk' * CHANNEL_FRAME_SIZE)
+            c1.open_channel(1).transmit(b'')
+        sending_thread = threading.Thread(target=sender)
+        sending_thread.start()
+
+        bulk = c2.open_channel(3)
+        self.assertEqual(bulk.receive(), b'bulk' * CHANNEL_FRAME_SIZE)
+        sending_thread.join(2)
+        self.assertEqual(c2.receive(), b'regular')
+        self.assertEqual(c2.open_channel(1).receive(), b'control')
+        self.assertEqual(c2.open_channel(1).receive(), b'')
+        c1.socket_o.close()
+        c2.socket_o.close()
+
+    def test_frames_of_concurrent_messages_are_interleaved(self):
+        "small message should not wait until a large message on another channel is sent in full"
+        c1, c2 = pipelined_pair()
+        frames = []
+
+        class Recorder(TinyProtoConnection):
+            def channel_transmission_received(self, channel, msg):
+                frames.append((channel.channel_id, len(msg)))
+                super().channel_transmission_received(channel, msg)
+
+        bulk = c1.open_channel(1)
+        control = c1.open_channel(3)
+        large = bytes(CHANNEL_FRAME_SIZE * 64)
+        with c1.connection_lock:
+            # queue both messages before any frame goes out
+            bulk_thread = threading.Thread(target=bulk.transmit, args=(large, ))
+            bulk_thread.start()
+            while len(c1._channel_ready) == 0:
+                pass
+            control_thread = threading.Thread(target=control.transmit, args=(b'urgent', ))
+            control_thread.start()
+            while len(c1._channel_ready) < 2:
+                pass
+        receiver = Recorder(c2.socket_o)
+        receiver.capabilities = CAP_PIPELINE
+        self.assertEqual(receiver.open_channel(3).receive(), b'urgent')
+        # large message was only partially received at that point
+        self.assertIsNotNone(receiver.open_channel(1)._fragments)
+        self.assertEqual(receiver.open_channel(1).receive(), large)
+        control_thread.join(2)
+        bulk_thread.join(2)
+        c1.socket_o.close()
+        c2.socket_o.close()
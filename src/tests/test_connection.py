@@ -1,8 +1,21 @@
 import unittest
 import unittest.mock
 import socket
-from tinyproto import TinyProtoConnection, TinyProtoError
-from tinyproto.connection import SC_OK, SC_GENERIC_ERROR
+import threading
+import time
+import tempfile
+from tinyproto import TinyProtoConnection, TinyProtoPlugin, TinyProtoStreamPlugin, TinyProtoError
+from tinyproto.connection import SC_OK, SC_GENERIC_ERROR, CTRL_CAPS, CTRL_ERROR, CTRL_BATCH, CAP_PIPELINE, CAP_HEARTBEAT
+
+
+def recv_into_side_effect(*chunks):
+    'Makes mocked socket recv_into hand out provided chunks, one per call'
+    pending = list(chunks)
+    def side_effect(buffer, nbytes=0):
+        chunk = pending.pop(0)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+    return side_effect
 
 
 class TestConnection(unittest.TestCase):
@@ -41,12 +54,12 @@ class TestConnection(unittest.TestCase):
         test_data = 'My life amounts to no more than one drop in a limitless ocean. Yet what is any ocean, but a multitude of drops?'.encode()
         test_data_size = len(test_data)
         
-        socket_mock.recv.return_value = test_data
+        socket_mock.recv_into.side_effect = recv_into_side_effect(test_data)
         
         result = connection_object._raw_receive(test_data_size)
         
         self.assertEqual(result, test_data)
-        socket_mock.recv.assert_called_once()
+        socket_mock.recv_into.assert_called_once()
 
     def test_raw_receive_will_keep_obtaining_data_in_loop_until_socket_returns_complete_set(self):
         "_raw_receive should continue requesting data from socket untill entire byte size is obtained"
@@ -57,18 +70,20 @@ class TestConnection(unittest.TestCase):
         test_data = 'Travel far enough, you meet yourself.'.encode()
         test_data_size = len(test_data)
         
-        def socket_recv_side_effect(receive_size):
+        def socket_recv_into_side_effect(buffer, receive_size):
             if receive_size == test_data_size:
-                return test_data[:4]
+                data = test_data[:4]
             else:
-                return test_data[-receive_size:]
+                data = test_data[-receive_size:]
+            buffer[:len(data)] = data
+            return len(data)
             
-        socket_mock.recv.side_effect = socket_recv_side_effect
+        socket_mock.recv_into.side_effect = socket_recv_into_side_effect
         
         result = connection_object._raw_receive(test_data_size)
         
         self.assertEqual(result, test_data)
-        self.assertEqual(len(socket_mock.recv.mock_calls), 2)
+        self.assertEqual(len(socket_mock.recv_into.mock_calls), 2)
 
     def test_raw_receive_will_return_zero_bytearray_on_receiving_empty_response(self):
         "_raw_receive, when receiving empty byte response, should return 4 zero bytes"
@@ -76,13 +91,13 @@ class TestConnection(unittest.TestCase):
         
         connection_object = TinyProtoConnection(socket_mock)
         
-        socket_mock.recv.return_value = bytes()
+        socket_mock.recv_into.return_value = 0
         
         result = connection_object._raw_receive(5)
         
         self.assertEqual(len(result), 4)
         self.assertEqual(result, bytearray((0,0,0,0)))
-        socket_mock.recv.assert_called_once()
+        socket_mock.recv_into.assert_called_once()
 
     def test_raw_transmit_will_push_data_through_socket_object(self):
         "_raw_transmit should correctly send data over socket object"
@@ -133,16 +148,16 @@ class TestConnection(unittest.TestCase):
         test_data = "...now I'm a spent firework; but at least I've been a firework.".encode()
         
         socket_mock.send.side_effect = [4, len(test_data)]
-        socket_mock.recv.return_value = bytes((SC_OK,))
+        socket_mock.recv_into.side_effect = recv_into_side_effect(bytes((SC_OK,)))
         
         connection_object.transmit(test_data)
         
         self.assertEqual(len(socket_mock.send.mock_calls), 2)
-        self.assertEqual(len(socket_mock.recv.mock_calls), 1)
+        self.assertEqual(len(socket_mock.recv_into.mock_calls), 1)
         
         first_send_argument = socket_mock.send.mock_calls[0][1][0]
         second_send_argument = socket_mock.send.mock_calls[1][1][0]
-        recv_argument = socket_mock.recv.mock_calls[0][1][0]
+        recv_argument = socket_mock.recv_into.mock_calls[0][1][1]
         
         self.assertEqual(first_send_argument, bytearray((0, 0, 0, len(test_data) )))
         self.assertEqual(second_send_argument, test_data)
@@ -157,13 +172,13 @@ class TestConnection(unittest.TestCase):
         test_data = "One fine day a predatory world shall consume itself.".encode()
         
         socket_mock.send.side_effect = [4, len(test_data)]
-        socket_mock.recv.return_value = bytes((SC_GENERIC_ERROR,))
+        socket_mock.recv_into.side_effect = recv_into_side_effect(bytes((SC_GENERIC_ERROR,)))
         
         with self.assertRaises(TinyProtoError):
             connection_object.transmit(test_data)
             
         self.assertEqual(len(socket_mock.send.mock_calls), 1)
-        self.assertEqual(len(socket_mock.recv.mock_calls), 1)
+        self.assertEqual(len(socket_mock.recv_into.mock_calls), 1)
         
     def test_receive_will_retrieve_size_followed_by_data(self):
         "receive should acquire 4 byte message size, reply with 1 byte signal ok, followed by retrieval of full message"
@@ -173,20 +188,20 @@ class TestConnection(unittest.TestCase):
         
         test_data = "By each crime and every kindness, we birth our future.".encode()
         
-        socket_mock.recv.side_effect = [
+        socket_mock.recv_into.side_effect = recv_into_side_effect(
             bytes((0,0,0, len(test_data))),
             test_data
-        ]
+        )
         socket_mock.send.return_value = 1
         
         result = connection_object.receive()
         
         self.assertEqual(result, test_data)
-        self.assertEqual(len(socket_mock.recv.mock_calls), 2)
+        self.assertEqual(len(socket_mock.recv_into.mock_calls), 2)
         self.assertEqual(len(socket_mock.send.mock_calls), 1)
         
-        first_recv_argument = socket_mock.recv.mock_calls[0][1][0]
-        second_recv_argument = socket_mock.recv.mock_calls[1][1][0]
+        first_recv_argument = socket_mock.recv_into.mock_calls[0][1][1]
+        second_recv_argument = socket_mock.recv_into.mock_calls[1][1][1]
         send_argument = socket_mock.send.mock_calls[0][1][0]
         
         self.assertEqual(first_recv_argument, 4)
@@ -200,7 +215,7 @@ class TestConnection(unittest.TestCase):
         
         connection_object = TinyProtoConnection(socket_mock)
         
-        socket_mock.recv.return_value = bytes((0,0,0, 42))
+        socket_mock.recv_into.side_effect = recv_into_side_effect(bytes((0,0,0, 42)))
         socket_mock.send.return_value = 1 # because it sends an error signal on too big message
         
         with self.assertRaises(TinyProtoError):
@@ -212,7 +227,356 @@ class TestConnection(unittest.TestCase):
         
         connection_object = TinyProtoConnection(socket_mock)
         
-        socket_mock.recv.return_value = bytes()
+        socket_mock.recv_into.return_value = 0
         
         with self.assertRaises(TinyProtoError):
             connection_object.receive()
+
+    def test_pipelined_transmit_will_not_wait_for_ok_signal(self):
+        "transmit with negotiated pipelining should send size and message without waiting for signal ok"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+        connection_object.capabilities = CAP_PIPELINE
+
+        test_data = "Souls cross ages like clouds cross skies.".encode()
+
+        socket_mock.sendmsg.return_value = 4 + len(test_data)
+
+        connection_object.transmit(test_data)
+
+        socket_mock.sendmsg.assert_called_once()
+        self.assertEqual(socket_mock.sendmsg.mock_calls[0][1][0], [bytearray((0, 0, 0, len(test_data))), test_data])
+        socket_mock.recv_into.assert_not_called()
+
+    def test_receive_will_answer_capability_offer(self):
+        "receive should answer capability offer with common capabilities and switch to pipelined framing"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+
+        test_data = "Power, time, gravity, love.".encode()
+
+        socket_mock.recv_into.side_effect = recv_into_side_effect(
+            bytes((CTRL_CAPS, 0, 0, 0xff)),
+            bytes((0, 0, 0, len(test_data))),
+            test_data
+        )
+        socket_mock.send.return_value = 4
+
+        result = connection_object.receive()
+
+        self.assertEqual(result, test_data)
+        self.assertEqual(connection_object.capabilities, CAP_PIPELINE | CAP_HEARTBEAT)
+        self.assertEqual(len(socket_mock.send.mock_calls), 1)
+        self.assertEqual(socket_mock.send.mock_calls[0][1][0], bytearray((CTRL_CAPS, 0, 0, CAP_PIPELINE | CAP_HEARTBEAT)))
+
+    def test_pipelined_receive_will_discard_oversized_message_and_send_error_frame(self):
+        "receive with negotiated pipelining should discard message above max size and report it with error frame"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+        connection_object.capabilities = CAP_PIPELINE
+        connection_object.max_message_size = 4
+
+        rejected_data = "The weak are meat, the strong eat.".encode()
+        test_data = "Ok.".encode()
+
+        socket_mock.recv_into.side_effect = recv_into_side_effect(
+            bytes((0, 0, 0, len(rejected_data))),
+            rejected_data,
+            bytes((0, 0, 0, len(test_data))),
+            test_data
+        )
+        socket_mock.send.return_value = 4
+
+        result = connection_object.receive()
+
+        self.assertEqual(result, test_data)
+        self.assertEqual(len(socket_mock.send.mock_calls), 1)
+        self.assertEqual(socket_mock.send.mock_calls[0][1][0], bytearray((CTRL_ERROR, 0, 0, SC_GENERIC_ERROR)))
+
+    def test_capabilities_are_negotiated_between_connections(self):
+        "connection offering capabilities should agree on pipelined framing with the remote end and exchange messages"
+        received = []
+        received_event = threading.Event()
+
+        class Collector(TinyProtoConnection):
+            def transmission_received(self, msg):
+                received.append(bytes(msg))
+                received_event.set()
+
+        offering_socket, answering_socket = socket.socketpair()
+        offering_connection = TinyProtoConnection(offering_socket, negotiate_capabilities=True)
+        answering_connection = Collector(answering_socket)
+        answering_connection.start()
+        offering_connection.start()
+
+        try:
+            deadline = time.monotonic() + 2
+            while offering_connection.capabilities != CAP_PIPELINE | CAP_HEARTBEAT and time.monotonic() < deadline:
+                time.sleep(0.01)
+            offering_connection.transmit(bytearray())
+            offering_connection.transmit(b'pipelined')
+            while len(received) < 2 and received_event.wait(2):
+                received_event.clear()
+        finally:
+            offering_connection.shutdown = True
+            answering_connection.shutdown = True
+
+        self.assertEqual(offering_connection.capabilities, CAP_PIPELINE | CAP_HEARTBEAT)
+        self.assertEqual(answering_connection.capabilities, CAP_PIPELINE | CAP_HEARTBEAT)
+        self.assertEqual(received, [b'', b'pipelined'])
+
+    def test_receive_into_will_place_message_in_provided_buffer(self):
+        "receive_into should receive message straight into provided buffer and return its size"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+
+        test_data = "Everything is connected.".encode()
+        buffer = bytearray(64)
+
+        socket_mock.recv_into.side_effect = recv_into_side_effect(
+            bytes((0, 0, 0, len(test_data))),
+            test_data
+        )
+        socket_mock.send.return_value = 1
+
+        result = connection_object.receive_into(buffer)
+
+        self.assertEqual(result, len(test_data))
+        self.assertEqual(buffer[:result], test_data)
+        self.assertEqual(socket_mock.send.mock_calls[0][1][0], bytes((SC_OK,)))
+
+    def test_receive_into_will_reject_message_not_fitting_into_buffer(self):
+        "receive_into should reject message bigger than provided buffer before it is sent"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+
+        socket_mock.recv_into.side_effect = recv_into_side_effect(bytes((0, 0, 0, 42)))
+        socket_mock.send.return_value = 1
+
+        with self.assertRaises(TinyProtoError):
+            connection_object.receive_into(bytearray(8))
+
+        self.assertEqual(socket_mock.send.mock_calls[0][1][0], bytes((SC_GENERIC_ERROR,)))
+
+    def test_raw_transmit_vectored_will_advance_over_partially_sent_buffers(self):
+        "_raw_transmit_vectored should send all buffers with sendmsg, continuing from where partial send stopped"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+
+        first_data = "Nothing is ever over.".encode()
+        second_data = "Yes, it's fine.".encode()
+
+        captured_buffers = []
+        def socket_sendmsg_side_effect(buffers):
+            captured_buffers.append([bytes(b) for b in buffers])
+            pending_size = sum(len(b) for b in buffers)
+            return min(3 if len(captured_buffers) == 1 else len(first_data), pending_size)
+        socket_mock.sendmsg.side_effect = socket_sendmsg_side_effect
+
+        connection_object._raw_transmit_vectored((first_data, bytearray(), second_data))
+
+        self.assertEqual(captured_buffers[0], [first_data, second_data])
+        self.assertEqual(captured_buffers[1], [first_data[3:], second_data])
+        self.assertEqual(captured_buffers[2], [second_data[3:]])
+        self.assertEqual(len(captured_buffers), 3)
+
+    def test_transmit_stream_will_send_file_as_single_message(self):
+        "transmit_stream should send a file as regular message, which receive_to_file writes into a file chunk by chunk"
+        sending_socket, receiving_socket = socket.socketpair()
+        sending_connection = TinyProtoConnection(sending_socket)
+        receiving_connection = TinyProtoConnection(receiving_socket)
+
+        test_data = bytes(range(256)) * 1000
+
+        with tempfile.TemporaryFile() as source, tempfile.TemporaryFile() as target:
+            source.write(test_data)
+            source.seek(0)
+            sending_thread = threading.Thread(target=sending_connection.transmit_stream, args=(source, ))
+            sending_thread.start()
+
+            written = receiving_connection.receive_to_file(target, chunk_size=4096)
+            sending_thread.join(2)
+
+            target.seek(0)
+            self.assertEqual(written, len(test_data))
+            self.assertEqual(target.read(), test_data)
+        sending_socket.close()
+        receiving_socket.close()
+
+    def test_transmit_stream_will_adapt_whole_message_plugins_with_pipelined_framing(self):
+        "transmit_stream of unknown size should pass whole stream to whole message plugins, and receive should gather it into one message"
+        class ReversePlugin(TinyProtoPlugin):
+            def msg_transmit(self, msg):
+                return bytes(reversed(msg))
+            def msg_receive(self, msg):
+                return bytes(reversed(msg))
+
+        sending_socket, receiving_socket = socket.socketpair()
+        sending_connection = TinyProtoConnection(sending_socket, connection_plugin_list=[ReversePlugin])
+        receiving_connection = TinyProtoConnection(receiving_socket, connection_plugin_list=[ReversePlugin])
+        sending_connection.capabilities = CAP_PIPELINE
+        receiving_connection.capabilities = CAP_PIPELINE
+
+        test_chunks = [b'Yesterday ', b'and today ', b'are the same.']
+
+        sending_connection.transmit_stream(iter(test_chunks), chunk_size=4)
+        sending_connection.transmit_stream(iter(test_chunks))
+
+        self.assertEqual(receiving_connection.receive(), b''.join(test_chunks))
+        self.assertEqual(list(receiving_connection.receive_stream()), [b''.join(test_chunks)])
+        sending_socket.close()
+        receiving_socket.close()
+
+    def test_transmit_stream_will_pipe_chunks_through_stream_plugins(self):
+        "stream plugins should process streamed message chunk by chunk on both ends"
+        class UpperPlugin(TinyProtoStreamPlugin):
+            def transmit_chunk(self, state, chunk):
+                return (bytes(chunk).upper(), )
+            def receive_chunk(self, state, chunk):
+                return (bytes(chunk) + b'|', )
+
+        sending_socket, receiving_socket = socket.socketpair()
+        sending_connection = TinyProtoConnection(sending_socket, connection_plugin_list=[UpperPlugin])
+        receiving_connection = TinyProtoConnection(receiving_socket, connection_plugin_list=[UpperPlugin])
+        sending_connection.capabilities = CAP_PIPELINE
+        receiving_connection.capabilities = CAP_PIPELINE
+
+        test_chunks = [b'Yesterday ', b'and today ', b'are the same.']
+
+        sending_connection.transmit_stream(iter(test_chunks))
+        sending_connection.transmit(b'whole')
+
+        self.assertEqual(list(receiving_connection.receive_stream()), [b'YESTERDAY |', b'AND TODAY |', b'ARE THE SAME.|'])
+        self.assertEqual(receiving_connection.receive(), b'WHOLE|')
+        sending_socket.close()
+        receiving_socket.close()
+
+    def test_transmit_stream_of_unknown_size_requires_pipelined_framing(self):
+        "transmit_stream should refuse stream of unknown size with classic framing"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+
+        with self.assertRaises(TinyProtoError):
+            connection_object.transmit_stream(iter([b'unknown']))
+        socket_mock.send.assert_not_called()
+
+    def test_pipelined_transmit_many_will_flush_batch_with_single_sendmsg(self):
+        "transmit_many with negotiated pipelining should frame all messages as one batch and send them with one sendmsg"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+        connection_object.capabilities = CAP_PIPELINE
+
+        test_msgs = [b'first', b'second', b'third']
+        socket_mock.sendmsg.side_effect = lambda buffers: sum(len(b) for b in buffers)
+
+        result = connection_object.transmit_many(test_msgs)
+
+        self.assertEqual(result, [True, True, True])
+        socket_mock.sendmsg.assert_called_once()
+        self.assertEqual(socket_mock.sendmsg.mock_calls[0][1][0], [
+            bytearray((CTRL_BATCH, 0, 0, 3)),
+            bytearray((0, 0, 0, 5)), b'first',
+            bytearray((0, 0, 0, 6)), b'second',
+            bytearray((0, 0, 0, 5)), b'third',
+        ])
+        socket_mock.recv_into.assert_not_called()
+
+    def test_transmit_many_will_report_rejected_message_with_classic_framing(self):
+        "transmit_many with classic framing should report per message success"
+        socket_mock = unittest.mock.MagicMock(spec=socket.socket)
+
+        connection_object = TinyProtoConnection(socket_mock)
+
+        socket_mock.send.side_effect = lambda data: len(data)
+        socket_mock.recv_into.side_effect = recv_into_side_effect(
+            bytes((SC_OK,)), bytes((SC_GENERIC_ERROR,)), bytes((SC_OK,))
+        )
+
+        result = connection_object.transmit_many([b'accepted', b'rejected', b'accepted'])
+
+        self.assertEqual(result, [True, False, True])
+
+    def test_batch_is_delivered_to_transmissions_received(self):
+        "messages sent with transmit_many should be delivered as one batch, and one by one through receive"
+        batches = []
+
+        class BatchCollector(TinyProtoConnection):
+            def transmissions_received(self, msgs):
+                batches.append(msgs)
+
+        sending_socket, receiving_socket = socket.socketpair()
+        sending_connection = TinyProtoConnection(sending_socket)
+        receiving_connection = BatchCollector(receiving_socket)
+        sending_connection.capabilities = CAP_PIPELINE
+        receiving_connection.capabilities = CAP_PIPELINE
+
+        sending_connection.transmit_many([b'one', b'two', b'three'])
+        sending_connection.transmit_many([b'four', b'five'])
+
+        receiving_connection._dispatch_received(receiving_connection._receive_frame())
+        for x in range(3):
+            receiving_connection._dispatch_received(receiving_connection._receive_frame())
+
+        self.assertEqual(batches, [[b'one', b'two', b'three']])
+        self.assertEqual(receiving_connection.receive(), b'four')
+        self.assertEqual(receiving_connection.receive(), b'five')
+        sending_socket.close()
+        receiving_socket.close()
+
+    def test_receive_into_will_drain_batch_one_by_one(self):
+        "messages sent with transmit_many should be received one by one through receive_into, without keeping views of its buffer"
+        sending_socket, receiving_socket = socket.socketpair()
+        sending_connection = TinyProtoConnection(sending_socket)
+        receiving_connection = TinyProtoConnection(receiving_socket)
+        sending_connection.capabilities = CAP_PIPELINE
+        receiving_connection.capabilities = CAP_PIPELINE
+
+        sending_connection.transmit_many([b'one', b'two', b'three'])
+        sending_connection.transmit_many([b'four', b'five'])
+
+        buffer = bytearray(16)
+        received = []
+        for x in range(3):
+            size = receiving_connection.receive_into(buffer)
+            received.append(bytes(buffer[:size]))
+            buffer[:] = bytes(len(buffer))
+
+        self.assertEqual(received, [b'one', b'two', b'three'])
+        self.assertIsNone(receiving_connection._received_batch)
+        self.assertEqual(receiving_connection.receive(), b'four')
+        size = receiving_connection.receive_into(buffer)
+        self.assertEqual(bytes(buffer[:size]), b'five')
+        sending_socket.close()
+        receiving_socket.close()
+
+    def test_pipelined_receive_into_will_discard_message_not_fitting_into_buffer(self):
+        "receive_into with pipelined framing should read and discard message bigger than provided buffer, and go on with next one"
+        sending_socket, receiving_socket = socket.socketpair()
+        sending_connection = TinyProtoConnection(sending_socket)
+        receiving_connection = TinyProtoConnection(receiving_socket)
+        sending_connection.capabilities = CAP_PIPELINE
+        receiving_connection.capabilities = CAP_PIPELINE
+
+        sending_connection.transmit(b'too long for the buffer')
+        sending_connection.transmit_many([b'also too long', b'fits'])
+        sending_connection.transmit(b'fits too')
+
+        buffer = bytearray(8)
+        with self.assertRaises(TinyProtoError):
+            receiving_connection.receive_into(buffer)
+        with self.assertRaises(TinyProtoError):
+            receiving_connection.receive_into(buffer)
+        size = receiving_connection.receive_into(buffer)
+        self.assertEqual(bytes(buffer[:size]), b'fits')
+        size = receiving_connection.receive_into(buffer)
+        self.assertEqual(bytes(buffer[:size]), b'fits too')
+        sending_socket.close()
+        receiving_socket.close()
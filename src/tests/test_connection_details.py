@@ -2,6 +2,7 @@ import unittest
 import unittest.mock
 import socket
 from tinyproto import TinyProtoConnectionDetails, TinyProtoError
+from tinyproto.connection_details import TinyProtoResolutionCache
 
 
 class TestConnectionDetails(unittest.TestCase):
@@ -157,3 +158,77 @@ class TestConnectionDetails(unittest.TestCase):
         self.assertEqual(connection_details.socket_kind, test_socket_kind)
         self.assertEqual(connection_details.socket_proto, test_socket_proto)
         self.assertEqual(connection_details.socket_connect_details, test_socket_connection_details)
+
+
+class TestResolution(unittest.TestCase):
+    def setUp(self):
+        self.cache = TinyProtoResolutionCache(max_entries=2)
+        patcher = unittest.mock.patch('tinyproto.connection_details.RESOLUTION_CACHE', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @unittest.mock.patch('socket.getaddrinfo')
+    def test_resolution_is_cached_with_ttl(self, mock_getaddrinfo):
+        "With cache_ttl, resolution should be reused until it expires"
+        mock_getaddrinfo.return_value = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 22))]
+
+        TinyProtoConnectionDetails('localhost', 22, cache_ttl=60)
+        TinyProtoConnectionDetails('localhost', 22, cache_ttl=60)
+        self.assertEqual(len(mock_getaddrinfo.mock_calls), 1)
+
+        TinyProtoConnectionDetails('localhost', 23, cache_ttl=0)
+        TinyProtoConnectionDetails('localhost', 23, cache_ttl=0)
+        self.assertEqual(len(mock_getaddrinfo.mock_calls), 3)
+
+        TinyProtoConnectionDetails('localhost', 24)
+        self.assertEqual(len(mock_getaddrinfo.mock_calls), 4)
+
+    @unittest.mock.patch('socket.getaddrinfo')
+    def test_least_recently_used_entry_is_evicted(self, mock_getaddrinfo):
+        "Cache should not keep more than max_entries resolutions"
+        mock_getaddrinfo.return_value = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 22))]
+
+        for port in (22, 23, 22, 24):
+            TinyProtoConnectionDetails('localhost', port, cache_ttl=60)
+        self.assertEqual(len(self.cache), 2)
+        TinyProtoConnectionDetails('localhost', 22, cache_ttl=60)
+        self.assertEqual(len(mock_getaddrinfo.mock_calls), 3)
+
+    @unittest.mock.patch('socket.getaddrinfo')
+    def test_all_addresses_alternate_families(self, mock_getaddrinfo):
+        "With all_addresses, every supported address should be kept, alternating address families"
+        mock_getaddrinfo.return_value = [
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 22, 0, 0)),
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::2', 22, 0, 0)),
+            (socket.AF_INET, socket.SOCK_DGRAM, 17, '', ('127.0.0.1', 22)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 22))
+        ]
+
+        self.assertEqual(len(TinyProtoConnectionDetails('localhost', 22).addresses), 1)
+        connection_details = TinyProtoConnectionDetails('localhost', 22, all_addresses=True)
+        self.assertEqual([a[3][0] for a in connection_details.addresses], ['::1', '127.0.0.1', '::2'])
+
+    def test_create_connection_fails_over_to_next_address(self):
+        "create_connection should connect to the next address when the first one refuses"
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.bind(('127.0.0.1', 0))
+        listening_socket.listen(1)
+        closed_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed_socket.bind(('127.0.0.1', 0))
+        closed_port = closed_socket.getsockname()[1]
+        closed_socket.close()
+
+        with unittest.mock.patch('socket.getaddrinfo') as mock_getaddrinfo:
+            mock_getaddrinfo.return_value = [
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', closed_port)),
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', listening_socket.getsockname())
+            ]
+            connection_details = TinyProtoConnectionDetails('localhost', 22, all_addresses=True)
+
+        connected_socket = connection_details.create_connection(timeout=2)
+        try:
+            self.assertEqual(connected_socket.getpeername(), listening_socket.getsockname())
+            self.assertEqual(connected_socket.gettimeout(), 2)
+        finally:
+            connected_socket.close()
+            listening_socket.close()
@@ -0,0 +1,114 @@
+import unittest
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tinyproto import TinyProtoConnection, TinyProtoReactor
+from tinyproto.connection import CAP_PIPELINE
+from .helpers import wait_for
+
+
+def double(msg):
+    return bytes(msg) * 2
+
+
+class SlowHandler(TinyProtoConnection):
+    __slots__ = ('handled', 'handler_threads', 'release', 'done')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handled = []
+        self.handler_threads = set()
+        self.release = threading.Event()
+        self.done = threading.Event()
+
+    def transmission_received(self, msg):
+        self.release.wait(5)
+        self.handler_threads.add(threading.current_thread())
+        self.handled.append(bytes(msg))
+        if len(self.handled) == 20:
+            self.done.set()
+
+
+class Processed(TinyProtoConnection):
+    __slots__ = ('results', 'done')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results = []
+        self.done = threading.Event()
+
+    def transmission_processed(self, msg, result):
+        self.results.append(result)
+        self.done.set()
+
+
+class TestExecutorDispatch(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(4)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=False)
+
+    def _run_backpressure(self, use_reactor):
+        receiving_socket, sending_socket = socket.socketpair()
+        receiving = SlowHandler(receiving_socket)
+        receiving.capabilities = CAP_PIPELINE
+        receiving.use_executor(self.executor, queue_size=4)
+        reactor = None
+        if use_reactor:
+            reactor = TinyProtoReactor()
+            reactor.start()
+            receiving.use_reactor(reactor)
+        sending = TinyProtoConnection(sending_socket)
+        sending.capabilities = CAP_PIPELINE
+        receiving.start()
+        sending.start()
+        try:
+            self.assertTrue(sending.wait_ready(2))
+            for x in range(20):
+                sending.transmit('message {}'.format(x).encode())
+
+            # handlers are stuck, so the connection stops taking messages off the socket
+            self.assertTrue(wait_for(lambda: receiving._dispatch_pending == 4))
+            time.sleep(0.1)
+            self.assertEqual(receiving._dispatch_pending, 4)
+            self.assertGreater(len(receiving_socket.recv(4096, socket.MSG_PEEK)), 0)
+
+            receiving.release.set()
+            self.assertTrue(receiving.done.wait(5))
+            self.assertEqual(receiving.handled, ['message {}'.format(x).encode() for x in range(20)])
+            self.assertNotIn(threading.current_thread(), receiving.handler_threads)
+            if reactor is not None:
+                self.assertNotIn(reactor._reactor_thread, receiving.handler_threads)
+        finally:
+            sending.shutdown = True
+            receiving.shutdown = True
+            if reactor is not None:
+                reactor.shutdown = True
+                reactor.join(1)
+
+    def test_full_queue_stops_reading(self):
+        "connection loop should stop reading when the executor queue is full, and handle messages in order once it drains"
+        self._run_backpressure(False)
+
+    def test_full_queue_pauses_reactor_connection(self):
+        "reactor should stop reading a connection whose executor queue is full"
+        self._run_backpressure(True)
+
+    def test_handler_result_is_passed_to_transmission_processed(self):
+        "with handler, executor should run the handler and pass its result to transmission_processed"
+        receiving_socket, sending_socket = socket.socketpair()
+        receiving = Processed(receiving_socket)
+        receiving.use_executor(self.executor, handler=double, ordered=False)
+        sending = TinyProtoConnection(sending_socket)
+        receiving.start()
+        sending.start()
+        try:
+            self.assertTrue(sending.wait_ready(2))
+            sending.transmit(b'twice ')
+            self.assertTrue(receiving.done.wait(2))
+            self.assertEqual(receiving.results, [b'twice twice '])
+        finally:
+            sending.shutdown = True
+            receiving.shutdown = True
@@ -0,0 +1,190 @@
+import unittest
+import unittest.mock
+import socket
+import threading
+import time
+from tinyproto import TinyProtoConnection, TinyProtoServer, TinyProtoConnectionDetails, TinyProtoReactor, TinyProtoMetrics
+from tinyproto.connection import SC_OK, CTRL_CAPS, CTRL_PING, CTRL_PONG, CAP_PIPELINE, CAP_HEARTBEAT
+from .helpers import free_port, wait_for
+
+
+class Closing(TinyProtoConnection):
+    __slots__ = ('closed', )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed = threading.Event()
+
+    def post_loop(self):
+        self.closed.set()
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        data += sock.recv(size - len(data))
+    return data
+
+
+class TestHeartbeat(unittest.TestCase):
+    def test_heartbeats_measure_round_trip_time(self):
+        "connection with heartbeats should agree on them, and smooth round trip times of answered pings"
+        local, remote = Closing.socketpair()
+        local.negotiate_capabilities = True
+        local.heartbeat_interval = 0.02
+        local.metrics = TinyProtoMetrics()
+        remote.start()
+        local.start()
+        self.addCleanup(setattr, remote, 'shutdown', True)
+        self.addCleanup(setattr, local, 'shutdown', True)
+        self.assertTrue(local.wait_ready(2))
+
+        self.assertTrue(wait_for(lambda: local.metrics.histograms['rtt'].count >= 3))
+        self.assertEqual(local.capabilities, CAP_PIPELINE | CAP_HEARTBEAT)
+        self.assertGreater(local.rtt, 0)
+        self.assertGreaterEqual(local.rtt_variance, 0)
+        self.assertIsNone(remote.rtt)
+
+    def test_round_trip_time_is_smoothed(self):
+        "round trip time should start at the first sample, and move by an eighth of the difference with every next one"
+        connection = TinyProtoConnection(unittest.mock.MagicMock(spec=socket.socket))
+        connection.capabilities = CAP_PIPELINE | CAP_HEARTBEAT
+        with unittest.mock.patch('tinyproto.connection.time.monotonic') as monotonic:
+            for sent, answered in ((10.0, 10.1), (20.0, 20.5)):
+                connection._ping_sent = sent
+                connection._ping_pending = True
+                monotonic.return_value = answered
+                connection._control_frame_received(CTRL_PONG, connection._ping_token)
+        self.assertAlmostEqual(connection.rtt, 0.1 + (0.5 - 0.1) / 8)
+        self.assertAlmostEqual(connection.rtt_variance, 0.05 + (0.4 - 0.05) / 4)
+        self.assertFalse(connection._ping_pending)
+
+    def test_peer_which_stops_answering_is_dropped(self):
+        "connection should be closed once its heartbeat goes unanswered and nothing else arrives"
+        local_socket, remote_socket = socket.socketpair()
+        self.addCleanup(remote_socket.close)
+        local = Closing(local_socket, negotiate_capabilities=True)
+        local.heartbeat_interval = 0.05
+        local.start()
+        self.addCleanup(setattr, local, 'shutdown', True)
+        # handshake with capability offer, answered by hand, then silence
+        recv_exactly(remote_socket, 5)
+        remote_socket.sendall(bytes((SC_OK, CTRL_CAPS, 0, 0, CAP_PIPELINE | CAP_HEARTBEAT)))
+        self.assertTrue(local.wait_ready(2))
+
+        self.assertEqual(recv_exactly(remote_socket, 4), bytes((CTRL_PING, 0, 0, 1)))
+        self.assertTrue(local.closed.wait(2))
+        self.assertTrue(wait_for(lambda: not local.is_alive()))
+
+    def test_answered_heartbeats_keep_idle_connection_open(self):
+        "answers to heartbeats should count as traffic, so idle timeout does not close a healthy connection"
+        local, remote = Closing.socketpair()
+        local.negotiate_capabilities = True
+        local.heartbeat_interval = 0.03
+        local.idle_timeout = 0.15
+        remote.start()
+        local.start()
+        self.addCleanup(setattr, remote, 'shutdown', True)
+        self.addCleanup(setattr, local, 'shutdown', True)
+        self.assertTrue(local.wait_ready(2))
+
+        self.assertFalse(local.closed.wait(0.5))
+        self.assertTrue(local.is_healthy())
+
+    def test_idle_connection_is_closed(self):
+        "connection with classic framing should be closed after idle timeout without anything received"
+        local, remote = Closing.socketpair()
+        local.idle_timeout = 0.1
+        remote.start()
+        local.start()
+        self.addCleanup(setattr, remote, 'shutdown', True)
+        self.assertTrue(local.wait_ready(2))
+
+        self.assertTrue(local.closed.wait(2))
+        # remote end notices the closed socket as well
+        self.assertTrue(remote.closed.wait(2))
+
+
+class TestReadTimeout(unittest.TestCase):
+    def check_stalled_frame(self, local, remote_socket):
+        local.read_timeout = 0.1
+        local.start()
+        self.addCleanup(setattr, local, 'shutdown', True)
+        self.assertEqual(recv_exactly(remote_socket, 1), bytes((SC_OK, )))
+        remote_socket.sendall(bytes((SC_OK, )))
+        self.assertTrue(local.wait_ready(2))
+
+        # waiting for the next frame is not a stall
+        self.assertFalse(local.closed.wait(0.3))
+        remote_socket.sendall(bytes((0, 0)))
+        self.assertTrue(local.closed.wait(2))
+
+    def test_frame_stalled_in_connection_thread_is_dropped(self):
+        "connection should be closed when a frame stops arriving half way, but not while waiting for one"
+        local_socket, remote_socket = socket.socketpair()
+        self.addCleanup(remote_socket.close)
+        self.check_stalled_frame(Closing(local_socket), remote_socket)
+
+    def test_frame_stalled_in_reactor_is_dropped(self):
+        "reactor should close connection when a frame stops arriving half way, but not while waiting for one"
+        reactor = TinyProtoReactor()
+        reactor.start()
+        self.addCleanup(reactor.join, 1)
+        self.addCleanup(setattr, reactor, 'shutdown', True)
+        local_socket, remote_socket = socket.socketpair()
+        self.addCleanup(remote_socket.close)
+        local = Closing(local_socket)
+        local.use_reactor(reactor)
+        self.check_stalled_frame(local, remote_socket)
+
+
+class SlowReader(Closing):
+    __slots__ = ('count', )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count = 0
+
+    def transmission_received(self, msg):
+        self.count += 1
+        time.sleep(0.3)
+
+
+class TestReadTimeoutOnSend(unittest.TestCase):
+    def test_slow_reader_does_not_fail_transmit(self):
+        "read timeout should not limit sending to a remote end which reads slowly"
+        local, remote = Closing.socketpair(remote_handler=SlowReader, negotiate_capabilities=False)
+        local.negotiate_capabilities = True
+        local.read_timeout = 0.1
+        remote.start()
+        local.start()
+        self.addCleanup(setattr, remote, 'shutdown', True)
+        self.addCleanup(setattr, local, 'shutdown', True)
+        self.assertTrue(local.wait_ready(2))
+
+        for x in range(3):
+            local.transmit(bytes(4 * 1024 * 1024))
+        self.assertTrue(wait_for(lambda: remote.count == 3))
+        self.assertFalse(local.shutdown)
+
+
+class TestServerTimeouts(unittest.TestCase):
+    def test_server_drops_silent_connections(self):
+        "server with idle timeout should reap connection of a client which went silent"
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = TinyProtoServer([details], idle_timeout=0.2, heartbeat_interval=0.05)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        try:
+            self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+            sock = socket.create_connection(details.socket_connect_details, timeout=5)
+            self.addCleanup(sock.close)
+            sock.sendall(bytes((SC_OK, )))
+            self.assertEqual(recv_exactly(sock, 1), bytes((SC_OK, )))
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 1))
+
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 0, 2))
+            self.assertEqual(sock.recv(1), b'')
+        finally:
+            server.shutdown = True
+            server_thread.join(5)
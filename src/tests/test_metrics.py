@@ -0,0 +1,166 @@
+import unittest
+import socket
+import threading
+import urllib.request
+from tinyproto import TinyProtoConnection, TinyProtoServer, TinyProtoConnectionDetails
+from tinyproto.connection import SC_CONLIMIT
+from tinyproto import TinyProtoHistogram, TinyProtoMetrics, format_prometheus, start_metrics_server
+from .helpers import free_port, wait_for
+
+
+class Echo(TinyProtoConnection):
+    def transmission_received(self, msg):
+        self.transmit(bytes(msg))
+
+
+class Collector(TinyProtoConnection):
+    __slots__ = ('inbox', 'got_reply')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inbox = []
+        self.got_reply = threading.Event()
+
+    def transmission_received(self, msg):
+        self.inbox.append(bytes(msg))
+        self.got_reply.set()
+
+
+class TestHistogram(unittest.TestCase):
+    def test_histogram_quantiles_are_within_relative_error(self):
+        "histogram quantiles should stay within relative error given by significant bits"
+        histogram = TinyProtoHistogram()
+        for value in range(1, 100001):
+            histogram.record(value)
+        self.assertEqual(histogram.count, 100000)
+        self.assertEqual(histogram.min, 1)
+        self.assertEqual(histogram.max, 100000)
+        for q in (0.5, 0.9, 0.99, 0.999):
+            expected = q * 100000
+            self.assertLess(abs(histogram.quantile(q) - expected) / expected, 2 / 2**6)
+
+    def test_histogram_merge_adds_counts(self):
+        "merging histograms should give the same result as recording all values into one"
+        first, second, together = TinyProtoHistogram(), TinyProtoHistogram(), TinyProtoHistogram()
+        for value in range(1000):
+            first.record(value)
+            together.record(value)
+        for value in range(5000, 6000):
+            second.record(value)
+            together.record(value)
+        first.merge(second)
+        self.assertEqual(first.count, together.count)
+        self.assertEqual(first.total, together.total)
+        self.assertEqual(first.quantile(0.75), together.quantile(0.75))
+
+
+class TestConnectionMetrics(unittest.TestCase):
+    def test_connection_counts_bytes_messages_and_latencies(self):
+        "connection with metrics should count bytes and messages both ways, and record latencies"
+        local_socket, remote_socket = socket.socketpair()
+        local_connection = Collector(local_socket)
+        local_connection.metrics = TinyProtoMetrics()
+        remote_connection = Echo(remote_socket)
+        local_connection.start()
+        remote_connection.start()
+        self.assertTrue(local_connection.wait_ready(2))
+
+        local_connection.transmit(b'x' * 1000)
+        self.assertTrue(local_connection.got_reply.wait(2))
+        # handler is timed once it returns, right after setting the event
+        self.assertTrue(wait_for(lambda: local_connection.metrics.histograms['handler'].count == 1))
+        snapshot = local_connection.metrics.snapshot()
+        self.assertEqual(snapshot['messages_out'], 1)
+        self.assertEqual(snapshot['messages_in'], 1)
+        # handshake, 4 byte size, ack and the message itself
+        self.assertEqual(snapshot['bytes_out'], 1 + 4 + 1000 + 1)
+        self.assertEqual(snapshot['bytes_in'], 1 + 1 + 4 + 1000)
+        self.assertEqual(snapshot['ack_wait_seconds']['count'], 1)
+        self.assertEqual(snapshot['receive_seconds']['count'], 1)
+        self.assertEqual(snapshot['handler_seconds']['count'], 1)
+        self.assertGreater(snapshot['ack_wait_seconds']['max'], 0)
+
+        local_connection.shutdown = True
+        remote_connection.shutdown = True
+
+
+class TestServerMetrics(unittest.TestCase):
+    def test_server_merges_metrics_of_active_and_closed_connections(self):
+        "server with metrics should count connections, and keep metrics of closed connections"
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = TinyProtoServer([details], connection_handler=Echo, metrics=True)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        try:
+            self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+            sock = socket.create_connection(details.socket_connect_details, timeout=5)
+            connection = TinyProtoConnection(sock)
+            connection._initialise_connection()
+            connection.transmit(b'ping')
+            self.assertEqual(bytes(connection.receive()), b'ping')
+
+            snapshot = server.metrics_snapshot()
+            self.assertEqual(snapshot['connections_accepted'], 1)
+            self.assertEqual(snapshot['connections_active'], 1)
+            self.assertEqual(snapshot['messages_in'], 1)
+            self.assertEqual(snapshot['messages_out'], 1)
+
+            sock.close()
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 0))
+            snapshot = server.metrics_snapshot()
+            self.assertEqual(snapshot['connections_active'], 0)
+            self.assertEqual(snapshot['messages_in'], 1)
+            self.assertEqual(snapshot['messages_out'], 1)
+        finally:
+            server.shutdown = True
+            server_thread.join(5)
+
+
+    def test_server_counts_rejected_connections_and_keeps_running(self):
+        "server over its connection limit should answer with SC_CONLIMIT, count the rejection, and keep serving"
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = TinyProtoServer([details], connection_handler=Echo, connection_limit=1, metrics=True)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        try:
+            self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+            sock = socket.create_connection(details.socket_connect_details, timeout=5)
+            self.addCleanup(sock.close)
+            connection = TinyProtoConnection(sock)
+            connection._initialise_connection()
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 1))
+
+            rejected = socket.create_connection(details.socket_connect_details, timeout=5)
+            self.addCleanup(rejected.close)
+            self.assertEqual(rejected.recv(2), bytes((SC_CONLIMIT, )))
+            self.assertTrue(wait_for(lambda: server.metrics_snapshot()['connections_rejected'] == 1))
+
+            self.assertTrue(server_thread.is_alive())
+            connection.transmit(b'still here')
+            self.assertEqual(bytes(connection.receive()), b'still here')
+        finally:
+            server.shutdown = True
+            server_thread.join(5)
+
+
+class TestPrometheus(unittest.TestCase):
+    def test_snapshot_is_rendered_and_served_in_prometheus_format(self):
+        "snapshot should be rendered as prometheus counters and summaries, and served over http"
+        metrics = TinyProtoMetrics()
+        metrics.count_in(100, 2)
+        metrics.observe('receive', 0.5)
+        text = format_prometheus(metrics.snapshot())
+        self.assertIn('# TYPE tinyproto_bytes_in_total counter\ntinyproto_bytes_in_total 100\n', text)
+        self.assertIn('tinyproto_messages_in_total 2\n', text)
+        self.assertIn('# TYPE tinyproto_receive_seconds summary\n', text)
+        self.assertIn('tinyproto_receive_seconds_count 1\n', text)
+        self.assertIn('tinyproto_receive_seconds{quantile="0.99"}', text)
+
+        httpd = start_metrics_server(metrics.snapshot, 0)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(httpd.server_address[1])
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertEqual(response.read().decode(), text)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
@@ -0,0 +1,119 @@
+import unittest
+import asyncio
+import socket
+import threading
+from tinyproto import TinyProtoConnection, TinyProtoReactor, TinyProtoError
+from tinyproto.connection import CAP_PIPELINE
+
+
+class Collector(TinyProtoConnection):
+    __slots__ = ('inbox', 'expected', 'done')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inbox = []
+        self.expected = 1
+        self.done = threading.Event()
+
+    def transmission_received(self, msg):
+        self.inbox.append(bytes(msg))
+        if len(self.inbox) == self.expected:
+            self.done.set()
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def start_pair(self, pipelined=True, reactor=None):
+        s1, s2 = socket.socketpair()
+        self.sender = TinyProtoConnection(s1)
+        self.receiver = Collector(s2)
+        if pipelined:
+            self.sender.capabilities = CAP_PIPELINE
+            self.receiver.capabilities = CAP_PIPELINE
+        if reactor is not None:
+            self.sender.use_reactor(reactor)
+        self.receiver.start()
+        self.sender.start()
+        self.assertTrue(self.sender.wait_ready(2))
+        self.assertTrue(self.receiver.wait_ready(2))
+
+    def tearDown(self):
+        self.sender.shutdown = True
+        self.receiver.shutdown = True
+
+    def test_messages_queued_from_many_threads_are_sent_in_order(self):
+        "messages queued by transmit_nowait from many threads should all be sent, in order within each thread"
+        self.start_pair()
+        self.receiver.expected = 400
+        futures = []
+        futures_lock = threading.Lock()
+
+        def queue_messages(thread_id):
+            for x in range(100):
+                future = self.sender.transmit_nowait('{} {}'.format(thread_id, x).encode())
+                with futures_lock:
+                    futures.append(future)
+
+        threads = [threading.Thread(target=queue_messages, args=(t, )) for t in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for future in futures:
+            self.assertIsNone(future.result(2))
+        self.assertTrue(self.receiver.done.wait(2))
+        for thread_id in range(4):
+            received = [m for m in self.receiver.inbox if m.startswith('{} '.format(thread_id).encode())]
+            self.assertEqual(received, ['{} {}'.format(thread_id, x).encode() for x in range(100)])
+
+    def test_messages_are_queued_with_classic_framing(self):
+        "transmit_nowait should work with classic framing, the loop waiting for approval of every message"
+        self.start_pair(pipelined=False)
+        self.receiver.expected = 3
+        futures = [self.sender.transmit_nowait(m) for m in (b'one', b'two', b'three')]
+        for future in futures:
+            self.assertIsNone(future.result(2))
+        self.assertTrue(self.receiver.done.wait(2))
+        self.assertEqual(self.receiver.inbox, [b'one', b'two', b'three'])
+
+    def test_messages_are_sent_by_reactor(self):
+        "messages queued on a connection owned by a reactor should be sent by the reactor"
+        reactor = TinyProtoReactor()
+        reactor.start()
+        self.addCleanup(reactor.join, 1)
+        self.addCleanup(setattr, reactor, 'shutdown', True)
+        self.start_pair(reactor=reactor)
+        self.assertIsNone(self.sender.transmit_nowait(b'from reactor').result(2))
+        self.assertTrue(self.receiver.done.wait(2))
+        self.assertEqual(self.receiver.inbox, [b'from reactor'])
+
+    def test_send_async_returns_once_sent(self):
+        "send_async should be awaitable within asyncio"
+        self.start_pair()
+
+        async def send():
+            await self.sender.send_async(b'awaited')
+
+        asyncio.run(send())
+        self.assertTrue(self.receiver.done.wait(2))
+        self.assertEqual(self.receiver.inbox, [b'awaited'])
+
+    def test_queued_message_fails_on_closed_connection(self):
+        "transmit_nowait on a closed connection should fail its future"
+        self.start_pair()
+        self.sender.shutdown = True
+        with self.assertRaises(TinyProtoError):
+            self.sender.transmit_nowait(b'too late').result(2)
+
+    def test_pipelined_transmit_does_not_wait_for_receiving_side(self):
+        "with pipelined framing transmit should not wait for a thread holding the receiving lock"
+        self.start_pair()
+        transmitted = threading.Event()
+
+        def transmit():
+            self.sender.transmit(b'while reading')
+            transmitted.set()
+
+        with self.sender.connection_lock:
+            threading.Thread(target=transmit).start()
+            self.assertTrue(transmitted.wait(2))
+        self.assertTrue(self.receiver.done.wait(2))
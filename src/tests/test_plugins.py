@@ -0,0 +1,156 @@
+import unittest
+import socket
+import threading
+from tinyproto import TinyProtoConnection, TinyProtoError, TinyProtoPlugin, TinyProtoStreamPlugin, CompressionPlugin
+from tinyproto.plugins import TinyProtoPluginPipeline
+
+
+class TestCompressionPlugin(unittest.TestCase):
+    def test_small_message_sent_raw(self):
+        "messages below threshold should be sent uncompressed behind a raw flag byte"
+        plugin = CompressionPlugin(threshold=64)
+        wire = plugin.msg_transmit(b'short one')
+        self.assertEqual(wire, b'\x00short one')
+        self.assertEqual(plugin.msg_receive(bytearray(wire)), b'short one')
+
+    def test_incompressible_message_sent_raw(self):
+        "message which would not get any smaller should be sent as it is"
+        plugin = CompressionPlugin(threshold=0)
+        msg = bytes(range(256))
+        wire = plugin.msg_transmit(msg)
+        self.assertEqual(wire[0], 0x00)
+        self.assertEqual(plugin.msg_receive(wire), msg)
+
+    def test_zlib_round_trip(self):
+        "zlib compressed message should be smaller on the wire and restored on receive"
+        plugin = CompressionPlugin(threshold=16)
+        msg = b'{"key": "value"}' * 64
+        wire = plugin.msg_transmit(msg)
+        self.assertEqual(wire[0], 0x01)
+        self.assertLess(len(wire), len(msg))
+        self.assertEqual(plugin.msg_receive(bytearray(wire)), msg)
+
+    def test_lzma_round_trip(self):
+        "lzma compressed message should be restored on receive"
+        plugin = CompressionPlugin('lzma', threshold=16)
+        msg = b'{"key": "value"}' * 64
+        wire = plugin.msg_transmit(msg)
+        self.assertEqual(wire[0], 0x02)
+        self.assertEqual(plugin.msg_receive(wire), msg)
+
+    def test_dictionary_shrinks_small_messages(self):
+        "preset dictionary should compress small messages better than plain zlib"
+        dictionary = b'{"user": "", "action": "login", "status": "ok"}'
+        msg = b'{"user": "spajderix", "action": "login", "status": "ok"}'
+        plain = CompressionPlugin(threshold=0)
+        primed = CompressionPlugin(threshold=0, dictionary=dictionary)
+        wire = primed.msg_transmit(msg)
+        self.assertEqual(wire[0], 0x01)
+        self.assertLess(len(wire), len(plain.msg_transmit(msg)))
+        self.assertEqual(primed.msg_receive(wire), msg)
+
+    def test_dictionary_mismatch_raises(self):
+        "message compressed with a dictionary should not be silently decoded without it"
+        dictionary = b'{"user": "", "action": "login", "status": "ok"}'
+        wire = CompressionPlugin(threshold=0, dictionary=dictionary).msg_transmit(b'{"user": "x", "action": "login", "status": "ok"}')
+        with self.assertRaises(TinyProtoError):
+            CompressionPlugin(threshold=0).msg_receive(wire)
+
+    def test_unknown_flag_raises(self):
+        "unknown flag byte should raise an error"
+        with self.assertRaises(TinyProtoError):
+            CompressionPlugin().msg_receive(b'\x7fpayload')
+
+    def test_message_decompressing_above_max_length_raises(self):
+        "small message which would decompress above max length should be rejected, with both algorithms"
+        for algorithm in ('zlib', 'lzma'):
+            wire = CompressionPlugin(algorithm, threshold=0).msg_transmit(bytes(1000000))
+            self.assertLess(len(wire), 1000)
+            with self.assertRaises(TinyProtoError):
+                CompressionPlugin(algorithm, max_length=999999).msg_receive(wire)
+            self.assertEqual(len(CompressionPlugin(algorithm, max_length=1000000).msg_receive(wire)), 1000000)
+
+    def test_stream_decompressing_above_max_length_raises(self):
+        "compressed stream should be rejected once all of its chunks together decompress above max length"
+        wire = CompressionPlugin(threshold=0).msg_transmit(bytes(1000000))
+        receiving = TinyProtoPluginPipeline([CompressionPlugin(max_length=500000)], receiving=True)
+        with self.assertRaises(TinyProtoError):
+            for offset in range(0, len(wire), 100):
+                receiving.feed(wire[offset:offset + 100])
+
+    def test_lzma_with_dictionary_not_supported(self):
+        "preset dictionary should only be accepted with zlib"
+        with self.assertRaises(ValueError):
+            CompressionPlugin('lzma', dictionary=b'abc')
+
+    def test_compression_between_connections(self):
+        "message should go through compression plugin on both ends of a connection"
+        s1, s2 = socket.socketpair()
+        msg = b'all boundaries are conventions ' * 100
+        c1 = TinyProtoConnection(s1, connection_plugin_list=[CompressionPlugin(threshold=32)])
+        c2 = TinyProtoConnection(s2, connection_plugin_list=[CompressionPlugin(threshold=32)])
+        sending_thread = threading.Thread(target=c1.transmit, args=(msg, ))
+        sending_thread.start()
+        self.assertEqual(bytes(c2.receive()), msg)
+        sending_thread.join(2)
+        s1.close()
+        s2.close()
+
+
+class TestPluginPipeline(unittest.TestCase):
+    def test_whole_message_plugin_is_adapted(self):
+        "whole message plugin should get all chunks gathered into a single message"
+        class ReversePlugin(TinyProtoPlugin):
+            def msg_transmit(self, msg):
+                return bytes(reversed(msg))
+
+        pipeline = TinyProtoPluginPipeline([ReversePlugin()])
+        self.assertEqual(pipeline.feed(b'abc'), [])
+        self.assertEqual(pipeline.feed(b'def'), [])
+        self.assertEqual(pipeline.finish(), [b'fedcba'])
+
+    def test_stream_plugins_are_chained_chunk_by_chunk(self):
+        "every chunk should pass through the whole chain as soon as it is fed, in reversed order on receive"
+        class TagPlugin(TinyProtoStreamPlugin):
+            def __init__(self, tag):
+                self.tag = tag
+            def transmit_chunk(self, state, chunk):
+                return (bytes(chunk) + self.tag, )
+            def receive_chunk(self, state, chunk):
+                return (bytes(chunk) + self.tag, )
+            def transmit_end(self, state):
+                return (b'end' + self.tag, )
+
+        plugins = [TagPlugin(b'1'), TagPlugin(b'2')]
+        pipeline = TinyProtoPluginPipeline(plugins)
+        self.assertEqual(pipeline.feed(b'a'), [b'a12'])
+        self.assertEqual(pipeline.feed(b'b'), [b'b12'])
+        self.assertEqual(pipeline.finish(), [b'end12', b'end2'])
+        receiving = TinyProtoPluginPipeline(plugins, receiving=True)
+        self.assertEqual(receiving.feed(b'a'), [b'a21'])
+        self.assertEqual(plugins[0].msg_transmit(b'x'), b'x1end1')
+
+    def test_compression_stream_matches_whole_message_format(self):
+        "message compressed chunk by chunk should be readable as a whole message and the other way round"
+        plugin = CompressionPlugin(threshold=0)
+        msg = b'all boundaries are conventions ' * 100
+        pipeline = TinyProtoPluginPipeline([plugin])
+        wire = b''.join(pipeline.feed(msg[:1000]) + pipeline.feed(msg[1000:]) + pipeline.finish())
+        self.assertEqual(plugin.msg_receive(wire), msg)
+
+        wire = plugin.msg_transmit(msg)
+        receiving = TinyProtoPluginPipeline([plugin], receiving=True)
+        output = []
+        for offset in range(0, len(wire), 7):
+            output.extend(receiving.feed(wire[offset:offset + 7]))
+        output.extend(receiving.finish())
+        self.assertEqual(b''.join(output), msg)
+
+    def test_truncated_compression_stream_raises(self):
+        "compressed stream ending too early should raise an error"
+        plugin = CompressionPlugin(threshold=0)
+        wire = plugin.msg_transmit(b'all boundaries are conventions ' * 100)
+        receiving = TinyProtoPluginPipeline([plugin], receiving=True)
+        receiving.feed(wire[:len(wire) // 2])
+        with self.assertRaises(TinyProtoError):
+            receiving.finish()
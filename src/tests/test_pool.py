@@ -0,0 +1,110 @@
+import unittest
+import unittest.mock
+import threading
+import time
+from tinyproto import TinyProtoConnection, TinyProtoConnectionDetails, TinyProtoConnectionPool, TinyProtoClient, TinyProtoError
+
+
+def mock_connection(*args, **kwargs):
+    connection_mock = unittest.mock.MagicMock(spec=TinyProtoConnection)
+    connection_mock.shutdown = False
+    connection_mock.is_alive.return_value = True
+    connection_mock.is_healthy.return_value = True
+    connection_mock.wait_ready.return_value = True
+    return connection_mock
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.details = TinyProtoConnectionDetails('127.0.0.1', 5000)
+        self.connect = unittest.mock.MagicMock(side_effect=mock_connection)
+
+    def test_connection_is_reused(self):
+        "connection checked in should be handed out again without connecting"
+        pool = TinyProtoConnectionPool(self.details, self.connect)
+
+        first = pool.checkout()
+        pool.checkin(first)
+        second = pool.checkout()
+
+        self.assertIs(first, second)
+        self.connect.assert_called_once_with(self.details)
+        self.assertEqual(len(pool), 1)
+
+    def test_checkout_waits_when_pool_exhausted(self):
+        "checkout above max_size should wait for a checkin, or fail after timeout"
+        pool = TinyProtoConnectionPool(self.details, self.connect, max_size=1)
+        first = pool.checkout()
+
+        with self.assertRaises(TinyProtoError):
+            pool.checkout(timeout=0.05)
+
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(pool.checkout(timeout=2)))
+        waiter.start()
+        time.sleep(0.05)
+        pool.checkin(first)
+        waiter.join(2)
+
+        self.assertEqual(result, [first])
+        self.assertEqual(self.connect.call_count, 1)
+
+    def test_unhealthy_connection_is_replaced(self):
+        "idle connection failing health check should be closed and replaced with a new one"
+        pool = TinyProtoConnectionPool(self.details, self.connect)
+        first = pool.checkout()
+        pool.checkin(first)
+        first.is_healthy.return_value = False
+
+        second = pool.checkout()
+
+        self.assertIsNot(first, second)
+        self.assertTrue(first.shutdown)
+        self.assertEqual(len(pool), 1)
+
+    def test_idle_connections_are_evicted_down_to_min_size(self):
+        "connections idle above idle_timeout should be closed, keeping min_size of them"
+        pool = TinyProtoConnectionPool(self.details, self.connect, min_size=1, idle_timeout=0)
+        pool.fill()
+        self.assertEqual(pool.idle_count(), 1)
+        first = pool.checkout()
+        second = pool.checkout()
+        pool.checkin(first)
+        pool.checkin(second)
+
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.idle_count(), 1)
+        self.assertTrue(first.shutdown)
+
+    def test_closed_connection_is_not_returned_to_pool(self):
+        "connection shut down while checked out should be dropped on checkin"
+        pool = TinyProtoConnectionPool(self.details, self.connect)
+        first = pool.checkout()
+        first.shutdown = True
+        pool.checkin(first)
+
+        self.assertEqual(len(pool), 0)
+        self.assertIsNot(pool.checkout(), first)
+
+
+class TestClientPool(unittest.TestCase):
+    def test_client_pools_connections_by_endpoint(self):
+        "client should keep a separate pool per host and port, and reuse connections within it"
+        client = TinyProtoClient(pool_max_size=2)
+        details = TinyProtoConnectionDetails('127.0.0.1', 5000)
+        other_details = TinyProtoConnectionDetails('127.0.0.1', 5001)
+
+        with unittest.mock.patch.object(TinyProtoClient, '_create_connection', side_effect=lambda d: mock_connection(remote_details=d)) as create_mock:
+            with client.pooled(details) as first:
+                first.remote_details = details
+            with client.pooled(details) as second:
+                pass
+            with client.pooled(other_details) as third:
+                third.remote_details = other_details
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, third)
+        self.assertEqual(create_mock.call_count, 2)
+        first.start.assert_called_once()
+        self.assertEqual(set(client.connection_pools.keys()), {('127.0.0.1', 5000), ('127.0.0.1', 5001)})
+        self.assertEqual(client.active_connections, {})
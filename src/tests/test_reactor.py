@@ -0,0 +1,286 @@
+import unittest
+import socket
+import threading
+import time
+from tinyproto import TinyProtoConnection, TinyProtoReactor
+from tinyproto.connection import CAP_PIPELINE, SC_OK
+from .helpers import wait_for
+
+
+class ReactorEcho(TinyProtoConnection):
+    __slots__ = ('received', 'closed', 'handler_threads')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = []
+        self.closed = threading.Event()
+        self.handler_threads = set()
+
+    def transmission_received(self, msg):
+        self.handler_threads.add(threading.current_thread())
+        self.received.append(bytes(msg))
+        self.transmit(bytes(msg).upper())
+
+    def post_loop(self):
+        self.closed.set()
+
+
+class Collector(TinyProtoConnection):
+    __slots__ = ('inbox', 'got_reply')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inbox = []
+        self.got_reply = threading.Event()
+
+    def transmission_received(self, msg):
+        self.inbox.append(bytes(msg))
+        self.got_reply.set()
+
+
+class Faulty(ReactorEcho):
+    def transmission_received(self, msg):
+        if bytes(msg) == b'boom':
+            raise ValueError('bug in handler')
+        super().transmission_received(msg)
+
+    def loop_pass(self):
+        if self.received == [b'loop']:
+            raise ValueError('bug in loop pass')
+
+
+class CountingPasses(ReactorEcho):
+    __slots__ = ('passes', )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.passes = 0
+
+    def loop_pass(self):
+        self.passes += 1
+
+
+class Ticking(CountingPasses):
+    loop_interval = 0.05
+
+
+class Greeter(TinyProtoConnection):
+    def pre_loop(self):
+        self.transmit(b'hello')
+
+
+class Relay(TinyProtoConnection):
+    'Passes every message on to another connection, straight from the reactor thread'
+    __slots__ = ('target', )
+
+    def transmission_received(self, msg):
+        # unlike transmit, transmit_many still sends right away from the reactor thread
+        self.target.transmit_many((bytes(msg), ))
+
+
+class StalledCollector(Collector):
+    'Stops reading after the first message, until released'
+    __slots__ = ('release', )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = threading.Event()
+
+    def transmission_received(self, msg):
+        self.release.wait(5)
+        super().transmission_received(msg)
+
+
+def wait_for_handshake(connection, timeout=2):
+    deadline = time.monotonic() + timeout
+    while connection.peername_details is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestReactor(unittest.TestCase):
+    def setUp(self):
+        self.reactor = TinyProtoReactor()
+        self.reactor.start()
+
+    def tearDown(self):
+        self.reactor.shutdown = True
+        self.reactor.join(1)
+
+    def test_reactor_drives_connection_state_machine(self):
+        "reactor should complete handshake, receive message in reactor thread and allow replying from the hook"
+        reactor_socket, remote_socket = socket.socketpair()
+        reactor_connection = ReactorEcho(reactor_socket)
+        reactor_connection.use_reactor(self.reactor)
+        reactor_connection.start()
+        remote_connection = Collector(remote_socket)
+        remote_connection.start()
+        wait_for_handshake(remote_connection)
+
+        remote_connection.transmit(b'all boundaries are conventions')
+
+        self.assertTrue(remote_connection.got_reply.wait(2))
+        self.assertEqual(reactor_connection.received, [b'all boundaries are conventions'])
+        self.assertEqual(remote_connection.inbox, [b'ALL BOUNDARIES ARE CONVENTIONS'])
+        self.assertEqual(reactor_connection.handler_threads, {self.reactor._reactor_thread})
+        self.assertTrue(reactor_connection.is_alive())
+
+        remote_connection.shutdown = True
+        self.assertTrue(reactor_connection.closed.wait(2))
+        self.reactor.shutdown = True
+        self.reactor.join(1)
+        self.assertFalse(reactor_connection.is_alive())
+
+    def test_reactor_holds_many_connections(self):
+        "single reactor should serve multiple connections at once"
+        pairs = []
+        for x in range(10):
+            reactor_socket, remote_socket = socket.socketpair()
+            reactor_connection = ReactorEcho(reactor_socket)
+            reactor_connection.use_reactor(self.reactor)
+            reactor_connection.start()
+            remote_connection = Collector(remote_socket)
+            remote_connection.start()
+            pairs.append((reactor_connection, remote_connection))
+
+        for x, (reactor_connection, remote_connection) in enumerate(pairs):
+            wait_for_handshake(remote_connection)
+            remote_connection.transmit('message {}'.format(x).encode())
+
+        for x, (reactor_connection, remote_connection) in enumerate(pairs):
+            self.assertTrue(remote_connection.got_reply.wait(2))
+            self.assertEqual(remote_connection.inbox, ['MESSAGE {}'.format(x).encode()])
+        self.assertEqual(self.reactor.connection_count(), 10)
+
+        for reactor_connection, remote_connection in pairs:
+            remote_connection.shutdown = True
+            self.assertTrue(reactor_connection.closed.wait(2))
+
+    def test_capability_offer_is_answered_before_pre_loop(self):
+        "reactor should answer capability offer sent with the handshake before pre_loop transmits anything"
+        reactor_socket, remote_socket = socket.socketpair()
+        reactor_connection = Greeter(reactor_socket)
+        reactor_connection.use_reactor(self.reactor)
+        reactor_connection.start()
+        remote_connection = Collector(remote_socket, negotiate_capabilities=True)
+        remote_connection.start()
+
+        self.assertTrue(remote_connection.got_reply.wait(2))
+        self.assertEqual(remote_connection.inbox, [b'hello'])
+        self.assertTrue(remote_connection.capabilities & CAP_PIPELINE)
+        self.assertEqual(reactor_connection.capabilities, remote_connection.capabilities)
+        remote_connection.shutdown = True
+
+    def test_error_in_hooks_closes_only_that_connection(self):
+        "unhandled error in a hook should close its own connection, and leave the reactor and other connections running"
+        pairs = []
+        for x in range(3):
+            reactor_socket, remote_socket = socket.socketpair()
+            reactor_connection = Faulty(reactor_socket)
+            reactor_connection.use_reactor(self.reactor)
+            reactor_connection.start()
+            remote_connection = Collector(remote_socket)
+            remote_connection.start()
+            wait_for_handshake(remote_connection)
+            pairs.append((reactor_connection, remote_connection))
+
+        pairs[0][1].transmit(b'boom')
+        pairs[1][1].transmit(b'loop')
+        self.assertTrue(pairs[0][0].closed.wait(2))
+        self.assertTrue(pairs[1][0].closed.wait(2))
+
+        pairs[2][1].transmit(b'still here')
+        self.assertTrue(pairs[2][1].got_reply.wait(2))
+        self.assertEqual(pairs[2][1].inbox, [b'STILL HERE'])
+        self.assertTrue(self.reactor.is_alive())
+        for reactor_connection, remote_connection in pairs:
+            remote_connection.shutdown = True
+
+    def test_idle_connections_are_left_out_of_passes(self):
+        "traffic on one connection should not run loop pass of idle connections, while loop interval still does"
+        pairs = []
+        for x in range(20):
+            reactor_socket, remote_socket = socket.socketpair()
+            reactor_connection = (Ticking if x == 1 else CountingPasses)(reactor_socket)
+            reactor_connection.use_reactor(self.reactor)
+            reactor_connection.start()
+            remote_connection = Collector(remote_socket)
+            remote_connection.start()
+            pairs.append((reactor_connection, remote_connection))
+        for reactor_connection, remote_connection in pairs:
+            wait_for_handshake(remote_connection)
+        ticking = pairs[1][0]
+        time.sleep(0.1)
+        idle_passes = [reactor_connection.passes for reactor_connection, remote_connection in pairs]
+
+        busy = pairs[0][1]
+        for x in range(50):
+            busy.got_reply.clear()
+            busy.transmit(b'busy')
+            self.assertTrue(busy.got_reply.wait(2))
+        time.sleep(0.2)
+
+        self.assertGreaterEqual(pairs[0][0].passes, 50)
+        self.assertGreater(ticking.passes, idle_passes[1] + 2)
+        self.assertEqual([reactor_connection.passes for reactor_connection, remote_connection in pairs[2:]], idle_passes[2:])
+        for reactor_connection, remote_connection in pairs:
+            remote_connection.shutdown = True
+
+    def test_transmit_from_reactor_thread_finishes_half_written_messages(self):
+        "sending from reactor thread should first finish queued messages the reactor left half written, without mixing their bytes"
+        target_socket, reader_socket = socket.socketpair()
+        target = TinyProtoConnection(target_socket)
+        target.use_reactor(self.reactor)
+        target.start()
+        reader = StalledCollector(reader_socket, negotiate_capabilities=True)
+        reader.start()
+        self.addCleanup(setattr, reader, 'shutdown', True)
+        self.assertTrue(wait_for(lambda: target.is_pipelined))
+        relay_socket, sender_socket = socket.socketpair()
+        relay = Relay(relay_socket)
+        relay.target = target
+        relay.use_reactor(self.reactor)
+        relay.start()
+        sender = Collector(sender_socket)
+        sender.start()
+        self.addCleanup(setattr, sender, 'shutdown', True)
+        wait_for_handshake(sender)
+
+        messages = [bytes((x, )) * 1024 * 1024 for x in range(4)]
+        futures = [target.transmit_nowait(m) for m in messages]
+        self.assertTrue(wait_for(lambda: self.reactor._connections[target].sending))
+        threading.Timer(0.2, reader.release.set).start()
+        sender.transmit(b'relayed')
+
+        self.assertTrue(wait_for(lambda: len(reader.inbox) == 5))
+        # messages still queued can be overtaken, but every one of them arrives whole
+        self.assertEqual(sorted(reader.inbox), sorted(messages + [b'relayed']))
+        for future in futures:
+            self.assertIsNone(future.result(2))
+
+    def test_transmit_from_hook_does_not_wait_for_silent_peer(self):
+        "transmit from a hook in the reactor thread should not wait for OK signal of a peer which went silent"
+        silent_socket, silent_remote = socket.socketpair()
+        self.addCleanup(silent_remote.close)
+        silent = ReactorEcho(silent_socket)
+        silent.use_reactor(self.reactor)
+        silent.start()
+        # handshake and a message with classic framing, then the reply is never approved
+        silent_remote.sendall(bytes((SC_OK, )))
+        self.assertEqual(silent_remote.recv(1), bytes((SC_OK, )))
+        silent_remote.sendall((5).to_bytes(4, 'big'))
+        self.assertEqual(silent_remote.recv(1), bytes((SC_OK, )))
+        silent_remote.sendall(b'quiet')
+        self.assertEqual(silent_remote.recv(4), (5).to_bytes(4, 'big'))
+        self.assertEqual(silent.received, [b'quiet'])
+
+        reactor_socket, remote_socket = socket.socketpair()
+        reactor_connection = ReactorEcho(reactor_socket)
+        reactor_connection.use_reactor(self.reactor)
+        reactor_connection.start()
+        remote_connection = Collector(remote_socket)
+        remote_connection.start()
+        self.addCleanup(setattr, remote_connection, 'shutdown', True)
+        wait_for_handshake(remote_connection)
+        remote_connection.transmit_nowait(b'still served')
+        self.assertTrue(remote_connection.got_reply.wait(2))
+        self.assertEqual(remote_connection.inbox, [b'STILL SERVED'])
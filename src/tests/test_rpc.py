@@ -0,0 +1,85 @@
+import unittest
+import unittest.mock
+import asyncio
+import socket
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from tinyproto import TinyProtoConnection, TinyProtoError
+from tinyproto.connection import CAP_PIPELINE
+
+
+class Responder(TinyProtoConnection):
+    __slots__ = ('held', )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.held = []
+
+    def request_received(self, msg):
+        if msg == b'fail':
+            raise ValueError('no such thing')
+        if msg == b'silence':
+            return Future()
+        if msg.startswith(b'hold'):
+            # answered later, once all held requests arrived
+            future = Future()
+            self.held.append((future, bytes(msg)))
+            if len(self.held) == 3:
+                for held_future, held_msg in reversed(self.held):
+                    held_future.set_result(held_msg.upper())
+            return future
+        return bytes(msg).upper()
+
+
+class TestRequest(unittest.TestCase):
+    def setUp(self):
+        s1, s2 = socket.socketpair()
+        self.requester = TinyProtoConnection(s1)
+        self.responder = Responder(s2)
+        self.requester.capabilities = CAP_PIPELINE
+        self.responder.capabilities = CAP_PIPELINE
+        self.responder.start()
+        self.requester.start()
+        deadline = time.monotonic() + 2
+        while None in (self.requester.peername_details, self.responder.peername_details) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.requester.shutdown = True
+        self.responder.shutdown = True
+
+    def test_request_requires_pipelined_framing(self):
+        "request should be refused with classic framing"
+        connection_object = TinyProtoConnection(unittest.mock.MagicMock(spec=socket.socket))
+        with self.assertRaises(TinyProtoError):
+            connection_object.request(b'classic')
+
+    def test_many_requests_in_flight(self):
+        "responses arriving in any order should be matched with their requests"
+        futures = [self.requester.request('hold {}'.format(x).encode()) for x in range(3)]
+        self.assertEqual([f.result(2) for f in futures], [b'HOLD 0', b'HOLD 1', b'HOLD 2'])
+        self.assertEqual(self.requester.request(b'direct').result(2), b'DIRECT')
+
+    def test_failed_request(self):
+        "exception raised by request_received should fail the future on requesting end"
+        future = self.requester.request(b'fail')
+        with self.assertRaises(TinyProtoError) as cm:
+            future.result(2)
+        self.assertIn('no such thing', str(cm.exception))
+
+    def test_request_timeout(self):
+        "request without response should fail once its timeout passes"
+        future = self.requester.request(b'silence', timeout=0.1)
+        with self.assertRaises(FutureTimeoutError):
+            future.result(2)
+        self.assertEqual(len(self.requester._requests), 0)
+
+    def test_request_async(self):
+        "awaitable variant should return the response"
+        async def call():
+            return await self.requester.request_async(b'awaited', timeout=2)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(call()), b'AWAITED')
+        finally:
+            loop.close()
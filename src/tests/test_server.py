@@ -0,0 +1,350 @@
+import unittest
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+from tinyproto import TinyProtoServer, TinyProtoConnection, TinyProtoConnectionDetails, TinyProtoPlugin, TinyProtoError
+from tinyproto.server import BROADCAST_DISCONNECT
+from tinyproto.connection import SC_OK
+from .helpers import free_port, wait_for
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        data += sock.recv(size - len(data))
+    return data
+
+
+class PidEcho(TinyProtoConnection):
+    def transmission_received(self, msg):
+        self.transmit(str(os.getpid()).encode())
+
+
+class RecordingServer(TinyProtoServer):
+    __slots__ = ('events', 'exits')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events = []
+        self.exits = []
+
+    def worker_conn_init(self, worker_id, conn_id, addr):
+        self.events.append(('init', worker_id, conn_id))
+    def worker_conn_shutdown(self, worker_id, conn_id, addr):
+        self.events.append(('shutdown', worker_id, conn_id))
+    def worker_exited(self, worker_id, exitcode):
+        self.exits.append((worker_id, exitcode))
+
+
+class FailingServer(RecordingServer):
+    def pre_loop(self):
+        raise RuntimeError('worker fails right away')
+
+
+class Blocking(TinyProtoConnection):
+    'Connection loop stops on a message, so nothing queued for the connection gets sent'
+    release = threading.Event()
+
+    def transmission_received(self, msg):
+        Blocking.release.wait(5)
+
+
+class Collector(TinyProtoConnection):
+    __slots__ = ('inbox', 'got')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inbox = []
+        self.got = threading.Event()
+
+    def transmission_received(self, msg):
+        self.inbox.append(bytes(msg))
+        self.got.set()
+
+
+class CountingPlugin(TinyProtoPlugin):
+    __slots__ = ('calls', )
+
+    def __init__(self):
+        self.calls = 0
+
+    def msg_transmit(self, msg):
+        self.calls += 1
+        return bytes(msg)[::-1]
+
+    def msg_receive(self, msg):
+        return bytes(msg)[::-1]
+
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork'), 'worker processes require SO_REUSEPORT and fork')
+class TestWorkerProcesses(unittest.TestCase):
+    def ask_pid(self, details):
+        sock = socket.create_connection(details.socket_connect_details, timeout=5)
+        connection = TinyProtoConnection(sock)
+        connection._initialise_connection()
+        connection.transmit(b'pid?')
+        pid = int(bytes(connection.receive()))
+        sock.close()
+        return pid
+
+    def test_workers_serve_connections_and_get_restarted(self):
+        "server with worker processes should serve connections from workers, report them, and restart a crashed worker"
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = RecordingServer([details], connection_handler=PidEcho, worker_processes=2)
+        supervisor = threading.Thread(target=server.start)
+        supervisor.start()
+        try:
+            self.assertTrue(wait_for(lambda: len(server._workers) == 2 and all(w.pid for w in server._workers.values())))
+            worker_pids = {w.pid for w in server._workers.values()}
+            self.assertTrue(wait_for(lambda: self._accepting(details)))
+
+            pid = self.ask_pid(details)
+            self.assertIn(pid, worker_pids)
+            self.assertTrue(wait_for(lambda: len([e for e in server.events if e[0] == 'shutdown']) >= 1))
+            self.assertIn('init', [e[0] for e in server.events])
+
+            os.kill(pid, signal.SIGKILL)
+            self.assertTrue(wait_for(lambda: len(server.exits) == 1))
+            self.assertTrue(wait_for(lambda: pid not in {w.pid for w in server._workers.values()} and all(w.is_alive() for w in server._workers.values())))
+            self.assertEqual(server.exits[0][1], -signal.SIGKILL)
+        finally:
+            workers = list(server._workers.values())
+            server.shutdown = True
+            supervisor.join(10)
+        self.assertFalse(supervisor.is_alive())
+        self.assertFalse(any(w.is_alive() for w in workers))
+
+    def test_worker_failing_right_away_is_restarted_with_backoff(self):
+        "worker which keeps failing right away should be restarted after a delay doubling with every crash"
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = FailingServer([details], worker_processes=1)
+        supervisor = threading.Thread(target=server.start)
+        supervisor.start()
+        try:
+            time.sleep(1)
+            # restarted after 0.1, 0.2 and 0.4 seconds, next one is due only later
+            self.assertGreaterEqual(len(server.exits), 3)
+            self.assertLessEqual(len(server.exits), 4)
+        finally:
+            server.shutdown = True
+            supervisor.join(10)
+        self.assertFalse(supervisor.is_alive())
+
+    def test_sigterm_stops_supervisor_and_workers(self):
+        "SIGTERM sent to supervising process should stop it along with all of its workers"
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = TinyProtoServer([details], connection_handler=PidEcho, worker_processes=2)
+        supervisor = multiprocessing.get_context('fork').Process(target=server.start)
+        supervisor.start()
+        try:
+            self.assertTrue(wait_for(lambda: self._accepting(details)))
+            worker_pid = self.ask_pid(details)
+            os.kill(supervisor.pid, signal.SIGTERM)
+            supervisor.join(10)
+            self.assertEqual(supervisor.exitcode, 0)
+            self.assertFalse(self._accepting(details))
+            self.assertRaises(ProcessLookupError, os.kill, worker_pid, 0)
+        finally:
+            if supervisor.is_alive():
+                supervisor.kill()
+                supervisor.join()
+
+    def _accepting(self, details):
+        try:
+            socket.create_connection(details.socket_connect_details, timeout=1).close()
+            return True
+        except OSError:
+            return False
+
+
+class ShutdownRecorder(TinyProtoServer):
+    __slots__ = ('closed', 'closed_event')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed = []
+        self.closed_event = threading.Event()
+
+    def conn_shutdown(self, conn_id, conn_o):
+        self.closed.append(conn_id)
+        self.closed_event.set()
+
+
+class TestReaping(unittest.TestCase):
+    def test_terminated_connection_is_reaped_alone_right_away(self):
+        "connection which terminated should be reported to conn_shutdown right away, leaving other connections untouched"
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = ShutdownRecorder([details])
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        sockets = []
+        try:
+            self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+            for x in range(20):
+                sock = socket.create_connection(details.socket_connect_details, timeout=5)
+                TinyProtoConnection(sock)._handshake(False)
+                sockets.append(sock)
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 20))
+            conn_id, conn_o = next(iter(server.active_connections.items()))
+
+            conn_o.shutdown = True
+            self.assertTrue(server.closed_event.wait(1))
+            self.assertEqual(server.closed, [conn_id])
+            self.assertEqual(len(server.active_connections), 19)
+            self.assertNotIn(conn_id, server.active_connections)
+        finally:
+            server.shutdown = True
+            server_thread.join(5)
+            for sock in sockets:
+                sock.close()
+
+
+class TestBroadcast(unittest.TestCase):
+    def start_server(self, **kwargs):
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = TinyProtoServer([details], **kwargs)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        self.addCleanup(server_thread.join, 5)
+        self.addCleanup(setattr, server, 'shutdown', True)
+        self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+        return server, details
+
+    def connect(self, server, details, plugins=[], handler=Collector, **kwargs):
+        count = len(server.active_connections)
+        sock = socket.create_connection(details.socket_connect_details, timeout=5)
+        connection = handler(sock, connection_plugin_list=plugins, **kwargs)
+        connection.start()
+        self.assertTrue(connection.wait_ready(2))
+        self.addCleanup(setattr, connection, 'shutdown', True)
+        self.assertTrue(wait_for(lambda: len(server.active_connections) == count + 1))
+        conn_id = [c for c in server.active_connections if c not in self.known][0]
+        self.known.add(conn_id)
+        return conn_id, connection
+
+    def setUp(self):
+        self.known = set()
+
+    def test_broadcast_runs_plugins_once_and_skips_excluded(self):
+        "broadcast should run plugins once, and deliver the message to every connection but the excluded one"
+        plugin = CountingPlugin()
+        server, details = self.start_server(connection_plugin_list=[plugin])
+        clients = [self.connect(server, details, [CountingPlugin]) for x in range(3)]
+
+        futures = server.broadcast(b'hello everyone', exclude=(clients[0][0], ))
+        self.assertEqual(set(futures), {clients[1][0], clients[2][0]})
+        for future in futures.values():
+            self.assertIsNone(future.result(2))
+        for conn_id, connection in clients[1:]:
+            self.assertTrue(connection.got.wait(2))
+            self.assertEqual(connection.inbox, [b'hello everyone'])
+        self.assertEqual(plugin.calls, 1)
+        self.assertEqual(clients[0][1].inbox, [])
+
+    def test_slow_connection_does_not_hold_back_others(self):
+        "connection falling behind should get its broadcast messages dropped, while others get them"
+        Blocking.release.clear()
+        self.addCleanup(Blocking.release.set)
+        server, details = self.start_server(connection_handler=Blocking, broadcast_queue_limit=1)
+        slow_id, slow = self.connect(server, details)
+        fast_id, fast = self.connect(server, details)
+        slow.transmit(b'stop reading')
+        time.sleep(0.1)
+
+        first = server.broadcast(b'first', targets=(slow_id, ))
+        second = server.broadcast(b'second')
+        with self.assertRaises(TinyProtoError):
+            second[slow_id].result(2)
+        self.assertIsNone(second[fast_id].result(2))
+        self.assertTrue(fast.got.wait(2))
+        self.assertEqual(fast.inbox, [b'second'])
+
+        Blocking.release.set()
+        self.assertIsNone(first[slow_id].result(2))
+        self.assertTrue(slow.got.wait(2))
+        self.assertEqual(slow.inbox, [b'first'])
+
+    def test_client_not_reading_does_not_hold_back_reactor(self):
+        "reactor should keep writing broadcast messages to other connections while clients stopped reading"
+        Blocking.release.clear()
+        self.addCleanup(Blocking.release.set)
+        server, details = self.start_server(reactor_threads=1)
+        # one client with classic framing never reads, the other one is pipelined and stops reading
+        classic = socket.create_connection(details.socket_connect_details, timeout=5)
+        self.addCleanup(classic.close)
+        classic.sendall(bytes((SC_OK, )))
+        self.assertEqual(classic.recv(1), bytes((SC_OK, )))
+        self.assertTrue(wait_for(lambda: len(server.active_connections) == 1))
+        self.known.update(server.active_connections)
+        pipelined_id, pipelined = self.connect(server, details, handler=Blocking, negotiate_capabilities=True)
+        self.assertTrue(wait_for(lambda: server.active_connections[pipelined_id].is_pipelined))
+        server.broadcast(b'stop reading', targets=(pipelined_id, ))
+        fast_id, fast = self.connect(server, details)
+        time.sleep(0.1)
+
+        results = [server.broadcast(bytes(256 * 1024)) for x in range(20)]
+        for futures in results:
+            self.assertIsNone(futures[fast_id].result(2))
+        self.assertTrue(wait_for(lambda: len(fast.inbox) == 20))
+        self.assertFalse(results[-1][pipelined_id].done())
+        self.assertEqual(len([f for f in results[-1].values() if not f.done()]), 2)
+
+        Blocking.release.set()
+        self.assertIsNone(results[-1][pipelined_id].result(5))
+
+    def raw_client(self, server, details):
+        'Client with classic framing driven by hand, already known to the server'
+        count = len(server.active_connections)
+        sock = socket.create_connection(details.socket_connect_details, timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(bytes((SC_OK, )))
+        self.assertEqual(sock.recv(1), bytes((SC_OK, )))
+        self.assertTrue(wait_for(lambda: len(server.active_connections) == count + 1))
+        conn_id = [c for c in server.active_connections if c not in self.known][0]
+        self.known.add(conn_id)
+        return conn_id, sock
+
+    def raw_receive(self, sock):
+        size = int.from_bytes(recv_exactly(sock, 4), 'big')
+        sock.sendall(bytes((SC_OK, )))
+        return recv_exactly(sock, size)
+
+    def test_peer_reset_while_awaiting_ok_closes_only_its_connection(self):
+        "peer resetting while reactor waits for its OK signal should close its own connection, and leave the others served"
+        server, details = self.start_server(reactor_threads=1)
+        resetting_id, resetting = self.raw_client(server, details)
+        other_id, other = self.raw_client(server, details)
+
+        futures = server.broadcast(b'first')
+        self.assertEqual(recv_exactly(resetting, 4), (5).to_bytes(4, 'big'))
+        resetting.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        resetting.close()
+        self.assertEqual(self.raw_receive(other), b'first')
+        self.assertIsNone(futures[other_id].result(2))
+        with self.assertRaises((TinyProtoError, OSError)):
+            futures[resetting_id].result(2)
+        self.assertTrue(wait_for(lambda: resetting_id not in server.active_connections))
+
+        self.assertTrue(server._reactors[0].is_alive())
+        futures = server.broadcast(b'second')
+        self.assertEqual(self.raw_receive(other), b'second')
+        self.assertIsNone(futures[other_id].result(2))
+
+    def test_slow_connection_is_disconnected_with_disconnect_policy(self):
+        "connection falling behind should be shut down with BROADCAST_DISCONNECT"
+        Blocking.release.clear()
+        self.addCleanup(Blocking.release.set)
+        server, details = self.start_server(connection_handler=Blocking, broadcast_queue_limit=1, broadcast_overflow=BROADCAST_DISCONNECT)
+        slow_id, slow = self.connect(server, details)
+        slow.transmit(b'stop reading')
+        time.sleep(0.1)
+        server_connection = server.active_connections[slow_id]
+
+        server.broadcast(b'first')
+        with self.assertRaises(TinyProtoError):
+            server.broadcast(b'second')[slow_id].result(2)
+        self.assertTrue(server_connection.shutdown)
@@ -0,0 +1,183 @@
+import unittest
+import os
+import tempfile
+import threading
+from tinyproto import TinyProtoConnection, TinyProtoServer, TinyProtoClient, TinyProtoConnectionDetails, TinyProtoMetrics
+from tinyproto.connection import CAP_PIPELINE, CAP_SHM, CAP_HEARTBEAT
+from tinyproto import shm
+from .helpers import wait_for
+
+
+class Collector(TinyProtoConnection):
+    __slots__ = ('inbox', 'expected', 'done')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inbox = []
+        self.expected = 1
+        self.done = threading.Event()
+
+    def transmission_received(self, msg):
+        self.inbox.append(bytes(msg))
+        if len(self.inbox) == self.expected:
+            self.done.set()
+
+
+class Keeper(TinyProtoConnection):
+    'Keeps messages without copying them'
+    __slots__ = ('kept', 'done')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kept = []
+        self.done = threading.Event()
+
+    def transmission_received(self, msg):
+        self.kept.append((msg, bytes(msg)))
+        self.done.set()
+
+
+class Echo(TinyProtoConnection):
+    def transmission_received(self, msg):
+        self.transmit(msg)
+
+
+@unittest.skipUnless(shm.is_supported(), 'shared memory is not supported')
+class TestShmRing(unittest.TestCase):
+    def setUp(self):
+        self.ring = shm.TinyProtoShmRing(1000)
+        self.addCleanup(self.ring.close)
+
+    def test_ring_wraps_around_once_oldest_slots_are_released(self):
+        "ring should place messages one after another, and reuse space from the start once it is released"
+        first = self.ring.allocate(400)
+        second = self.ring.allocate(400)
+        self.assertEqual((first[1], second[1]), (0, 400))
+        self.assertIsNone(self.ring.allocate(400))
+
+        self.ring.release(first[0])
+        third = self.ring.allocate(400)
+        self.assertEqual(third[1], 0)
+        self.assertIsNone(self.ring.allocate(100))
+        self.assertEqual(len(self.ring), 2)
+
+    def test_slot_is_reused_only_after_all_references_and_older_slots_are_released(self):
+        "slot should stay in use until every reference is gone, and until all slots written before it are free"
+        first = self.ring.allocate(500, references=2)
+        second = self.ring.allocate(500)
+        self.ring.release(second[0])
+        self.ring.release(first[0])
+        self.assertIsNone(self.ring.allocate(500))
+        self.ring.release(first[0])
+        self.assertEqual(len(self.ring), 0)
+        self.assertEqual(self.ring.allocate(1000)[1], 0)
+
+    def test_write_copies_message_into_segment(self):
+        "write should copy message into the segment, where an attached end can read it"
+        slot_id, offset = self.ring.write(memoryview(b'shared'))
+        segment = shm.attach_segment(self.ring.name)
+        try:
+            self.assertEqual(bytes(segment.buf[offset:offset + 6]), b'shared')
+        finally:
+            shm.close_segment(segment)
+
+
+@unittest.skipUnless(shm.is_supported(), 'shared memory is not supported')
+class TestShmConnection(unittest.TestCase):
+    def start_pair(self, local_size=1 << 20, remote_size=1 << 20, remote_handler=Collector):
+        self.local, self.remote = Collector.socketpair(remote_handler=remote_handler)
+        self.local.negotiate_capabilities = True
+        self.local.shared_memory_size = local_size
+        self.remote.shared_memory_size = remote_size
+        self.remote.metrics = TinyProtoMetrics()
+        self.remote.start()
+        self.local.start()
+        self.addCleanup(setattr, self.remote, 'shutdown', True)
+        self.addCleanup(setattr, self.local, 'shutdown', True)
+        self.assertTrue(self.local.wait_ready(2))
+
+    def test_large_message_passes_through_shared_memory(self):
+        "message above threshold should be read from the ring of the remote end, with only its descriptor on the socket"
+        self.start_pair()
+        self.assertEqual(self.local.capabilities, CAP_PIPELINE | CAP_SHM | CAP_HEARTBEAT)
+        self.assertTrue(wait_for(lambda: self.local._shm_out is not None and self.local._shm_out.ready))
+        msg = os.urandom(512 * 1024)
+
+        self.local.transmit(msg)
+
+        self.assertTrue(self.remote.done.wait(5))
+        self.assertEqual(self.remote.inbox, [msg])
+        self.assertLess(self.remote.metrics.snapshot()['bytes_in'], 1024)
+        # slot is released by the remote end once the message is copied out
+        self.assertTrue(wait_for(lambda: len(self.local._shm_out) == 0))
+
+    def test_message_view_is_released_once_handled(self):
+        "message read from shared memory should be a read-only view, released together with its slot once the hook returns"
+        self.start_pair(remote_handler=Keeper)
+        self.assertTrue(wait_for(lambda: self.local._shm_out is not None and self.local._shm_out.ready))
+        msg = os.urandom(128 * 1024)
+
+        self.local.transmit(msg)
+
+        self.assertTrue(self.remote.done.wait(5))
+        view, copy = self.remote.kept[0]
+        self.assertEqual(copy, msg)
+        self.assertIsInstance(view, memoryview)
+        self.assertTrue(wait_for(lambda: len(self.local._shm_out) == 0))
+        with self.assertRaises(ValueError):
+            view.tobytes()
+
+    def test_full_ring_falls_back_to_socket(self):
+        "messages not fitting into the ring should be sent through the socket, in order with the others"
+        self.start_pair(local_size=300 * 1024)
+        self.assertTrue(wait_for(lambda: self.local._shm_out is not None and self.local._shm_out.ready))
+        msgs = [os.urandom(200 * 1024) for x in range(4)] + [os.urandom(400 * 1024)]
+        self.remote.expected = len(msgs)
+
+        futures = [self.local.transmit_nowait(msg) for msg in msgs]
+
+        self.assertTrue(self.remote.done.wait(5))
+        self.assertEqual(self.remote.inbox, msgs)
+        for future in futures:
+            self.assertIsNone(future.result(5))
+        # the last one never fits, so at least that one went through the socket
+        self.assertGreater(self.remote.metrics.snapshot()['bytes_in'], 400 * 1024)
+
+    def test_shared_memory_requires_both_ends(self):
+        "shared memory should not be agreed when the remote end does not enable it"
+        self.start_pair(remote_size=0)
+        self.assertEqual(self.local.capabilities, CAP_PIPELINE | CAP_HEARTBEAT)
+        self.local.transmit(b'x' * (128 * 1024))
+        self.assertTrue(self.remote.done.wait(5))
+        self.assertIsNone(self.local._shm_out)
+
+
+@unittest.skipUnless(shm.is_supported() and hasattr(os, 'getuid'), 'shared memory or unix sockets are not supported')
+class TestShmServer(unittest.TestCase):
+    def test_server_and_client_agree_on_shared_memory_over_unix_socket(self):
+        "server and client on the same host should pass large messages through shared memory both ways"
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        details = TinyProtoConnectionDetails.unix(os.path.join(directory.name, 'shm.sock'))
+        server = TinyProtoServer([details], connection_handler=Echo, shared_memory_size=1 << 20)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        self.addCleanup(server_thread.join, 5)
+        self.addCleanup(setattr, server, 'shutdown', True)
+        self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+
+        client = TinyProtoClient(connection_handler=Collector, negotiate_capabilities=True, shared_memory_size=1 << 20)
+        connection = client.active_connections[client.connect_to(details)]
+        self.addCleanup(setattr, connection, 'shutdown', True)
+        connection.metrics = TinyProtoMetrics()
+        self.assertTrue(connection.wait_ready(5))
+        self.assertTrue(wait_for(lambda: connection._shm_out is not None and connection._shm_out.ready))
+        server_connection = tuple(server.active_connections.values())[0]
+        self.assertTrue(wait_for(lambda: server_connection._shm_out is not None and server_connection._shm_out.ready))
+
+        msg = os.urandom(256 * 1024)
+        connection.transmit(msg)
+
+        self.assertTrue(connection.done.wait(5))
+        self.assertEqual(connection.inbox, [msg])
+        self.assertLess(connection.metrics.snapshot()['bytes_in'], 1024)
@@ -0,0 +1,99 @@
+import unittest
+import socket
+import threading
+from tinyproto import TinyProtoServer, TinyProtoClient, TinyProtoConnectionDetails, TinyProtoSocketOptions
+from tinyproto.connection import SC_OK
+from .helpers import free_port, wait_for
+
+
+def option(sock, level, name):
+    return sock.getsockopt(level, name)
+
+
+class TestSocketOptions(unittest.TestCase):
+    def test_options_are_set_on_tcp_socket(self):
+        "profile should set nodelay, keepalive and buffer sizes on a tcp socket"
+        options = TinyProtoSocketOptions(nodelay=True, keepalive=True, keepalive_count=3, receive_buffer=65536)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            options.apply(sock)
+            self.assertTrue(option(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(option(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            if hasattr(socket, 'TCP_KEEPCNT'):
+                self.assertEqual(option(sock, socket.IPPROTO_TCP, socket.TCP_KEEPCNT), 3)
+            # linux doubles the requested size to account for its own bookkeeping
+            self.assertGreaterEqual(option(sock, socket.SOL_SOCKET, socket.SO_RCVBUF), 65536)
+        finally:
+            sock.close()
+
+    def test_tcp_options_are_skipped_for_other_families(self):
+        "tcp level options should not be set on sockets which are not tcp"
+        options = TinyProtoSocketOptions(nodelay=True, keepalive_idle=10, quickack=True)
+        local_socket, remote_socket = socket.socketpair()
+        try:
+            options.apply(local_socket)
+        finally:
+            local_socket.close()
+            remote_socket.close()
+
+
+class TestServerSocketOptions(unittest.TestCase):
+    def setUp(self):
+        self.details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+
+    def start_server(self, **kwargs):
+        server = TinyProtoServer([self.details], **kwargs)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        self.addCleanup(server_thread.join, 5)
+        self.addCleanup(setattr, server, 'shutdown', True)
+        self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+        return server
+
+    def test_burst_of_connections_is_accepted_with_options(self):
+        "server should accept every waiting connection, and set its options on accepted sockets"
+        server = self.start_server(socket_options=TinyProtoSocketOptions(backlog=64, nodelay=True, keepalive=True))
+        self.assertEqual(server.listen_socks[0].gettimeout(), 0.0)
+        socks = [socket.create_connection(self.details.socket_connect_details, timeout=5) for x in range(20)]
+        try:
+            for sock in socks:
+                sock.sendall(bytes((SC_OK, )))
+            for sock in socks:
+                self.assertEqual(sock.recv(1), bytes((SC_OK, )))
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 20))
+            for conn_o in tuple(server.active_connections.values()):
+                self.assertIsNone(conn_o.socket_o.gettimeout())
+                self.assertTrue(option(conn_o.socket_o, socket.IPPROTO_TCP, socket.TCP_NODELAY))
+                self.assertTrue(option(conn_o.socket_o, socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        finally:
+            for sock in socks:
+                sock.close()
+
+    def test_options_of_connection_details_take_precedence(self):
+        "options given with listening address should be used instead of the ones of the server"
+        self.details.socket_options = TinyProtoSocketOptions(nodelay=False, keepalive=True)
+        server = self.start_server(socket_options=TinyProtoSocketOptions(nodelay=True))
+        sock = socket.create_connection(self.details.socket_connect_details, timeout=5)
+        try:
+            sock.sendall(bytes((SC_OK, )))
+            self.assertEqual(sock.recv(1), bytes((SC_OK, )))
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 1))
+            conn_o = tuple(server.active_connections.values())[0]
+            self.assertFalse(option(conn_o.socket_o, socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(option(conn_o.socket_o, socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        finally:
+            sock.close()
+
+    def test_client_sets_options_on_its_connections(self):
+        "client should set its options on sockets before connecting"
+        self.start_server()
+        client = TinyProtoClient(socket_options=TinyProtoSocketOptions(nodelay=True, keepalive=True))
+        conn_id = client.connect_to(self.details)
+        conn_o = client.active_connections[conn_id]
+        try:
+            self.assertTrue(conn_o.wait_ready(5))
+            self.assertTrue(option(conn_o.socket_o, socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(option(conn_o.socket_o, socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            self.assertIs(conn_o.socket_options, client.socket_options)
+        finally:
+            conn_o.shutdown = True
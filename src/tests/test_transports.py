@@ -0,0 +1,181 @@
+import unittest
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+from tinyproto import TinyProtoServer, TinyProtoClient, TinyProtoConnection, TinyProtoConnectionDetails, TinyProtoError
+from tinyproto import AsyncTinyProtoConnection, AsyncTinyProtoClient
+from .helpers import wait_for
+
+
+class Echo(TinyProtoConnection):
+    def transmission_received(self, msg):
+        self.transmit(bytes(msg))
+
+
+class Collector(TinyProtoConnection):
+    __slots__ = ('inbox', 'got')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inbox = []
+        self.got = threading.Event()
+
+    def transmission_received(self, msg):
+        self.inbox.append(bytes(msg))
+        self.got.set()
+
+
+def ipv6_available():
+    if not socket.has_ipv6:
+        return False
+    probe = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    try:
+        probe.bind(('::1', 0))
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'unix domain sockets are not supported')
+class TestUnixTransport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'tinyproto.sock')
+
+    def start_server(self, details):
+        server = TinyProtoServer([details], connection_handler=Echo)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        self.addCleanup(server_thread.join, 5)
+        self.addCleanup(setattr, server, 'shutdown', True)
+        self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+        return server, server_thread
+
+    def round_trip(self, details):
+        client = TinyProtoClient(connection_handler=Collector)
+        connection = client.active_connections[client.connect_to(details)]
+        try:
+            self.assertTrue(connection.wait_ready(5))
+            connection.transmit(b'same host')
+            self.assertTrue(connection.got.wait(5))
+            self.assertEqual(connection.inbox, [b'same host'])
+        finally:
+            connection.shutdown = True
+
+    def test_unix_details_are_not_resolved(self):
+        "unix details should keep the path as address, and describe it as such"
+        details = TinyProtoConnectionDetails.unix(self.path)
+        self.assertTrue(details.is_unix)
+        self.assertEqual(details.address_family, socket.AF_UNIX)
+        self.assertEqual(details.socket_connect_details, self.path)
+        self.assertEqual(str(details), 'unix:' + self.path)
+        self.assertEqual(str(TinyProtoConnectionDetails.unix('\0tinyproto')), 'unix:@tinyproto')
+        with self.assertRaises(TinyProtoError):
+            TinyProtoConnectionDetails.unix('')
+
+    def test_server_and_client_talk_over_unix_socket(self):
+        "client should reach server listening on a unix socket path, which is removed once the server stops"
+        # left behind by a server which did not stop cleanly
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+
+        server, server_thread = self.start_server(TinyProtoConnectionDetails.unix(self.path))
+        self.round_trip(TinyProtoConnectionDetails.unix(self.path))
+
+        server.shutdown = True
+        server_thread.join(5)
+        self.assertFalse(os.path.exists(self.path))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'abstract namespace is linux only')
+    def test_server_and_client_talk_over_abstract_address(self):
+        "client should reach server listening on an address in the abstract namespace"
+        details = TinyProtoConnectionDetails.unix('\0tinyproto-test-{}'.format(os.getpid()))
+        self.start_server(details)
+        self.round_trip(details)
+
+    def test_workers_refuse_unix_addresses(self):
+        "server with worker processes should refuse unix socket addresses, as they can not be shared"
+        server = TinyProtoServer([TinyProtoConnectionDetails.unix(self.path)], worker_processes=2)
+        with self.assertRaises(TinyProtoError):
+            server.start()
+
+    def test_async_client_connects_over_unix_socket(self):
+        "async client should reach threaded server listening on a unix socket"
+        details = TinyProtoConnectionDetails.unix(self.path)
+        self.start_server(details)
+
+        class AsyncCollector(AsyncTinyProtoConnection):
+            __slots__ = ('inbox', )
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.inbox = asyncio.Queue()
+            async def transmission_received(self, msg):
+                await self.inbox.put(bytes(msg))
+
+        async def scenario():
+            client = AsyncTinyProtoClient(connection_handler=AsyncCollector)
+            connection = client.active_connections[await client.connect_to(details)]
+            await connection.transmit(b'async')
+            reply = await connection.inbox.get()
+            connection.shutdown = True
+            await connection.wait_closed()
+            return reply
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(asyncio.wait_for(scenario(), 5)), b'async')
+        finally:
+            loop.close()
+
+
+class TestInet6Transport(unittest.TestCase):
+    @unittest.skipUnless(ipv6_available(), 'ipv6 loopback is not available')
+    def test_server_listens_on_ipv6_address(self):
+        "server should listen with the address family of its connection details"
+        probe = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        probe.bind(('::1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        details = TinyProtoConnectionDetails('::1', port)
+        server = TinyProtoServer([details], connection_handler=Echo)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        try:
+            self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+            self.assertEqual(server.listen_socks[0].family, socket.AF_INET6)
+            client = TinyProtoClient(connection_handler=Collector)
+            connection = client.active_connections[client.connect_to(details)]
+            self.assertTrue(connection.wait_ready(5))
+            connection.transmit(b'v6')
+            self.assertTrue(connection.got.wait(5))
+            self.assertEqual(connection.socket_o.family, socket.AF_INET6)
+            connection.shutdown = True
+        finally:
+            server.shutdown = True
+            server_thread.join(5)
+
+
+class TestSocketPair(unittest.TestCase):
+    def test_socketpair_connects_two_connections_in_process(self):
+        "socketpair should give two connections talking to each other, with different channel id ranges"
+        local_connection, remote_connection = Collector.socketpair(remote_handler=Echo)
+        self.assertIsInstance(remote_connection, Echo)
+        self.assertEqual(local_connection._next_channel_id, 1)
+        self.assertEqual(remote_connection._next_channel_id, 2)
+        local_connection.start()
+        remote_connection.start()
+        try:
+            self.assertTrue(local_connection.wait_ready(2))
+            local_connection.transmit(b'in process')
+            self.assertTrue(local_connection.got.wait(2))
+            self.assertEqual(local_connection.inbox, [b'in process'])
+        finally:
+            local_connection.shutdown = True
+            remote_connection.shutdown = True
@@ -0,0 +1,149 @@
+import unittest
+import socket
+import threading
+import time
+from tinyproto import TinyProtoConnection, TinyProtoReactor, TinyProtoServer, TinyProtoClient, TinyProtoConnectionDetails
+from tinyproto.wakeup import TinyProtoWaker
+from .helpers import free_port, wait_for
+
+
+class PassCounter(TinyProtoConnection):
+    __slots__ = ('passes', 'woken')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.passes = 0
+        self.woken = threading.Event()
+
+    def loop_pass(self):
+        self.passes += 1
+        self.woken.set()
+
+
+class IntervalCounter(PassCounter):
+    loop_interval = 0.02
+
+
+class ClientPassCounter(TinyProtoClient):
+    __slots__ = ('passes', 'woken')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.passes = 0
+        self.woken = threading.Event()
+
+    def loop_pass(self):
+        self.passes += 1
+        self.woken.set()
+
+
+class TestWaker(unittest.TestCase):
+    def test_waker_coalesces_wakes_until_drained(self):
+        "waker should make selector return once for any number of wakes, until it is drained"
+        waker = TinyProtoWaker()
+        try:
+            waker.wake()
+            waker.wake()
+            self.assertEqual(waker._writer.send(b''), 0)
+            self.assertEqual(len(waker._reader.recv(16)), 1)
+            waker.drain()
+            waker.wake()
+            waker.drain()
+            with self.assertRaises(BlockingIOError):
+                waker._reader.recv(16)
+        finally:
+            waker.close()
+        # waking closed waker is harmless
+        waker.wake()
+
+
+class TestConnectionWakeup(unittest.TestCase):
+    def start_pair(self, handler, use_reactor=None):
+        local_socket, remote_socket = socket.socketpair()
+        local_connection = handler(local_socket)
+        if use_reactor is not None:
+            local_connection.use_reactor(use_reactor)
+        remote_connection = TinyProtoConnection(remote_socket)
+        local_connection.start()
+        remote_connection.start()
+        self.assertTrue(local_connection.wait_ready(2))
+        self.addCleanup(setattr, remote_connection, 'shutdown', True)
+        return local_connection, remote_connection
+
+    def test_idle_connection_loop_waits_until_woken(self):
+        "idle connection loop should not spin, and should run loop_pass as soon as it is woken"
+        connection, remote = self.start_pair(PassCounter)
+        self.assertTrue(wait_for(lambda: connection.passes > 0, 2))
+        passes = connection.passes
+        time.sleep(0.2)
+        self.assertEqual(connection.passes, passes)
+
+        connection.woken.clear()
+        connection.wake()
+        self.assertTrue(connection.woken.wait(0.5))
+        self.assertEqual(connection.passes, passes + 1)
+
+        connection.shutdown = True
+        self.assertTrue(wait_for(lambda: not connection.is_alive(), 1))
+
+    def test_loop_interval_keeps_calling_loop_pass(self):
+        "connection with loop_interval should run loop_pass periodically while idle"
+        connection, remote = self.start_pair(IntervalCounter)
+        self.assertTrue(wait_for(lambda: connection.passes >= 5, 2))
+        connection.shutdown = True
+
+    def test_reactor_connection_is_woken_through_reactor(self):
+        "waking connection owned by a reactor should run its loop_pass, and shutdown should close it right away"
+        reactor = TinyProtoReactor()
+        reactor.start()
+        self.addCleanup(reactor.join, 1)
+        self.addCleanup(setattr, reactor, 'shutdown', True)
+        connection, remote = self.start_pair(PassCounter, reactor)
+        self.assertTrue(wait_for(lambda: connection.passes > 0, 2))
+        connection.woken.clear()
+        connection.wake()
+        self.assertTrue(connection.woken.wait(0.5))
+
+        connection.shutdown = True
+        self.assertTrue(wait_for(lambda: not connection.is_alive(), 1))
+
+
+class TestServerAndClientWakeup(unittest.TestCase):
+    def test_server_reaps_closed_connection_and_stops_without_polling(self):
+        "server should reap closed connection as soon as it terminates, and stop right after shutdown is set"
+        details = TinyProtoConnectionDetails('127.0.0.1', free_port())
+        server = TinyProtoServer([details])
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        try:
+            self.assertTrue(wait_for(lambda: len(server.listen_socks) > 0))
+            sock = socket.create_connection(details.socket_connect_details, timeout=5)
+            connection = TinyProtoConnection(sock)
+            connection._initialise_connection()
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 1))
+            server_connection = tuple(server.active_connections.values())[0]
+            server_connection.shutdown = True
+            self.assertTrue(wait_for(lambda: len(server.active_connections) == 0, 1))
+            sock.close()
+        finally:
+            server.shutdown = True
+            server_thread.join(1)
+        self.assertFalse(server_thread.is_alive())
+
+    def test_client_loop_waits_until_woken(self):
+        "client loop should run loop_pass when woken, and stop right after shutdown is set"
+        client = ClientPassCounter()
+        client_thread = threading.Thread(target=client.start)
+        client_thread.start()
+        try:
+            self.assertTrue(client.woken.wait(1))
+            time.sleep(0.1)
+            passes = client.passes
+            client.woken.clear()
+            client.wake()
+            self.assertTrue(client.woken.wait(0.5))
+            self.assertEqual(client.passes, passes + 1)
+        finally:
+            client.shutdown = True
+            client_thread.join(1)
+        self.assertFalse(client_thread.is_alive())
@@ -15,8 +15,16 @@
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 #
 from .errors import TinyProtoError
-from .plugins import TinyProtoPlugin
+from .plugins import TinyProtoPlugin, TinyProtoStreamPlugin, CompressionPlugin
+from .socket_options import TinyProtoSocketOptions
 from .connection_details import TinyProtoConnectionDetails
+from .metrics import TinyProtoHistogram, TinyProtoMetrics, format_prometheus, start_metrics_server
+from .channel import TinyProtoChannel
 from .connection import TinyProtoConnection
+from .reactor import TinyProtoReactor
+from .pool import TinyProtoConnectionPool
 from .server import TinyProtoServer
 from .client import TinyProtoClient
+from .async_connection import AsyncTinyProtoConnection
+from .async_server import AsyncTinyProtoServer
+from .async_client import AsyncTinyProtoClient
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+import asyncio
+import typing
+from uuid import uuid4 as uuid
+from uuid import UUID
+
+from .plugins import TinyProtoPlugin
+from .connection_details import TinyProtoConnectionDetails
+from .async_connection import AsyncTinyProtoConnection
+
+
+class AsyncTinyProtoClient:
+    __slots__ = ('_shutdown', '_shutdown_event', 'active_connections', 'connection_handler', 'connection_plugin_list', 'socket_timeout')
+
+    def __init__(
+        self,
+        connection_handler: AsyncTinyProtoConnection = AsyncTinyProtoConnection,
+        connection_plugin_list: typing.List[TinyProtoPlugin] = [],
+        timeout: int = 5
+    ):
+        self._shutdown = False
+        self._shutdown_event: typing.Optional[asyncio.Event] = None
+        self.active_connections: typing.Dict[UUID, AsyncTinyProtoConnection] = {}
+
+        self.set_conn_handler(connection_handler)
+
+        self.connection_plugin_list: typing.List[TinyProtoPlugin] = []
+        for connection_plugin in connection_plugin_list:
+            self.register_connection_plugin(connection_plugin)
+        self.socket_timeout: int = timeout
+
+    @property
+    def shutdown(self) -> bool:
+        return self._shutdown
+    @shutdown.setter
+    def shutdown(self, newval: bool):
+        self._shutdown = newval
+        if newval and self._shutdown_event is not None:
+            self._shutdown_event.set()
+
+    def set_conn_handler(self, handler: AsyncTinyProtoConnection):
+        if not issubclass(handler, AsyncTinyProtoConnection):
+            raise ValueError('Connection handler must be a subclass of AsyncTinyProtoConnection')
+        self.connection_handler: AsyncTinyProtoConnection = handler
+
+    async def _shutdown_active_cons(self):
+        conn_uids = tuple(self.active_connections.keys())
+        for cuid in conn_uids:
+            conn_o = self.active_connections.pop(cuid)
+            conn_o.shutdown = True
+            await conn_o.wait_closed()
+
+    def register_connection_plugin(self, plugin):
+        try:
+            if issubclass(plugin, TinyProtoPlugin):
+                self.connection_plugin_list.append(plugin())
+            else:
+                raise ValueError('Not a subclass of TinyProtoPlugin')
+        except TypeError as e:
+            if isinstance(plugin, TinyProtoPlugin):
+                self.connection_plugin_list.append(plugin)
+            else:
+                raise ValueError('Not a subclass of TinyProtoPlugin')
+
+    async def connect_to(self, connection_details: TinyProtoConnectionDetails) -> UUID:
+        'Opens the connection and returns its id once the handshake is complete'
+        connection_id = uuid()
+        connection_object = self.connection_handler(
+            remote_details = connection_details,
+            connection_plugin_list = self.connection_plugin_list
+        )
+
+        await asyncio.wait_for(connection_object.start(), self.socket_timeout)
+        self.active_connections[connection_id] = connection_object
+        return connection_id
+
+
+    async def start(self):
+        'Runs until shutdown flag is raised'
+        self._shutdown_event = asyncio.Event()
+        if self._shutdown:
+            self._shutdown_event.set()
+        await self.pre_loop()
+        await self._shutdown_event.wait()
+        await self.post_loop()
+        await self._shutdown_active_cons()
+
+
+    async def pre_loop(self):
+        pass
+    async def post_loop(self):
+        pass
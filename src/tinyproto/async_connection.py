@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+import asyncio
+import typing
+import logging
+
+from .errors import TinyProtoError
+from .plugins import TinyProtoPlugin
+from .connection_details import TinyProtoConnectionDetails
+from .connection import SC_OK, SC_GENERIC_ERROR, MSG_MAX_SIZE, CTRL_CAPS
+
+log = logging.getLogger(__name__)
+
+
+class AsyncTinyProtoConnection:
+    '''asyncio counterpart of TinyProtoConnection.
+
+    Speaks exactly the same wire protocol, so either end of a connection
+    can be threaded or asyncio based. All hooks are coroutines.
+    '''
+    __slots__ = (
+        '_shutdown',
+        '_shutdown_event',
+        'reader',
+        'writer',
+        'is_socket_up',
+        'remote_details',
+        'plugin_list',
+        'connection_lock',
+        'peername_details',
+        '_ack_waiter',
+        '_loop_reading',
+        '_connection_loop_task'
+    )
+
+    def __init__(
+        self,
+        reader: typing.Optional[asyncio.StreamReader] = None,
+        writer: typing.Optional[asyncio.StreamWriter] = None,
+        remote_details: typing.Optional[TinyProtoConnectionDetails] = None,
+        connection_plugin_list: typing.List[TinyProtoPlugin] = []
+    ):
+        self._shutdown: bool = False
+        self._shutdown_event = asyncio.Event()
+        self.connection_lock = asyncio.Lock()
+        self.peername_details = None
+
+        self.reader: typing.Optional[asyncio.StreamReader] = reader
+        self.writer: typing.Optional[asyncio.StreamWriter] = writer
+        self.is_socket_up = reader is not None and writer is not None
+
+        self.remote_details: typing.Optional[TinyProtoConnectionDetails] = remote_details
+
+        self.plugin_list = []
+        for connection_plugin in connection_plugin_list:
+            self.register_plugin(connection_plugin)
+
+        # while connection loop is running, it is the only reader of the stream,
+        # so transmit waits for the ack to be handed over through this future
+        self._ack_waiter: typing.Optional[asyncio.Future] = None
+        # set only while connection loop reads the stream, so pre_loop and post_loop read acks on their own
+        self._loop_reading: bool = False
+        self._connection_loop_task: typing.Optional[asyncio.Task] = None
+
+    @property
+    def shutdown(self) -> bool:
+        return self._shutdown
+    @shutdown.setter
+    def shutdown(self, newval: bool):
+        self._shutdown = newval
+        if newval:
+            self._shutdown_event.set()
+
+    def _ba_to_s(self, size_ba):
+        'Always 4 byte size!!!'
+        return int.from_bytes(size_ba[:4], 'big')
+
+    def _s_to_ba(self, s):
+        'Always 4 byte size!!!'
+        if type(s) is not int:
+            raise ValueError('Must be an integer')
+        return bytearray((s & 0xffffffff).to_bytes(4, 'big'))
+
+    def _process_plugins_transmit(self, msg):
+        for p in self.plugin_list:
+            msg = p.msg_transmit(msg)
+        return msg
+
+    def _process_plugins_receive(self, msg):
+        for x in range(len(self.plugin_list)-1, -1, -1):
+            msg =  self.plugin_list[x].msg_receive(msg)
+        return msg
+
+    async def _raw_transmit(self, msg):
+        if type(msg) is int:
+            msg = bytes((msg, ))
+        self.writer.write(msg)
+        await self.writer.drain()
+
+    async def _raw_receive(self, size):
+        try:
+            return bytearray(await self.reader.readexactly(size))
+        except asyncio.IncompleteReadError:
+            # same as with the threaded connection, remote end closing
+            # the stream is the moment to close the connection
+            self.shutdown = True
+            return bytearray(4)
+
+    async def _receive_header(self, first_byte=None):
+        if first_byte is None:
+            return await self._raw_receive(4)
+        rest = await self._raw_receive(3)
+        if self.shutdown:
+            return bytearray(4)
+        return first_byte + rest
+
+    async def _receive(self, size_ba=None):
+        # first get a 4 byte size of a transmission
+        if size_ba is None:
+            size_ba = await self._raw_receive(4)
+        recv_count = self._ba_to_s(size_ba)
+        if recv_count >> 24 == CTRL_CAPS:
+            # capability offer from a threaded connection, none of them
+            # is supported here, so the classic protocol stays in use
+            await self._raw_transmit(self._s_to_ba(CTRL_CAPS << 24))
+            return None
+        if recv_count > MSG_MAX_SIZE:
+            await self._raw_transmit(SC_GENERIC_ERROR)
+            raise TinyProtoError(f'Remote end trying to send message of size {recv_count} which is bigger then supported max size of {MSG_MAX_SIZE}')
+        elif recv_count == 0 and self.shutdown:
+            # this will happen if the connection is dropped on the other side
+            raise TinyProtoError(f'Received zero bytes from remote end. Most probably remote end dropped connection.')
+        await self._raw_transmit(SC_OK)
+        msg_a = await self._raw_receive(recv_count)
+        # as the last step, push message through all plugins
+        return self._process_plugins_receive(msg_a)
+
+    async def _transmit(self, msg):
+        async with self.connection_lock:
+            # before we can even begin calculating anything, we have to process all plugins
+            # because the size might change in the process
+            msg = self._process_plugins_transmit(msg)
+            if self._loop_reading:
+                self._ack_waiter = asyncio.get_event_loop().create_future()
+                try:
+                    await self._raw_transmit(self._s_to_ba(len(msg)))
+                    tx_status = await self._ack_waiter
+                finally:
+                    self._ack_waiter = None
+            else:
+                await self._raw_transmit(self._s_to_ba(len(msg)))
+                tx_status = await self._raw_receive(1)
+            if tx_status[0] != SC_OK:
+                raise TinyProtoError('Transmission rejected: {0}'.format(tx_status))
+            await self._raw_transmit(msg)
+
+    async def receive(self):
+        try:
+            msg_a = None
+            while msg_a is None:
+                msg_a = await self._receive()
+            return msg_a
+        except OSError as e:
+            self.shutdown = True
+            log.error('Shutting down connection on receive due to error {}'.format(e))
+            return bytearray()
+
+    async def transmit(self, msg):
+        try:
+            await self._transmit(msg)
+        except OSError as e:
+            log.error('Shutting down connection on transmit due to error {}'.format(e))
+            self.shutdown = True
+
+    async def _initialise_connection(self):
+        if not self.is_socket_up and self.remote_details is not None:
+            if self.remote_details.is_unix:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.remote_details.socket_connect_details)
+            else:
+                host, port = self.remote_details.socket_connect_details[:2]
+                self.reader, self.writer = await asyncio.open_connection(host, port)
+            self.is_socket_up = True
+        await self._raw_transmit(SC_OK)
+        res = await self._raw_receive(1)
+        if res[0] != SC_OK:
+            raise TinyProtoError('Initialisation error: {0}'.format(res))
+        self.peername_details = self.writer.get_extra_info('peername')
+
+    async def _next_byte(self):
+        'Waits for the next byte on the stream, or returns None if shutdown was requested first'
+        read_task = asyncio.ensure_future(self._raw_receive(1))
+        shutdown_task = asyncio.ensure_future(self._shutdown_event.wait())
+        done, pending = await asyncio.wait((read_task, shutdown_task), return_when=asyncio.FIRST_COMPLETED)
+        for t in pending:
+            t.cancel()
+        if len(pending) > 0:
+            # cancelled read has to let go of the stream before anything else reads it
+            await asyncio.wait(pending)
+        if read_task not in done:
+            return None
+        return read_task.result()
+
+    async def _run_handler(self, msg_a):
+        '''Runs transmission_received, answering acks of messages it transmits in the meantime.
+
+        Returns the first byte of the next frame, if it arrived before the handler
+        was done, as that frame waits for the handler.'''
+        handler_task = asyncio.ensure_future(self.transmission_received(msg_a))
+        while True:
+            read_task = asyncio.ensure_future(self._raw_receive(1))
+            done, pending = await asyncio.wait((handler_task, read_task), return_when=asyncio.FIRST_COMPLETED)
+            if read_task not in done:
+                # nothing was taken from the stream yet, so it is safe to cancel the read
+                read_task.cancel()
+                await asyncio.wait((read_task, ))
+                handler_task.result()
+                return None
+            next_byte = read_task.result()
+            if not self.shutdown and self._ack_waiter is not None and not self._ack_waiter.done():
+                # remote end answers transmission of the handler
+                self._ack_waiter.set_result(next_byte)
+                continue
+            await handler_task
+            return None if self.shutdown else next_byte
+
+    async def _connection_loop(self):
+        async with self.connection_lock:
+            # transmissions which read their acks on their own are done by now
+            self._loop_reading = True
+        first_byte = None
+        while not self.shutdown:
+            if first_byte is None:
+                first_byte = await self._next_byte()
+                if first_byte is None or self.shutdown:
+                    break
+            if self._ack_waiter is not None and not self._ack_waiter.done():
+                # remote end answers our own transmission
+                self._ack_waiter.set_result(first_byte)
+                first_byte = None
+                continue
+            try:
+                size_ba = await self._receive_header(first_byte)
+                msg_a = await self._receive(size_ba)
+            except OSError as e:
+                self.shutdown = True
+                log.error('Shutting down connection on receive due to error {}'.format(e))
+                break
+            first_byte = None
+            if msg_a is not None:
+                # handler runs in its own task, so it can transmit and have its acks read here
+                first_byte = await self._run_handler(msg_a)
+
+    def _stop_reading(self):
+        self._loop_reading = False
+        if self._ack_waiter is not None and not self._ack_waiter.done():
+            self._ack_waiter.set_exception(ConnectionResetError('Connection closed while waiting for transmission status'))
+
+    async def _cleanup_connection(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, AttributeError):
+                pass
+
+    def register_plugin(self, plugin):
+        try:
+            if issubclass(plugin, TinyProtoPlugin):
+                self.plugin_list.append(plugin())
+            else:
+                raise ValueError('Not a subclass of TinyProtoPlugin')
+        except TypeError as e:
+            if isinstance(plugin, TinyProtoPlugin):
+                self.plugin_list.append(plugin)
+            else:
+                raise ValueError('Not a subclass of TinyProtoPlugin')
+
+    async def _connection_task_runner(self):
+        try:
+            try:
+                await self.pre_loop()
+                await self._connection_loop()
+            finally:
+                self._stop_reading()
+            await self.post_loop()
+        finally:
+            await self._cleanup_connection()
+
+    def is_alive(self) -> bool:
+        return self._connection_loop_task is not None and not self._connection_loop_task.done()
+
+    async def start(self):
+        'Completes the handshake and schedules the connection loop as a separate task'
+        await self._initialise_connection()
+        self._connection_loop_task = asyncio.ensure_future(self._connection_task_runner())
+
+    async def wait_closed(self):
+        if self._connection_loop_task is not None:
+            await asyncio.wait((self._connection_loop_task, ))
+
+    async def pre_loop(self):
+        pass
+    async def post_loop(self):
+        pass
+    async def transmission_received(self, msg):
+        pass
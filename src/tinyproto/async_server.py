@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+import asyncio
+import os
+import socket
+import typing
+from uuid import uuid4 as uuid
+from uuid import UUID
+
+from .errors import TinyProtoError
+from .plugins import TinyProtoPlugin
+from .connection_details import TinyProtoConnectionDetails, remove_stale_unix_socket
+from .connection import SC_CONLIMIT
+from .async_connection import AsyncTinyProtoConnection
+
+
+class AsyncTinyProtoServer:
+    __slots__ = ('_shutdown', '_shutdown_event', 'listen_addrs', 'listen_servers', 'active_connections', 'connection_handler', 'connection_limit', 'connection_plugin_list')
+
+    def __init__(
+        self,
+        listen_addresses: typing.List[TinyProtoConnectionDetails],
+        connection_handler: AsyncTinyProtoConnection = AsyncTinyProtoConnection,
+        connection_limit: typing.Optional[int] = None,
+        connection_plugin_list: typing.List[TinyProtoPlugin] = [],
+    ):
+        'Whenever this flag is raised to true, server will stop serving, and shutdown will be initiated'
+        self._shutdown = False
+        self._shutdown_event: typing.Optional[asyncio.Event] = None
+        'The list of connection details on which to listen to for connections'
+        self.listen_addrs: typing.List[TinyProtoConnectionDetails] = listen_addresses
+        'The list used to store asyncio servers currently in use'
+        self.listen_servers: typing.List[asyncio.AbstractServer] = []
+        'The dictionary used to store connection objects based on AsyncTinyProtoConnection class by their UUID'
+        self.active_connections: typing.Dict[UUID, AsyncTinyProtoConnection] = {}
+
+        self.set_conn_handler(connection_handler)
+
+        self.connection_limit: typing.Optional[int] = connection_limit
+
+        self.connection_plugin_list: typing.List[TinyProtoPlugin] = []
+        for connection_plugin in connection_plugin_list:
+            self.register_connection_plugin(connection_plugin)
+
+    @property
+    def shutdown(self) -> bool:
+        return self._shutdown
+    @shutdown.setter
+    def shutdown(self, newval: bool):
+        self._shutdown = newval
+        if newval and self._shutdown_event is not None:
+            self._shutdown_event.set()
+
+    async def _activate_l(self, connection_details: TinyProtoConnectionDetails):
+        if connection_details.is_unix:
+            remove_stale_unix_socket(connection_details.socket_connect_details)
+            listen_server = await asyncio.start_unix_server(self._initialise_connection, connection_details.socket_connect_details)
+        else:
+            host, port = connection_details.socket_connect_details[:2]
+            listen_server = await asyncio.start_server(self._initialise_connection, host, port, reuse_address=True)
+        self.listen_servers.append(listen_server)
+
+    async def _activate_listeners(self):
+        if len(self.listen_servers) != 0:
+            raise TinyProtoError('There are already active listeners')
+        if len(self.listen_addrs) == 0:
+            raise TinyProtoError('No addresses defined for listening')
+        for connection_details in self.listen_addrs:
+            await self._activate_l(connection_details)
+
+    def _is_limit_exceeded(self):
+        if self.connection_limit == None:
+            return False
+        if len(self.active_connections) >= self.connection_limit:
+            return True
+        return False
+
+    async def _respond_with_limit_exceeded_code(self, writer: asyncio.StreamWriter):
+        writer.write(bytes((SC_CONLIMIT, )))
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _initialise_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self._is_limit_exceeded():
+            await self._respond_with_limit_exceeded_code(writer)
+            return
+
+        connection_id = uuid()
+        connection_object = self.connection_handler(
+            reader=reader,
+            writer=writer,
+            connection_plugin_list=self.connection_plugin_list,
+        )
+
+        await self.conn_init(connection_id, connection_object)
+
+        self.active_connections[connection_id] = connection_object
+        try:
+            await connection_object.start()
+            await connection_object.wait_closed()
+        finally:
+            self.active_connections.pop(connection_id, None)
+            await self.conn_shutdown(connection_id, connection_object)
+
+    async def _shutdown_active_cons(self):
+        conn_uids = tuple(self.active_connections.keys())
+        for cuid in conn_uids:
+            conn_o = self.active_connections.get(cuid)
+            if conn_o is not None:
+                conn_o.shutdown = True
+                await conn_o.wait_closed()
+
+    async def _close_listeners(self):
+        for x in range(len(self.listen_servers)):
+            ls = self.listen_servers.pop(0)
+            paths = [sock.getsockname() for sock in ls.sockets or () if sock.family == getattr(socket, 'AF_UNIX', None)]
+            ls.close()
+            await ls.wait_closed()
+            for path in paths:
+                # abstract addresses are returned as bytes, and need no cleanup
+                if isinstance(path, str) and len(path) > 0:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+
+    def set_conn_handler(self, handler: AsyncTinyProtoConnection):
+        if not issubclass(handler, AsyncTinyProtoConnection):
+            raise ValueError('Connection handler must be a subclass of AsyncTinyProtoConnection')
+        self.connection_handler = handler
+
+    def register_connection_plugin(self, plugin: TinyProtoPlugin):
+        try:
+            if issubclass(plugin, TinyProtoPlugin):
+                self.connection_plugin_list.append(plugin())
+            else:
+                raise ValueError('Not a subclass of TinyProtoPlugin')
+        except TypeError as e:
+            if isinstance(plugin, TinyProtoPlugin):
+                self.connection_plugin_list.append(plugin)
+            else:
+                raise ValueError('Not a subclass of TinyProtoPlugin')
+
+    async def start(self):
+        'Serves connections until shutdown flag is raised'
+        self._shutdown_event = asyncio.Event()
+        if self._shutdown:
+            self._shutdown_event.set()
+        await self._activate_listeners()
+        await self.pre_loop()
+        await self._shutdown_event.wait()
+        await self.post_loop()
+        await self._close_listeners()
+        await self._shutdown_active_cons()
+
+
+    async def pre_loop(self):
+        pass
+    async def post_loop(self):
+        pass
+    async def conn_init(self, conn_id: UUID, conn_o: AsyncTinyProtoConnection):
+        pass
+    async def conn_shutdown(self, conn_id: UUID, conn_o: AsyncTinyProtoConnection):
+        pass
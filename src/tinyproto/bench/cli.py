@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+import sys
+import json
+import typing
+import argparse
+
+from .runner import run_benchmark, PLUGIN_CHAINS, TRANSPORTS
+
+
+def _int_list(value):
+    try:
+        return [int(v) for v in value.split(',') if v]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected comma separated integers, got {}'.format(value))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='tinyproto-bench',
+        description='Starts a tinyproto server on loopback, drives it with client connections and reports results as JSON.'
+    )
+    parser.add_argument('-c', '--clients', type=int, default=4, help='number of client connections (default: %(default)s)')
+    parser.add_argument('-s', '--sizes', type=_int_list, default=[64, 1024, 65536], help='comma separated message sizes in bytes (default: 64,1024,65536)')
+    parser.add_argument(
+        '-p', '--plugins', default='none',
+        help='comma separated plugin chains, plugins within a chain joined with + ( known plugins: {} ) (default: %(default)s)'.format(', '.join(sorted(PLUGIN_CHAINS)))
+    )
+    parser.add_argument('-d', '--duration', type=float, default=1.0, help='seconds spent on every size and chain (default: %(default)s)')
+    parser.add_argument('-r', '--reactor-threads', type=int, default=0, help='reactor threads of the server, 0 for a thread per connection (default: %(default)s)')
+    parser.add_argument(
+        '-t', '--transports', default='tcp',
+        help='comma separated transports to compare ( known transports: {} ) (default: %(default)s)'.format(', '.join(TRANSPORTS))
+    )
+    parser.add_argument('--pipelined', action='store_true', help='negotiate pipelined framing')
+    parser.add_argument('-o', '--output', help='file to write JSON results into, instead of standard output')
+    return parser
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        results = run_benchmark(
+            sizes=args.sizes,
+            chains=[c for c in args.plugins.split(',') if c],
+            clients=args.clients,
+            duration=args.duration,
+            reactor_threads=args.reactor_threads,
+            negotiate_capabilities=args.pipelined,
+            transports=[t for t in args.transports.split(',') if t]
+        )
+    except ValueError as e:
+        print('tinyproto-bench: {}'.format(e), file=sys.stderr)
+        return 2
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
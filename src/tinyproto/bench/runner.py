@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import sys
+import time
+import queue
+import typing
+import platform
+import socket
+import tempfile
+import threading
+
+from ..errors import TinyProtoError
+from ..plugins import TinyProtoPlugin, CompressionPlugin
+from ..connection_details import TinyProtoConnectionDetails
+from ..connection import TinyProtoConnection
+from ..metrics import TinyProtoHistogram
+from ..server import TinyProtoServer
+from ..client import TinyProtoClient
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+'Plugin chains which can be named in a sweep, joined with + to chain them'
+PLUGIN_CHAINS: typing.Dict[str, typing.Callable[[], TinyProtoPlugin]] = {
+    'zlib': lambda: CompressionPlugin('zlib'),
+    'lzma': lambda: CompressionPlugin('lzma'),
+}
+
+'Transports a sweep can compare, loopback TCP and unix domain sockets'
+TRANSPORTS = ('tcp', 'unix')
+
+LATENCY_QUANTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+
+class BenchEcho(TinyProtoConnection):
+    'Server end of the benchmark, sends every message straight back'
+    def transmission_received(self, msg):
+        self.transmit(msg)
+
+
+class BenchConnection(TinyProtoConnection):
+    'Client end of the benchmark, hands echoed messages over to the thread waiting for them'
+    __slots__ = ('echoes', )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.echoes = queue.Queue()
+
+    def transmission_received(self, msg):
+        self.echoes.put(len(msg))
+
+
+def plugin_chain(name: str) -> typing.List[TinyProtoPlugin]:
+    'Builds the list of plugins for a chain name, like none, zlib or zlib+lzma'
+    if name == 'none':
+        return []
+    try:
+        return [PLUGIN_CHAINS[part]() for part in name.split('+')]
+    except KeyError as e:
+        raise ValueError('Unknown plugin {}, known ones are {}'.format(e.args[0], ', '.join(sorted(PLUGIN_CHAINS))))
+
+
+def sample_message(size: int) -> bytes:
+    'Half random, half repeated bytes, so compression has some, but not all of the work to do'
+    random_part = os.urandom(size // 2)
+    return random_part + bytes(size - len(random_part))
+
+
+def rss_bytes() -> typing.Optional[int]:
+    'Returns resident set size of this process, or its peak where the current one is not available'
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in kilobytes everywhere but macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _free_port() -> int:
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+    finally:
+        probe.close()
+
+
+class _BenchServer:
+    'Runs TinyProtoServer on a free loopback port, or a unix domain socket, within a thread'
+    __slots__ = ('server', 'thread', 'details', '_directory')
+
+    def __init__(self, plugins: typing.List[TinyProtoPlugin], reactor_threads: int = 0, transport: str = 'tcp'):
+        self._directory = None
+        if transport == 'tcp':
+            self.details = TinyProtoConnectionDetails('127.0.0.1', _free_port())
+        elif transport == 'unix':
+            self._directory = tempfile.TemporaryDirectory(prefix='tinyproto-bench-')
+            self.details = TinyProtoConnectionDetails.unix(os.path.join(self._directory.name, 'bench.sock'))
+        else:
+            raise ValueError('Unknown transport {}, known ones are {}'.format(transport, ', '.join(TRANSPORTS)))
+        self.server = TinyProtoServer(
+            [self.details],
+            connection_handler=BenchEcho,
+            connection_plugin_list=plugins,
+            reactor_threads=reactor_threads
+        )
+        self.thread = threading.Thread(target=self.server.start, daemon=True)
+
+    def start(self, timeout: float = 5):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while len(self.server.listen_socks) == 0:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise TinyProtoError('Benchmark server did not start listening')
+            time.sleep(0.01)
+
+    def stop(self):
+        self.server.shutdown = True
+        self.thread.join()
+        if self._directory is not None:
+            self._directory.cleanup()
+
+
+def _drive(connection, msg, deadline, histogram, lock, counters, errors):
+    sent = 0
+    local = TinyProtoHistogram(histogram.significant_bits)
+    try:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            connection.transmit(msg)
+            connection.echoes.get(timeout=10)
+            local.record(int((time.perf_counter() - start) * 1e9))
+            sent += 1
+    except Exception as e:
+        errors.append(repr(e))
+    with lock:
+        histogram.merge(local)
+        counters[0] += sent
+
+
+def run_case(
+    details: TinyProtoConnectionDetails,
+    size: int,
+    plugins: typing.List[TinyProtoPlugin],
+    clients: int = 4,
+    duration: float = 1.0,
+    negotiate_capabilities: bool = False
+) -> dict:
+    '''Drives a running server with a number of client connections for the given duration.
+
+    Every client transmits a message and waits for its echo before sending
+    the next one, so latency is a full round trip.'''
+    client = TinyProtoClient(
+        connection_handler=BenchConnection,
+        connection_plugin_list=plugins,
+        negotiate_capabilities=negotiate_capabilities
+    )
+    connections = []
+    try:
+        for x in range(clients):
+            connection = client.active_connections[client.connect_to(details)]
+            if not connection.wait_ready(5):
+                raise TinyProtoError('Benchmark connection was not established')
+            connections.append(connection)
+
+        msg = sample_message(size)
+        histogram = TinyProtoHistogram()
+        lock = threading.Lock()
+        counters = [0]
+        errors = []
+        deadline = time.monotonic() + duration
+        start = time.perf_counter()
+        threads = [threading.Thread(target=_drive, args=(c, msg, deadline, histogram, lock, counters, errors)) for c in connections]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        for connection in connections:
+            connection.shutdown = True
+    if errors:
+        raise TinyProtoError('Benchmark client failed: {}'.format(errors[0]))
+
+    messages = counters[0]
+    res = {
+        'size': size,
+        'clients': clients,
+        'messages': messages,
+        'seconds': elapsed,
+        'msgs_per_s': messages / elapsed,
+        'mb_per_s': messages * size / elapsed / 1e6,
+        'latency_seconds': {name: histogram.quantile(q) / 1e9 for name, q in LATENCY_QUANTILES},
+        'rss_bytes': rss_bytes()
+    }
+    return res
+
+
+def run_benchmark(
+    sizes: typing.Iterable[int] = (64, 1024, 65536),
+    chains: typing.Iterable[str] = ('none', ),
+    clients: int = 4,
+    duration: float = 1.0,
+    reactor_threads: int = 0,
+    negotiate_capabilities: bool = False,
+    transports: typing.Iterable[str] = ('tcp', )
+) -> dict:
+    '''Runs every combination of transport, plugin chain and message size against a server on loopback.
+
+    A separate server is started for every transport and plugin chain, as plugins
+    have to match on both ends. Returns a plain dict, ready to be dumped as JSON.'''
+    results = []
+    for transport in transports:
+        for chain in chains:
+            bench_server = _BenchServer(plugin_chain(chain), reactor_threads, transport)
+            bench_server.start()
+            try:
+                for size in sizes:
+                    case = run_case(bench_server.details, size, plugin_chain(chain), clients, duration, negotiate_capabilities)
+                    case['transport'] = transport
+                    case['plugins'] = chain
+                    results.append(case)
+            finally:
+                bench_server.stop()
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'clients': clients,
+            'duration': duration,
+            'reactor_threads': reactor_threads,
+            'negotiate_capabilities': negotiate_capabilities
+        },
+        'results': results
+    }
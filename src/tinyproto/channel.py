@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+from collections import deque
+import queue
+import typing
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TinyProtoChannel:
+    '''Logical channel multiplexed with other channels over a single TinyProtoConnection.
+
+    Messages are split into frames of limited size, and frames of all
+    channels with pending messages are sent in turns, so a large message
+    on one channel does not hold back small messages on the others.
+    Channels with the same id on both ends are connected with each other.'''
+    __slots__ = (
+        'channel_id',
+        'connection',
+        'is_open',
+        '_inbox',
+        '_outbox',
+        '_fragments',
+        '_fragments_dropped'
+    )
+
+    def __init__(self, connection, channel_id: int):
+        self.channel_id: int = channel_id
+        self.connection = connection
+        self.is_open: bool = True
+        self._inbox: queue.Queue = queue.Queue()
+        # messages waiting to be sent, each as [view, offset, sent]
+        self._outbox: deque = deque()
+        # received part of a message which is not yet complete
+        self._fragments: typing.Optional[bytearray] = None
+        self._fragments_dropped: bool = False
+
+    def transmit(self, msg):
+        'Returns once the last frame of the message is sent'
+        self.connection._channel_transmit(self, msg)
+
+    def receive(self, timeout: typing.Optional[float] = None):
+        'Returns next message of this channel, or None if none arrived within timeout or the connection was closed'
+        return self.connection._channel_receive(self, timeout)
+
+    def close(self):
+        'Forgets the channel on this end, frames arriving later open it anew'
+        self.connection._close_channel(self)
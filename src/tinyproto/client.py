@@ -14,26 +14,48 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 #
+from contextlib import contextmanager
+from threading import Event
 import socket
 import typing
 from uuid import uuid4 as uuid
 from uuid import UUID
-from time import sleep
 
+from .errors import TinyProtoError
 from .plugins import TinyProtoPlugin
 from .connection_details import TinyProtoConnectionDetails
-from .connection import TinyProtoConnection
+from .socket_options import TinyProtoSocketOptions, DEFAULT_SOCKET_OPTIONS
+from .connection import TinyProtoConnection, SHM_DEFAULT_THRESHOLD
+from .pool import TinyProtoConnectionPool
 
 
 class TinyProtoClient:
-    __slots__ = ('shutdown', 'active_connections', 'connection_handler', 'connection_plugin_list', 'socket_timeout')
+    'When set, loop_pass is called at least every that many seconds, otherwise only when woken up'
+    loop_interval: typing.Optional[float] = None
+
+    __slots__ = (
+        '_shutdown', '_wakeup', 'active_connections', 'connection_handler', 'connection_plugin_list', 'socket_timeout', 'socket_options', 'negotiate_capabilities',
+        'shared_memory_size', 'shared_memory_threshold', 'heartbeat_interval', 'idle_timeout', 'read_timeout',
+        'connection_pools', 'pool_min_size', 'pool_max_size', 'pool_idle_timeout'
+    )
 
     def __init__(
         self,
         connection_handler: TinyProtoConnection = TinyProtoConnection,
         connection_plugin_list: typing.List[TinyProtoPlugin] = [],
-        timeout: int = 5
+        timeout: int = 5,
+        negotiate_capabilities: bool = False,
+        pool_min_size: int = 0,
+        pool_max_size: int = 4,
+        pool_idle_timeout: float = 60.0,
+        socket_options: typing.Optional[TinyProtoSocketOptions] = None,
+        shared_memory_size: int = 0,
+        shared_memory_threshold: int = SHM_DEFAULT_THRESHOLD,
+        heartbeat_interval: typing.Optional[float] = None,
+        idle_timeout: typing.Optional[float] = None,
+        read_timeout: typing.Optional[float] = None
     ):
+        self._wakeup = Event()
         self.shutdown = False
         self.active_connections: typing.Dict[UUID, TinyProtoConnection] = {}
 
@@ -43,6 +65,36 @@ class TinyProtoClient:
         for connection_plugin in connection_plugin_list:
             self.register_connection_plugin(connection_plugin)
         self.socket_timeout: int = timeout
+        'Options set on sockets of new connections, unless their connection details have their own'
+        self.socket_options: TinyProtoSocketOptions = socket_options if socket_options is not None else DEFAULT_SOCKET_OPTIONS
+        'When true, new connections offer pipelined framing to the server, and fall back to the classic protocol if it is not supported'
+        self.negotiate_capabilities: bool = negotiate_capabilities
+        'When above zero, and capabilities are negotiated with a server on the same host, large messages are passed through shared memory of that size'
+        self.shared_memory_size: int = shared_memory_size
+        self.shared_memory_threshold: int = shared_memory_threshold
+        'Heartbeat interval, idle and read timeouts of new connections, see TinyProtoConnection, heartbeats need negotiate_capabilities'
+        self.heartbeat_interval: typing.Optional[float] = heartbeat_interval
+        self.idle_timeout: typing.Optional[float] = idle_timeout
+        self.read_timeout: typing.Optional[float] = read_timeout
+
+        'Pools of connections used by checkout, by host and port'
+        self.connection_pools: typing.Dict[typing.Tuple[str, int], TinyProtoConnectionPool] = {}
+        self.pool_min_size: int = pool_min_size
+        self.pool_max_size: int = pool_max_size
+        self.pool_idle_timeout: float = pool_idle_timeout
+
+    @property
+    def shutdown(self) -> bool:
+        return self._shutdown
+    @shutdown.setter
+    def shutdown(self, newval: bool):
+        self._shutdown = newval
+        if newval:
+            self.wake()
+
+    def wake(self):
+        'Thread safe, makes the client loop run loop_pass right away'
+        self._wakeup.set()
 
     def set_conn_handler(self, handler: TinyProtoConnection):
         if not issubclass(handler, TinyProtoConnection):
@@ -55,11 +107,26 @@ class TinyProtoClient:
             conn_o = self.active_connections.pop(cuid)
             # !!!!this part needs to be rewritten as soon as connection class is completed!!!!!!!
             conn_o.shutdown = True
+        for pool in tuple(self.connection_pools.values()):
+            pool.close()
+
+    def _next_timeout(self) -> typing.Optional[float]:
+        'Returns how long the loop can wait for something to happen, None if there is nothing due'
+        timeout = self.loop_interval
+        for pool in tuple(self.connection_pools.values()):
+            eviction = pool.next_eviction()
+            if eviction is not None and (timeout is None or eviction < timeout):
+                timeout = eviction
+        return timeout
 
     def _client_loop(self):
         while not self.shutdown:
+            # cleared before the pass, so wakes coming during it are not lost
+            self._wakeup.clear()
             self.loop_pass()
-            sleep(0.03)
+            for pool in tuple(self.connection_pools.values()):
+                pool.evict_idle()
+            self._wakeup.wait(self._next_timeout())
 
     def register_connection_plugin(self, plugin):
         try:
@@ -73,22 +140,83 @@ class TinyProtoClient:
             else:
                 raise ValueError('Not a subclass of TinyProtoPlugin')
 
-    def connect_to(self, connection_details: TinyProtoConnectionDetails) -> UUID:
-        socket_object = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def _create_connection(self, connection_details: TinyProtoConnectionDetails) -> TinyProtoConnection:
+        socket_options = connection_details.socket_options
+        if socket_options is None:
+            socket_options = self.socket_options
+        socket_object = socket.socket(connection_details.address_family, connection_details.socket_kind, connection_details.socket_proto)
         socket_object.settimeout(self.socket_timeout)
+        socket_options.apply(socket_object)
 
-        connection_id = uuid()
         connection_object = self.connection_handler(
             socket_object = socket_object,
             socket_already_up = False,
             remote_details = connection_details,
-            connection_plugin_list = self.connection_plugin_list
+            connection_plugin_list = self.connection_plugin_list,
+            negotiate_capabilities = self.negotiate_capabilities,
+            socket_options = socket_options
         )
+        connection_object.shared_memory_size = self.shared_memory_size
+        connection_object.shared_memory_threshold = self.shared_memory_threshold
+        connection_object.heartbeat_interval = self.heartbeat_interval
+        connection_object.idle_timeout = self.idle_timeout
+        connection_object.read_timeout = self.read_timeout
+        return connection_object
+
+    def connect_to(self, connection_details: TinyProtoConnectionDetails) -> UUID:
+        connection_id = uuid()
+        connection_object = self._create_connection(connection_details)
 
         connection_object.start()
         self.active_connections[connection_id] = connection_object
         return connection_id
 
+    def _connect_pooled(self, connection_details: TinyProtoConnectionDetails) -> TinyProtoConnection:
+        connection_object = self._create_connection(connection_details)
+        connection_object.start()
+        if not connection_object.wait_ready(self.socket_timeout):
+            connection_object.shutdown = True
+            raise TinyProtoError(f'Could not establish connection to {connection_details}')
+        return connection_object
+
+    def get_pool(self, connection_details: TinyProtoConnectionDetails) -> TinyProtoConnectionPool:
+        'Returns pool of connections to given host and port, creating it if needed'
+        key = (connection_details.host, connection_details.port)
+        pool = self.connection_pools.get(key)
+        if pool is None:
+            pool = TinyProtoConnectionPool(
+                connection_details,
+                self._connect_pooled,
+                min_size = self.pool_min_size,
+                max_size = self.pool_max_size,
+                idle_timeout = self.pool_idle_timeout
+            )
+            pool = self.connection_pools.setdefault(key, pool)
+            pool.fill()
+        return pool
+
+    def checkout(self, connection_details: TinyProtoConnectionDetails, timeout: typing.Optional[float] = None) -> TinyProtoConnection:
+        '''Returns an established connection from the pool of given host and port.
+
+        Connection has to be given back with checkin once it is no longer used.
+        When all pool_max_size connections are in use, waits up to timeout seconds for one.'''
+        return self.get_pool(connection_details).checkout(timeout)
+
+    def checkin(self, connection_object: TinyProtoConnection):
+        'Gives connection taken with checkout back to its pool'
+        self.get_pool(connection_object.remote_details).checkin(connection_object)
+        # client loop has to pick up the idle timeout of the connection
+        self.wake()
+
+    @contextmanager
+    def pooled(self, connection_details: TinyProtoConnectionDetails, timeout: typing.Optional[float] = None):
+        'Context manager taking a connection from the pool, and giving it back on exit'
+        connection_object = self.checkout(connection_details, timeout)
+        try:
+            yield connection_object
+        finally:
+            self.checkin(connection_object)
+
 
     def start(self):
         self.pre_loop()
@@ -14,18 +14,36 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 #
-from threading import Thread, RLock
+from threading import Thread, RLock, Lock, Event, Condition
+from concurrent.futures import Executor, Future, TimeoutError as FutureTimeoutError
+from collections import deque
+from contextlib import contextmanager
+import asyncio
+import io
+import ipaddress
+import queue
+import os
 import socket
+import time
+import select
 import selectors
+import struct
 import typing
 import logging
 
 from .errors import TinyProtoError
-from .plugins import TinyProtoPlugin
+from .plugins import TinyProtoPlugin, TinyProtoPluginPipeline
 from .connection_details import TinyProtoConnectionDetails
+from .socket_options import TinyProtoSocketOptions
+from .channel import TinyProtoChannel
+from .metrics import TinyProtoMetrics, METRIC_ACK_WAIT, METRIC_RECEIVE, METRIC_PLUGINS, METRIC_HANDLER, METRIC_RTT
+from .wakeup import TinyProtoWaker
+from . import shm
 
 log = logging.getLogger(__name__)
 
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', None)
+
 SC_OK=0xff
 SC_GENERIC_ERROR=0x00
 SC_CONLIMIT=0xfe
@@ -38,17 +56,120 @@ MSG_MAX_SIZE=0xf0ffffff # 4 byte size, never change this value!!!
 # It also sets a reasonably high one time transfer limit of
 # a little over 3854 MB, which no sane person would ever reach
 
+# Sizes above MSG_MAX_SIZE are used as control frames, where the
+# most significant byte carries the kind of the frame and the
+# remaining 3 bytes carry its parameter. Apart from CTRL_CAPS,
+# which starts the negotiation, they are only ever sent once both
+# ends agreed on CAP_PIPELINE
+CTRL_CAPS=0xf1 # capability exchange, parameter holds capability bits
+CTRL_ERROR=0xf2 # asynchronous rejection, parameter holds sequence and status
+CTRL_STREAM_BEGIN=0xf3 # following messages are chunks of a single streamed message
+CTRL_STREAM_END=0xf4 # streamed message is complete
+CTRL_BATCH=0xf5 # parameter holds number of following messages sent as one batch
+CTRL_CHANNEL=0xf6 # following message is a frame of a channel message, parameter holds channel id
+CTRL_RPC=0xf7 # following message is a request or a response, parameter holds correlation id
+CTRL_PING=0xf8 # remote end asks for CTRL_PONG, parameter holds token to be echoed back
+CTRL_PONG=0xf9 # answer to CTRL_PING, parameter holds its token
+CTRL_SHM=0xfa # shared memory operation, parameter holds operation and slot id
+
+CAP_PIPELINE=0x01 # messages are sent without waiting for SC_OK
+CAP_SHM=0x02 # large messages are passed through shared memory, only ever agreed between ends on the same host
+CAP_HEARTBEAT=0x04 # CTRL_PING frames are answered with CTRL_PONG
+TINY_PROTO_CAPABILITIES=CAP_PIPELINE|CAP_SHM|CAP_HEARTBEAT
+
+DISCARD_CHUNK_SIZE=0x10000
+SENDMSG_MAX_BUFFERS=1024 # stays within IOV_MAX of common platforms
+STREAM_CHUNK_SIZE=0x100000
+BATCH_MAX_SIZE=0xffffff
+CHANNEL_ID_MASK=0x7fffff
+CHANNEL_FINAL=0x800000 # set on the last frame of a channel message
+CHANNEL_FRAME_SIZE=0x10000
+RPC_ID_MASK=0x3fffff
+RPC_RESPONSE=0x800000 # set on responses
+RPC_FAILED=0x400000 # response carries error description instead of a result
+SHM_OP_SHIFT=21 # operation is kept in the top 3 bits of CTRL_SHM parameter
+SHM_SLOT_MASK=0x1fffff
+SHM_MESSAGE=0 # following message holds offset and size of a message in a slot of the ring
+SHM_ATTACH=1 # following message holds name of the ring of the sending end
+SHM_ATTACHED=2 # remote end attached to the ring
+SHM_REFUSED=3 # remote end could not attach to the ring, it stays unused
+SHM_RELEASE=4 # remote end is done with the slot
+SHM_DESCRIPTOR=struct.Struct('>QQ')
+SHM_DEFAULT_THRESHOLD=0x10000
+PING_TOKEN_MASK=0xffffff
+# smoothing of round trip time and its deviation, as in RFC 6298
+RTT_GAIN=0.125
+RTT_VARIANCE_GAIN=0.25
+
 
 class TinyProtoConnection:
+    'When set, loop_pass is called at least every that many seconds, otherwise only when something happened'
+    loop_interval: typing.Optional[float] = None
+
     __slots__ = (
-        'shutdown',
+        '_shutdown',
         'socket_o',
         'is_socket_up',
         'remote_details',
+        'socket_options',
         'plugin_list',
         'connection_lock',
+        'transmit_lock',
         'peername_details',
+        'negotiate_capabilities',
+        'capabilities',
+        'max_message_size',
+        'metrics',
+        'shared_memory_size',
+        'shared_memory_threshold',
+        '_shm_out',
+        '_shm_in',
+        '_shm_views',
+        'heartbeat_interval',
+        'idle_timeout',
+        'read_timeout',
+        'rtt',
+        'rtt_variance',
+        '_last_received',
+        '_ping_token',
+        '_ping_sent',
+        '_ping_pending',
+        '_transmit_seq',
+        '_receive_seq',
+        '_reject_status',
+        '_header_buffer',
+        '_stream_active',
+        '_stream_ended',
+        '_stream_buffer',
+        '_stream_pipeline',
+        '_batch_remaining',
+        '_batch_messages',
+        '_received_batch',
+        '_received_backlog',
+        '_channels',
+        '_channel_lock',
+        '_channel_ready',
+        '_prefix_frame',
+        '_outbound',
+        '_requests',
+        '_request_lock',
+        '_next_request_id',
+        '_next_channel_id',
+        '_header_view',
         '_selector',
+        '_waker',
+        '_terminated',
+        '_on_terminated',
+        '_reactor',
+        '_executor',
+        '_dispatch_handler',
+        '_dispatch_limit',
+        '_dispatch_ordered',
+        '_dispatch_queue',
+        '_dispatch_pending',
+        '_dispatch_active',
+        '_dispatch_condition',
+        '_ready',
         '_connection_loop_thread'
     )
 
@@ -57,17 +178,104 @@ class TinyProtoConnection:
         socket_object: socket.socket,
         socket_already_up: bool = True,
         remote_details: typing.Optional[TinyProtoConnectionDetails] = None,
-        connection_plugin_list: typing.List[TinyProtoPlugin] = []
+        connection_plugin_list: typing.List[TinyProtoPlugin] = [],
+        negotiate_capabilities: bool = False,
+        socket_options: typing.Optional[TinyProtoSocketOptions] = None
     ):
-        self.shutdown: bool = False
+        self._shutdown: bool = False
+        'Guards receiving, and with classic framing transmitting as well, as approval of every message is read from the socket'
         self.connection_lock = RLock()
+        'Guards transmitting, always taken after connection_lock when both are needed'
+        self.transmit_lock = RLock()
         self.peername_details = None
-        self._selector = selectors.DefaultSelector()
+        self._selector: typing.Optional[selectors.BaseSelector] = None
+        self._waker: typing.Optional[TinyProtoWaker] = None
+        # set once the connection is closed, right before _on_terminated is called
+        self._terminated: bool = False
+        self._on_terminated: typing.Optional[typing.Callable[[], None]] = None
+        self._reactor = None
+        self._executor: typing.Optional[Executor] = None
+        self._dispatch_handler: typing.Optional[typing.Callable] = None
+        self._dispatch_limit: int = 0
+        self._dispatch_ordered: bool = True
+        # messages waiting for their turn when dispatch is ordered
+        self._dispatch_queue: deque = deque()
+        # messages handed to the connection and not yet handled, queued or running
+        self._dispatch_pending: int = 0
+        self._dispatch_active: bool = False
+        self._dispatch_condition = Condition()
+        # set once the handshake is over, or the connection failed before it
+        self._ready = Event()
+
+        'When true, connecting end offers capabilities of this version to the remote end right after the handshake'
+        self.negotiate_capabilities: bool = negotiate_capabilities
+        'Capabilities agreed by both ends, zero means the classic protocol'
+        self.capabilities: int = 0
+        'Messages above this size are rejected by the receiving end'
+        self.max_message_size: int = MSG_MAX_SIZE
+        'When set to TinyProtoMetrics, the connection records its traffic and latencies into it'
+        self.metrics: typing.Optional[TinyProtoMetrics] = None
+        'When above zero, and both ends are on the same host, messages are passed through shared memory of that size'
+        self.shared_memory_size: int = 0
+        'Messages smaller than that are sent through the socket even when shared memory is in use'
+        self.shared_memory_threshold: int = SHM_DEFAULT_THRESHOLD
+        # ring written by this end, and the one of the remote end, once agreed
+        self._shm_out: typing.Optional[shm.TinyProtoShmRing] = None
+        self._shm_in = None
+        # views of messages handed out straight from the ring of the remote end, with their slots, by id of the view
+        self._shm_views: typing.Dict[int, typing.Tuple[memoryview, int]] = {}
+        'When set, and heartbeats are agreed, CTRL_PING is sent every that many seconds, and remote end silent for as long after it is dropped'
+        self.heartbeat_interval: typing.Optional[float] = None
+        'When set, the connection is closed after that many seconds without receiving anything'
+        self.idle_timeout: typing.Optional[float] = None
+        'When set, the connection is closed once a frame which started arriving makes no progress for that many seconds, sending is not limited by it'
+        self.read_timeout: typing.Optional[float] = None
+        'Smoothed round trip time in seconds, measured with heartbeats, None until the first one is answered'
+        self.rtt: typing.Optional[float] = None
+        'Smoothed mean deviation of the round trip time in seconds'
+        self.rtt_variance: typing.Optional[float] = None
+        # monotonic time of the last bytes received from the remote end
+        self._last_received: float = time.monotonic()
+        # token of the last CTRL_PING and when it was sent, pending until its CTRL_PONG arrives
+        self._ping_token: int = 0
+        self._ping_sent: float = self._last_received
+        self._ping_pending: bool = False
+        self._transmit_seq: int = 0
+        self._receive_seq: int = 0
+        self._reject_status: typing.Optional[int] = None
+        self._stream_active: bool = False
+        self._stream_ended: bool = False
+        self._stream_buffer: typing.Optional[bytearray] = None
+        self._stream_pipeline: typing.Optional[TinyProtoPluginPipeline] = None
+        self._batch_remaining: int = 0
+        self._batch_messages: list = []
+        self._received_batch: typing.Optional[list] = None
+        # messages of a batch not yet handed out by receive
+        self._received_backlog: deque = deque()
+        self._channels: typing.Dict[int, TinyProtoChannel] = {}
+        # guards outboxes of channels, which are filled outside of connection_lock
+        self._channel_lock = Lock()
+        # channels with messages waiting to be sent, in order of their turns
+        self._channel_ready: deque = deque()
+        # last CTRL_CHANNEL or CTRL_RPC frame, until the message frame it announced arrives
+        self._prefix_frame: typing.Optional[int] = None
+        # messages queued by transmit_nowait, with their size headers and futures, until the loop sends them
+        self._outbound: deque = deque()
+        # requests waiting for response, by correlation id, with their deadlines
+        self._requests: typing.Dict[int, typing.Tuple[Future, typing.Optional[float]]] = {}
+        self._request_lock = Lock()
+        self._next_request_id: int = 0
+        # connecting end allocates odd channel ids, accepting end even ones
+        self._next_channel_id: int = 1 if remote_details is not None else 2
+        self._header_buffer = bytearray(4)
+        self._header_view = memoryview(self._header_buffer)
 
         self.socket_o: socket.socket = socket_object
         self.is_socket_up = socket_already_up
 
         self.remote_details: typing.Optional[TinyProtoConnectionDetails] = remote_details
+        'Options for sockets created when connecting to remote end again, already applied to socket_object by its creator'
+        self.socket_options: typing.Optional[TinyProtoSocketOptions] = socket_options
 
         self.plugin_list = []
         for connection_plugin in connection_plugin_list:
@@ -75,19 +283,44 @@ class TinyProtoConnection:
 
         self._connection_loop_thread: Thread = Thread(target=self._connection_thread_runner, daemon=True)
 
+    @classmethod
+    def socketpair(cls, remote_handler: typing.Optional[type] = None, **kwargs) -> typing.Tuple['TinyProtoConnection', 'TinyProtoConnection']:
+        '''Returns two connections joined with each other, for passing messages within a single process.
+
+        Neither of them is started. The first one takes the role of the connecting end,
+        the second one, made of remote_handler if given, the role of the accepting end.
+        Keyword arguments are passed to both of them.'''
+        local_socket, remote_socket = socket.socketpair()
+        local_connection = cls(local_socket, **kwargs)
+        # there are no remote details to tell the roles apart, so the channel ids are set here
+        local_connection._next_channel_id = 1
+        remote_connection = (remote_handler or cls)(remote_socket, **kwargs)
+        return local_connection, remote_connection
+
     def __del__(self):
         self.shutdown = True
 
+    @property
+    def shutdown(self) -> bool:
+        return self._shutdown
+    @shutdown.setter
+    def shutdown(self, newval: bool):
+        self._shutdown = newval
+        if newval:
+            self.wake()
+
+    def wake(self):
+        'Thread safe, makes the connection loop run loop_pass right away, instead of waiting for the next message'
+        if self._reactor is not None:
+            self._reactor.wake(self)
+        elif self._waker is not None:
+            self._waker.wake()
+
     def _ba_to_s(self, size_ba):
         'Always 4 byte size!!!'
         if type(size_ba) is not bytearray:
             raise ValueError('Must be a byte array')
-        s = 0
-        s += (size_ba[0] << 24 )
-        s += (size_ba[1] << 16 )
-        s += (size_ba[2] << 8 )
-        s += size_ba[3]
-        return s
+        return int.from_bytes(size_ba[:4], 'big')
 
     def _s_to_ba(self, s):
         'Always 4 byte size!!!'
@@ -101,82 +334,1190 @@ class TinyProtoConnection:
         return ba
 
     def _prep_for_transmit(self, msg):
+        'Returns a flat byte view of the message, copying it only if it is not contiguous'
         if type(msg) is int:
-            ba = bytearray()
-            ba.append(msg)
-        else:
-            ba = bytearray(msg)
-        return ba
+            return memoryview(bytes((msg, )))
+        view = memoryview(msg)
+        if not view.contiguous:
+            return memoryview(view.tobytes())
+        return view.cast('B')
 
     def _process_plugins_transmit(self, msg):
+        if self.metrics is not None and len(self.plugin_list) > 0:
+            start = time.perf_counter()
         for p in self.plugin_list:
             msg = p.msg_transmit(msg)
+        if self.metrics is not None and len(self.plugin_list) > 0:
+            self.metrics.observe(METRIC_PLUGINS, time.perf_counter() - start)
         return msg
 
     def _process_plugins_receive(self, msg):
+        if self.metrics is not None and len(self.plugin_list) > 0:
+            start = time.perf_counter()
         for x in range(len(self.plugin_list)-1, -1, -1):
             msg =  self.plugin_list[x].msg_receive(msg)
+        if self.metrics is not None and len(self.plugin_list) > 0:
+            self.metrics.observe(METRIC_PLUGINS, time.perf_counter() - start)
         return msg
 
     def _raw_transmit(self, msg):
-        msg_a = self._prep_for_transmit(msg)
-        transmit_count = len(msg_a)
-        while transmit_count > 0:
-            res = self.socket_o.send(msg_a[(transmit_count * -1):])
-            transmit_count -= res
-
-    def _raw_receive(self, size):
-        msg_a = bytearray()
-        recv_count = size
-        while recv_count > 0:
-            tmp = self.socket_o.recv(recv_count)
+        if self._reactor is not None:
+            self._reactor._finish_sending(self)
+        msg_v = self._prep_for_transmit(msg)
+        if self.metrics is not None:
+            self.metrics.count_out(len(msg_v))
+        while len(msg_v) > 0:
+            res = self.socket_o.send(msg_v)
+            msg_v = msg_v[res:]
+
+    def _raw_transmit_vectored(self, msgs):
+        'Sends all messages one after another, with as few syscalls as the platform allows'
+        if self._reactor is not None:
+            # reactor thread may have left its own write half way
+            self._reactor._finish_sending(self)
+        views = [self._prep_for_transmit(m) for m in msgs]
+        views = [v for v in views if len(v) > 0]
+        if not hasattr(self.socket_o, 'sendmsg'):
+            for v in views:
+                self._raw_transmit(v)
+            return
+        if self.metrics is not None:
+            self.metrics.count_out(sum(len(v) for v in views))
+        first = 0
+        while first < len(views):
+            res = self.socket_o.sendmsg(views[first:first + SENDMSG_MAX_BUFFERS])
+            # skip over everything sent in full, and advance into partially sent buffer
+            while first < len(views) and res >= len(views[first]):
+                res -= len(views[first])
+                first += 1
+            if res > 0:
+                views[first] = views[first][res:]
+
+    def _wait_receivable(self):
+        'Waits up to read_timeout for more data of a frame which started arriving'
+        readable, writable, failed = select.select((self.socket_o, ), (), (), self.read_timeout)
+        if len(readable) == 0:
+            raise socket.timeout(f'Nothing received within read timeout of {self.read_timeout} seconds')
+
+    def _raw_receive_into(self, view, frame_start=False):
+        '''Fills entire memoryview straight from the socket, returns number of bytes received.
+
+        Unless the view starts a new frame, every wait for more data is limited by read_timeout.'''
+        received = 0
+        size = len(view)
+        while received < size:
+            if self.read_timeout is not None and (received > 0 or not frame_start):
+                self._wait_receivable()
+            tmp = self.socket_o.recv_into(view[received:], size - received)
 
             # if the connection dies for some reason
-            # then socket will return 0 byte string
+            # then socket will return 0 bytes
             # this is the moment to close the connection
-            if len(tmp) == 0:
+            if tmp == 0:
                 self.shutdown = True
-                msg_a.append(0)
-                msg_a.append(0)
-                msg_a.append(0)
-                msg_a.append(0)
-                return msg_a
-
-            msg_a.extend(tmp)
-            recv_count -= len(tmp)
+                break
+
+            received += tmp
+        if received > 0:
+            self._last_received = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.count_in(received)
+        return received
+
+    def _raw_receive(self, size, frame_start=False):
+        msg_a = bytearray(size)
+        if self._raw_receive_into(memoryview(msg_a), frame_start) < size:
+            return bytearray(4)
         return msg_a
 
-    def _receive(self):
-        with self.connection_lock:
-            # first get a 4 byte size of a transmission
-            size_ba = self._raw_receive(4)
-            recv_count = self._ba_to_s(size_ba)
-            if recv_count > MSG_MAX_SIZE:
-                self._raw_transmit(SC_GENERIC_ERROR)
-                raise TinyProtoError(f'Remote end trying to send message of size {recv_count} which is bigger then supported max size of {MSG_MAX_SIZE}')
-            elif recv_count == 0 and self.shutdown:
-                # this will happen if the connection is dropped on the other side
-                raise TinyProtoError(f'Received zero bytes from remote end. Most probably remote end dropped connection.')
-            self._raw_transmit(SC_OK)
-            msg_a = self._raw_receive(recv_count)
+    def _receive_size(self):
+        'Reads 4 byte size into a buffer reused for every transmission'
+        if self._raw_receive_into(self._header_view, True) < 4:
+            return 0
+        return int.from_bytes(self._header_buffer, 'big')
+
+    @property
+    def is_pipelined(self) -> bool:
+        return self.capabilities & CAP_PIPELINE != 0
+
+    @contextmanager
+    def _transmitting(self):
+        'Holds locks needed to send a message, with classic framing the receiving side too'
+        if self.is_pipelined:
+            with self.transmit_lock:
+                yield
+        else:
+            with self.connection_lock, self.transmit_lock:
+                yield
+
+    def _transmit_control(self, kind, param=0):
+        with self.transmit_lock:
+            self._raw_transmit(self._s_to_ba((kind << 24) | (param & 0xffffff)))
+
+    def _transmit_status(self, status):
+        with self.transmit_lock:
+            self._raw_transmit(status)
+
+    def _control_frame_received(self, kind, param):
+        if kind == CTRL_CAPS:
+            # remote end offers its capabilities, answer with the common part
+            capabilities = param & self._local_capabilities()
+            self._transmit_control(CTRL_CAPS, capabilities)
+            self.capabilities = capabilities
+            self._start_shared_memory()
+        elif kind == CTRL_ERROR and self.is_pipelined:
+            self.transmission_rejected((param >> 8) & 0xffff, param & 0xff)
+        elif kind == CTRL_STREAM_BEGIN and self.is_pipelined and not self._stream_active:
+            self._stream_active = True
+            # streamed message goes through plugins chunk by chunk
+            self._stream_pipeline = TinyProtoPluginPipeline(self.plugin_list, receiving=True)
+        elif kind == CTRL_BATCH and self.is_pipelined and self._batch_remaining == 0 and not self._stream_active:
+            self._batch_remaining = param
+            self._batch_messages = []
+        elif kind in (CTRL_CHANNEL, CTRL_RPC) and self.is_pipelined and self._prefix_frame is None and self._batch_remaining == 0 and not self._stream_active:
+            self._prefix_frame = (kind << 24) | param
+        elif kind == CTRL_SHM and self.capabilities & CAP_SHM and self._prefix_frame is None and self._batch_remaining == 0 and not self._stream_active:
+            if param >> SHM_OP_SHIFT in (SHM_MESSAGE, SHM_ATTACH):
+                self._prefix_frame = (kind << 24) | param
+            else:
+                self._shm_control_received(param >> SHM_OP_SHIFT, param & SHM_SLOT_MASK)
+        elif kind == CTRL_PING and self.capabilities & CAP_HEARTBEAT and self._prefix_frame is None:
+            self._transmit_control(CTRL_PONG, param)
+        elif kind == CTRL_PONG and self.capabilities & CAP_HEARTBEAT and self._prefix_frame is None:
+            self._heartbeat_answered(param)
+        elif kind == CTRL_STREAM_END and self._stream_active:
+            self._stream_active = False
+            self._stream_ended = True
+        else:
+            raise TinyProtoError('Unsupported control frame {0:#x} received'.format(kind))
+
+    def _local_capabilities(self) -> int:
+        'Capabilities this end is willing to agree on with the remote end'
+        capabilities = CAP_PIPELINE | CAP_HEARTBEAT
+        if self.shared_memory_size > 0 and shm.is_supported() and self._is_local_peer():
+            capabilities |= CAP_SHM
+        return capabilities
+
+    def _is_local_peer(self) -> bool:
+        'True if the remote end is surely on the same host'
+        if self.socket_o.family == getattr(socket, 'AF_UNIX', None):
+            return True
+        try:
+            address = ipaddress.ip_address(self.socket_o.getpeername()[0])
+        except (OSError, ValueError, IndexError):
+            return False
+        if getattr(address, 'ipv4_mapped', None) is not None:
+            address = address.ipv4_mapped
+        return address.is_loopback
+
+    def _start_shared_memory(self):
+        'Creates ring written by this end, and hands it over to the remote end, once CAP_SHM is agreed'
+        if self.capabilities & CAP_SHM == 0 or self._shm_out is not None:
+            return
+        try:
+            self._shm_out = shm.TinyProtoShmRing(self.shared_memory_size)
+        except (OSError, ValueError) as e:
+            log.error('Shared memory not used for sending due to error {}'.format(e))
+            return
+        self._transmit_prefixed(CTRL_SHM, SHM_ATTACH << SHM_OP_SHIFT, self._shm_out.name.encode())
+
+    def _shm_control_received(self, op, slot_id):
+        ring = self._shm_out
+        if ring is None:
+            return
+        if op == SHM_RELEASE:
+            ring.release(slot_id)
+        elif op == SHM_ATTACHED:
+            ring.ready = True
+            # both ends have it mapped, so the name is no longer needed,
+            # and the memory is freed even if both of them crash
+            ring.unlink()
+        elif op == SHM_REFUSED:
+            log.info('Remote end could not attach to shared memory, messages are sent through the socket')
+            self._shm_out = None
+            ring.close()
+        else:
+            raise TinyProtoError('Unsupported shared memory operation {0}'.format(op))
+
+    def _shm_frame_received(self, param, msg_a):
+        'Handles message announced by CTRL_SHM frame, returns message read from shared memory, if any'
+        op = param >> SHM_OP_SHIFT
+        if op == SHM_ATTACH:
+            if msg_a is None:
+                return None
+            try:
+                self._shm_in = shm.attach_segment(bytes(msg_a).decode())
+            except (OSError, ValueError) as e:
+                log.error('Could not attach to shared memory of remote end due to error {}'.format(e))
+                self._transmit_control(CTRL_SHM, SHM_REFUSED << SHM_OP_SHIFT)
+            else:
+                self._transmit_control(CTRL_SHM, SHM_ATTACHED << SHM_OP_SHIFT)
+            return None
+        slot_id = param & SHM_SLOT_MASK
+        if self._shm_in is None:
+            raise TinyProtoError('Shared memory message received before remote end handed over its ring')
+        view = None
+        try:
+            if msg_a is None:
+                return None
+            if len(msg_a) != SHM_DESCRIPTOR.size:
+                raise TinyProtoError(f'Shared memory message descriptor of invalid size {len(msg_a)} received')
+            offset, size = SHM_DESCRIPTOR.unpack(msg_a)
+            if offset + size > self._shm_in.size:
+                raise TinyProtoError(f'Shared memory message at {offset} of size {size} is outside of the ring')
+            if size > self.max_message_size:
+                self._transmit_control(CTRL_ERROR, (((self._receive_seq - 1) & 0xffff) << 8) | SC_GENERIC_ERROR)
+                return None
+            # message is handed out without copying, and the slot is held until it is handled
+            view = self._shm_in.buf[offset:offset + size].toreadonly()
+            self._shm_views[id(view)] = (view, slot_id)
+            return view
+        finally:
+            if view is None:
+                self._transmit_control(CTRL_SHM, (SHM_RELEASE << SHM_OP_SHIFT) | slot_id)
+
+    def _shm_release(self, msg):
+        'Lets the remote end reuse the slot of a message read from shared memory, once it is handled'
+        if len(self._shm_views) == 0:
+            return
+        held = self._shm_views.pop(id(msg), None)
+        if held is None:
+            return
+        view, slot_id = held
+        try:
+            # anyone still holding the message gets an error, instead of whatever is written there next
+            view.release()
+        except BufferError:
+            pass
+        if not self.shutdown:
+            self._transmit_control(CTRL_SHM, (SHM_RELEASE << SHM_OP_SHIFT) | slot_id)
+
+    def _shm_detach(self, msg):
+        'Returns copy of a message read from shared memory, releasing its slot, other messages as they are'
+        if len(self._shm_views) == 0 or id(msg) not in self._shm_views:
+            return msg
+        msg_copy = bytearray(msg)
+        self._shm_release(msg)
+        return msg_copy
+
+    def _shm_frames(self, msg) -> typing.Optional[list]:
+        'Returns frames announcing message placed in shared memory, None if it should go through the socket'
+        ring = self._shm_out
+        if ring is None or not ring.ready or len(msg) < self.shared_memory_threshold:
+            return None
+        slot = ring.write(msg)
+        if slot is None:
+            # ring is full, remote end is still busy with earlier messages
+            return None
+        slot_id, offset = slot
+        return [
+            self._s_to_ba((CTRL_SHM << 24) | (SHM_MESSAGE << SHM_OP_SHIFT) | slot_id),
+            self._s_to_ba(SHM_DESCRIPTOR.size),
+            SHM_DESCRIPTOR.pack(offset, len(msg))
+        ]
+
+    def _close_shared_memory(self):
+        ring, self._shm_out = self._shm_out, None
+        if ring is not None:
+            ring.close()
+        for view, slot_id in tuple(self._shm_views.values()):
+            try:
+                view.release()
+            except BufferError:
+                pass
+        self._shm_views.clear()
+        segment, self._shm_in = self._shm_in, None
+        if segment is not None:
+            shm.close_segment(segment)
+
+    def _accept_size(self, recv_count, size_limit=None):
+        '''Validates announced size of a transmission and signals remote end to proceed.
+
+        Returns the number of payload bytes to follow, or None when the
+        header was a control frame without any payload.'''
+        self._reject_status = None
+        max_message_size = self.max_message_size
+        if size_limit is not None and size_limit < max_message_size:
+            max_message_size = size_limit
+        if recv_count > MSG_MAX_SIZE and (recv_count >> 24) >= CTRL_CAPS:
+            self._control_frame_received(recv_count >> 24, recv_count & 0xffffff)
+            return None
+        if recv_count > MSG_MAX_SIZE:
+            self._transmit_status(SC_GENERIC_ERROR)
+            raise TinyProtoError(f'Remote end trying to send message of size {recv_count} which is bigger then supported max size of {MSG_MAX_SIZE}')
+        elif recv_count == 0 and self.shutdown:
+            # this will happen if the connection is dropped on the other side
+            raise TinyProtoError(f'Received zero bytes from remote end. Most probably remote end dropped connection.')
+        elif recv_count > max_message_size:
+            if not self.is_pipelined:
+                self._transmit_status(SC_GENERIC_ERROR)
+                raise TinyProtoError(f'Remote end trying to send message of size {recv_count} which is bigger then allowed size of {max_message_size}')
+            # payload is already on its way, it has to be discarded
+            # before the rejection can be reported back
+            self._reject_status = SC_GENERIC_ERROR
+        if not self.is_pipelined:
+            self._transmit_status(SC_OK)
+        return recv_count
+
+    def _account_receive(self):
+        'Counts received message, returns False if it was rejected'
+        if self.metrics is not None:
+            self.metrics.count_in(0, 1)
+        if self.is_pipelined:
+            seq = self._receive_seq
+            self._receive_seq = (seq + 1) & 0xffff
+            if self._reject_status is not None:
+                self._transmit_control(CTRL_ERROR, (seq << 8) | self._reject_status)
+                self._reject_status = None
+                return False
+        return True
+
+    def _complete_receive(self, msg_a):
+        accepted = self._account_receive()
+        if self._prefix_frame is not None:
+            kind, param = self._prefix_frame >> 24, self._prefix_frame & 0xffffff
+            self._prefix_frame = None
+            if kind == CTRL_SHM:
+                msg_a = self._shm_frame_received(param, msg_a if accepted else None)
+                if msg_a is None:
+                    return None
+            elif kind == CTRL_CHANNEL:
+                self._channel_frame_received(param & CHANNEL_ID_MASK, param & CHANNEL_FINAL != 0, msg_a if accepted else None)
+                return None
+            else:
+                self._rpc_frame_received(param, msg_a if accepted else None)
+                return None
+        if self._stream_active:
+            if accepted:
+                for chunk in self._stream_pipeline.feed(msg_a):
+                    self.stream_chunk_received(chunk)
+            return None
+        if accepted:
             # as the last step, push message through all plugins
+            received = msg_a
             msg_a = self._process_plugins_receive(msg_a)
-            return msg_a
+            if msg_a is not received:
+                self._shm_release(received)
+        if self._batch_remaining > 0:
+            self._batch_remaining -= 1
+            if accepted:
+                self._batch_messages.append(msg_a)
+            if self._batch_remaining == 0:
+                self._received_batch = self._batch_messages
+                self._batch_messages = []
+            return None
+        if not accepted:
+            return None
+        return msg_a
 
-    def _transmit(self, msg):
+    def _channel_for(self, channel_id):
+        with self._channel_lock:
+            channel = self._channels.get(channel_id)
+            if channel is not None:
+                return channel
+            channel = TinyProtoChannel(self, channel_id)
+            self._channels[channel_id] = channel
+        self.channel_opened(channel)
+        return channel
+
+    def _channel_frame_received(self, channel_id, final, fragment):
+        channel = self._channel_for(channel_id)
+        if fragment is None or channel._fragments_dropped:
+            # rejected frame makes the whole message useless
+            channel._fragments = None
+            channel._fragments_dropped = True
+        elif channel._fragments is None:
+            # single frame message is passed on without copying
+            channel._fragments = fragment if final else bytearray(fragment)
+        elif len(channel._fragments) + len(fragment) > self.max_message_size:
+            channel._fragments = None
+            channel._fragments_dropped = True
+        else:
+            channel._fragments += fragment
+        if not final:
+            return
+        msg_a = channel._fragments
+        channel._fragments = None
+        if channel._fragments_dropped:
+            channel._fragments_dropped = False
+            log.error('Message on channel {} dropped, as it was above allowed size of {}'.format(channel_id, self.max_message_size))
+            return
+        self.channel_transmission_received(channel, self._process_plugins_receive(msg_a))
+
+    def _rpc_frame_received(self, param, msg_a):
+        request_id = param & RPC_ID_MASK
+        if param & RPC_RESPONSE == 0:
+            if msg_a is None:
+                self._transmit_response(request_id, 'Request rejected, allowed size is {}'.format(self.max_message_size), True)
+                return
+            self._handle_request(request_id, self._process_plugins_receive(msg_a))
+            return
+        with self._request_lock:
+            future = self._requests.pop(request_id, (None, None))[0]
+        if future is None:
+            # caller already gave up waiting
+            log.debug('Dropping response to unknown request {}'.format(request_id))
+            return
+        if msg_a is None:
+            future.set_exception(TinyProtoError(f'Response rejected, allowed size is {self.max_message_size}'))
+        elif param & RPC_FAILED:
+            future.set_exception(TinyProtoError('Request failed on remote end: {}'.format(bytes(msg_a).decode('utf-8', 'replace'))))
+        else:
+            future.set_result(self._process_plugins_receive(msg_a))
+
+    def _handle_request(self, request_id, msg_a):
+        try:
+            response = self.request_received(msg_a)
+        except Exception as e:
+            log.error('Request {} failed due to error {}'.format(request_id, e))
+            self._transmit_response(request_id, str(e), True)
+            return
+        if isinstance(response, Future):
+            # response is completed later, possibly in another thread
+            response.add_done_callback(lambda f: self._complete_response(request_id, f))
+        else:
+            self._transmit_response(request_id, response)
+
+    def _complete_response(self, request_id, future):
+        if future.cancelled():
+            self._transmit_response(request_id, 'Request cancelled', True)
+        elif future.exception() is not None:
+            self._transmit_response(request_id, str(future.exception()), True)
+        else:
+            self._transmit_response(request_id, future.result())
+
+    def _transmit_response(self, request_id, response, failed=False):
+        if failed:
+            param = request_id | RPC_RESPONSE | RPC_FAILED
+            msg = response.encode('utf-8')
+        else:
+            param = request_id | RPC_RESPONSE
+            msg = self._process_plugins_transmit(response if response is not None else b'')
+        try:
+            self._transmit_prefixed(CTRL_RPC, param, msg)
+        except OSError as e:
+            log.error('Shutting down connection on transmit due to error {}'.format(e))
+            self.shutdown = True
+
+    def _expire_requests(self):
+        'Fails requests which did not get a response before their deadline'
+        if len(self._requests) == 0:
+            return
+        now = time.monotonic()
+        with self._request_lock:
+            expired = [request_id for request_id, (future, deadline) in self._requests.items() if deadline is not None and deadline <= now]
+            futures = [self._requests.pop(request_id)[0] for request_id in expired]
+        for future in futures:
+            future.set_exception(FutureTimeoutError('No response within timeout'))
+
+    def _heartbeat_answered(self, token):
+        'Updates smoothed round trip time with the answer to the last CTRL_PING'
+        if not self._ping_pending or token != self._ping_token:
+            # answer to a ping which was already given up on
+            return
+        self._ping_pending = False
+        sample = time.monotonic() - self._ping_sent
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_variance = sample / 2
+        else:
+            self.rtt_variance += RTT_VARIANCE_GAIN * (abs(self.rtt - sample) - self.rtt_variance)
+            self.rtt += RTT_GAIN * (sample - self.rtt)
+        if self.metrics is not None:
+            self.metrics.observe(METRIC_RTT, sample)
+
+    def _check_liveness(self, receiving: bool = False):
+        '''Closes the connection once the remote end went silent for too long, and sends heartbeats when they are due.
+
+        With receiving, a frame started arriving and read_timeout applies as well.'''
+        if self.idle_timeout is None and self.read_timeout is None and self.heartbeat_interval is None:
+            return
+        now = time.monotonic()
+        if self._dispatch_full():
+            # socket is not read until the executor catches up,
+            # the remote end can't be blamed for the silence
+            self._last_received = now
+        silent = now - self._last_received
+        if self.idle_timeout is not None and silent >= self.idle_timeout:
+            log.info('Shutting down connection idle for {:.3f} seconds'.format(silent))
+            self.shutdown = True
+        elif receiving and self.read_timeout is not None and silent >= self.read_timeout:
+            log.info('Shutting down connection stalled in the middle of a frame for {:.3f} seconds'.format(silent))
+            self.shutdown = True
+        elif self.heartbeat_interval is None or self.capabilities & CAP_HEARTBEAT == 0:
+            return
+        elif self._ping_pending:
+            if now - self._ping_sent >= self.heartbeat_interval and silent >= self.heartbeat_interval:
+                log.info('Shutting down connection, remote end did not answer heartbeat for {:.3f} seconds'.format(now - self._ping_sent))
+                self.shutdown = True
+        elif now - self._ping_sent >= self.heartbeat_interval:
+            self._ping_token = (self._ping_token + 1) & PING_TOKEN_MASK
+            self._ping_sent = now
+            self._ping_pending = True
+            self._transmit_control(CTRL_PING, self._ping_token)
+
+    def _liveness_deadline(self, receiving: bool = False) -> typing.Optional[float]:
+        'Returns monotonic time of the next _check_liveness which could act, None if there is none'
+        deadlines = []
+        if self.idle_timeout is not None:
+            deadlines.append(self._last_received + self.idle_timeout)
+        if receiving and self.read_timeout is not None:
+            deadlines.append(self._last_received + self.read_timeout)
+        if self.heartbeat_interval is not None and self.capabilities & CAP_HEARTBEAT:
+            if self._ping_pending:
+                deadlines.append(max(self._ping_sent, self._last_received) + self.heartbeat_interval)
+            else:
+                deadlines.append(self._ping_sent + self.heartbeat_interval)
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def _fail_requests(self):
+        with self._request_lock:
+            futures = [future for future, deadline in self._requests.values()]
+            self._requests.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(TinyProtoError('Connection closed before response arrived'))
+
+    def _receive_prefixed_frame(self, recv_count):
+        '''Receives message frame announced by the last CTRL_CHANNEL, CTRL_RPC or CTRL_SHM frame.
+
+        Returns the message, if it was passed through shared memory.'''
+        if self._reject_status is not None:
+            self._discard(recv_count)
+            return self._complete_receive(None)
+        return self._complete_receive(self._raw_receive(recv_count))
+
+    def _finish_stream_pipeline(self):
+        'Returns the last chunks of streamed message left in plugins'
+        pipeline = self._stream_pipeline
+        self._stream_pipeline = None
+        if pipeline is None:
+            return []
+        return [chunk for chunk in pipeline.finish() if len(chunk) > 0]
+
+    def _control_frame_done(self):
+        'Returns a message completed by the last control frame, if any'
+        if self._stream_ended:
+            self._stream_ended = False
+            for chunk in self._finish_stream_pipeline():
+                self.stream_chunk_received(chunk)
+            return self.stream_finished()
+        return None
+
+    def _discard(self, size):
+        discard_view = memoryview(bytearray(min(size, DISCARD_CHUNK_SIZE)))
+        while size > 0 and not self.shutdown:
+            size -= self._raw_receive_into(discard_view[:min(size, DISCARD_CHUNK_SIZE)])
+
+    def _receive_frame(self):
+        'Receives a single frame, returns None if it did not carry a message'
         with self.connection_lock:
+            # first get a 4 byte size of a transmission
+            recv_count = self._accept_size(self._receive_size())
+            if recv_count is None:
+                return self._control_frame_done()
+            if self._reject_status is not None:
+                self._discard(recv_count)
+                return self._complete_receive(None)
+            if self.metrics is not None:
+                start = time.perf_counter()
+                msg_a = self._raw_receive(recv_count)
+                self.metrics.observe(METRIC_RECEIVE, time.perf_counter() - start)
+            else:
+                msg_a = self._raw_receive(recv_count)
+            return self._complete_receive(msg_a)
+
+    def _receive(self):
+        with self.connection_lock:
+            while len(self._received_backlog) == 0:
+                msg_a = self._receive_frame()
+                if msg_a is not None:
+                    # caller keeps the message as long as it likes, so it can't stay in shared memory
+                    return self._shm_detach(msg_a)
+                if self._received_batch is not None:
+                    self._received_backlog.extend(self._received_batch)
+                    self._received_batch = None
+            return self._received_backlog.popleft()
+
+    def _dispatch_received(self, msg_a):
+        'Hands received message, or completed batch of messages, over to the hooks'
+        if msg_a is not None:
+            if self._executor is None:
+                try:
+                    self._call_handler(self.transmission_received, msg_a)
+                finally:
+                    self._shm_release(msg_a)
+            else:
+                self._queue_dispatch(msg_a, False)
+        if self._received_batch is not None:
+            batch = self._received_batch
+            self._received_batch = None
+            if self._executor is None:
+                self._call_handler(self.transmissions_received, batch)
+            elif self._dispatch_handler is not None:
+                for msg in batch:
+                    self._queue_dispatch(msg, False)
+            else:
+                self._queue_dispatch(batch, True)
+
+    def _call_handler(self, fn, arg):
+        if self.metrics is None:
+            return fn(arg)
+        start = time.perf_counter()
+        try:
+            return fn(arg)
+        finally:
+            self.metrics.observe(METRIC_HANDLER, time.perf_counter() - start)
+
+    def _queue_dispatch(self, arg, is_batch):
+        if self._dispatch_handler is not None:
+            fn = self._dispatch_handler
+        elif is_batch:
+            fn = self.transmissions_received
+        else:
+            fn = self.transmission_received
+        with self._dispatch_condition:
+            self._dispatch_pending += 1
+            if self._dispatch_ordered:
+                if self._dispatch_active:
+                    self._dispatch_queue.append((fn, arg))
+                    return
+                self._dispatch_active = True
+        self._start_dispatch(fn, arg)
+
+    def _start_dispatch(self, fn, arg):
+        try:
+            if fn is self._dispatch_handler:
+                future = self._executor.submit(fn, arg)
+            else:
+                future = self._executor.submit(self._call_handler, fn, arg)
+        except RuntimeError as e:
+            # executor is already shut down
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(lambda f: self._dispatch_done(arg, f))
+
+    def _dispatch_done(self, arg, future):
+        if future.exception() is not None:
+            log.error('Handling of received message failed due to error {}'.format(future.exception()))
+        elif self._dispatch_handler is not None:
+            try:
+                self.transmission_processed(arg, future.result())
+            except Exception as e:
+                log.error('Handling of processed message failed due to error {}'.format(e))
+        self._shm_release(arg)
+        next_item = None
+        with self._dispatch_condition:
+            self._dispatch_pending -= 1
+            resumed = self._dispatch_pending == self._dispatch_limit - 1
+            if self._dispatch_ordered:
+                if len(self._dispatch_queue) > 0:
+                    next_item = self._dispatch_queue.popleft()
+                else:
+                    self._dispatch_active = False
+            self._dispatch_condition.notify_all()
+        if resumed:
+            # loop stopped reading from the socket once the queue was full
+            self.wake()
+        if next_item is not None:
+            self._start_dispatch(*next_item)
+
+    def _dispatch_full(self) -> bool:
+        return self._executor is not None and self._dispatch_pending >= self._dispatch_limit
+
+    def _receive_into(self, buffer):
+        view = memoryview(buffer).cast('B')
+        with self.connection_lock:
+            while len(self._received_backlog) == 0:
+                received = self._receive_frame_into(view)
+                if received is not None:
+                    return received
+                if self._received_batch is not None:
+                    self._received_backlog.extend(self._received_batch)
+                    self._received_batch = None
+            # rest of a batch received earlier
+            msg_a = self._received_backlog.popleft()
+            if len(msg_a) > len(view):
+                raise TinyProtoError(f'Message of size {len(msg_a)} does not fit into buffer of size {len(view)}')
+            view[:len(msg_a)] = msg_a
+            return len(msg_a)
+
+    def _receive_frame_into(self, view):
+        'Receives next frame into the view, returns its size, or None if it was not a message for the caller'
+        recv_count = None
+        while recv_count is None:
+            # without plugins the announced size is final, so anything not fitting
+            # into the buffer is rejected, before it is sent with classic framing,
+            # and discarded after it is read with pipelined framing
+            size_limit = len(view) if len(self.plugin_list) == 0 and self._prefix_frame is None and self._batch_remaining == 0 else None
+            recv_count = self._accept_size(self._receive_size(), size_limit)
+            if recv_count is not None and self._prefix_frame is not None:
+                msg_a = self._receive_prefixed_frame(recv_count)
+                recv_count = None
+                if msg_a is not None:
+                    # already read from shared memory, and through plugins
+                    msg_a = self._shm_detach(msg_a)
+                    if len(msg_a) > len(view):
+                        raise TinyProtoError(f'Message of size {len(msg_a)} does not fit into buffer of size {len(view)}')
+                    view[:len(msg_a)] = msg_a
+                    return len(msg_a)
+        if self._batch_remaining > 0:
+            # members of a batch are kept until the caller asks for them,
+            # so they can't be read into its buffer
+            if self._reject_status is not None:
+                self._discard(recv_count)
+                self._complete_receive(None)
+            else:
+                self._complete_receive(self._raw_receive(recv_count))
+            return None
+        if self._reject_status is not None:
+            self._discard(recv_count)
+            self._complete_receive(None)
+            raise TinyProtoError(f'Message of size {recv_count} does not fit into buffer of size {len(view)}')
+        if len(self.plugin_list) == 0:
+            received = self._raw_receive_into(view[:recv_count])
+            self._complete_receive(view)
+        else:
+            msg_a = bytearray(recv_count)
+            received = self._raw_receive_into(memoryview(msg_a))
+            msg_a = self._complete_receive(msg_a)
+        if received < recv_count:
+            raise TinyProtoError(f'Received {received} out of {recv_count} bytes from remote end. Most probably remote end dropped connection.')
+        if len(self.plugin_list) == 0:
+            return recv_count
+        if len(msg_a) > len(view):
+            raise TinyProtoError(f'Message of size {len(msg_a)} does not fit into buffer of size {len(view)}')
+        view[:len(msg_a)] = msg_a
+        return len(msg_a)
+
+    def _receive_message_chunks(self, recv_count, chunk_size):
+        if self._reject_status is not None:
+            self._discard(recv_count)
+            self._account_receive()
+            raise TinyProtoError(f'Message of size {recv_count} rejected, allowed size is {self.max_message_size}')
+        pipeline = None
+        if len(self.plugin_list) > 0:
+            pipeline = TinyProtoPluginPipeline(self.plugin_list, receiving=True)
+        chunk_view = memoryview(bytearray(min(recv_count, chunk_size)))
+        while recv_count > 0:
+            view = chunk_view[:min(recv_count, chunk_size)]
+            received = self._raw_receive_into(view)
+            if received < len(view):
+                raise TinyProtoError('Remote end dropped connection in the middle of a message')
+            recv_count -= received
+            if pipeline is None:
+                yield view
+                continue
+            for chunk in pipeline.feed(view):
+                if len(chunk) > 0:
+                    yield chunk
+        self._account_receive()
+        if pipeline is not None:
+            for chunk in pipeline.finish():
+                if len(chunk) > 0:
+                    yield chunk
+
+    def _receive_stream(self, chunk_size):
+        with self.connection_lock:
+            recv_count = None
+            while recv_count is None and not self._stream_active:
+                recv_count = self._accept_size(self._receive_size())
+                if recv_count is not None and self._prefix_frame is not None:
+                    msg_a = self._receive_prefixed_frame(recv_count)
+                    recv_count = None
+                    if msg_a is not None:
+                        # already read from shared memory, and through plugins
+                        yield self._shm_detach(msg_a)
+                        return
+            if recv_count is not None:
+                yield from self._receive_message_chunks(recv_count, chunk_size)
+                return
+            # message streamed as separate frames, chunks are pushed through plugins as they come
+            while True:
+                recv_count = self._accept_size(self._receive_size())
+                if recv_count is None:
+                    if self._stream_ended:
+                        self._stream_ended = False
+                        yield from self._finish_stream_pipeline()
+                        return
+                    continue
+                if self._reject_status is not None:
+                    self._discard(recv_count)
+                    self._account_receive()
+                    continue
+                msg_a = self._raw_receive(recv_count)
+                if self._account_receive():
+                    for chunk in self._stream_pipeline.feed(msg_a):
+                        if len(chunk) > 0:
+                            yield chunk
+
+    def _stream_source_size(self, source, size):
+        if size is not None:
+            return size
+        try:
+            return os.fstat(source.fileno()).st_size - source.tell()
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            return None
+
+    def _iter_stream_source(self, source, chunk_size):
+        if hasattr(source, 'read'):
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+        else:
+            for chunk in source:
+                view = self._prep_for_transmit(chunk)
+                for offset in range(0, len(view), chunk_size):
+                    yield view[offset:offset + chunk_size]
+
+    def _transmit_size(self, size):
+        'Announces size of a message to remote end, waiting for its approval with classic framing'
+        self._raw_transmit(self._s_to_ba(size))
+        if self.metrics is not None:
+            self.metrics.count_out(0, 1)
+        if self.is_pipelined:
+            self._transmit_seq = (self._transmit_seq + 1) & 0xffff
+            return
+        self._receive_ack()
+
+    def _receive_ack(self):
+        'Waits for remote end to approve the announced message'
+        if self.metrics is not None:
+            start = time.perf_counter()
+            tx_status = self._raw_receive(1, True)
+            self.metrics.observe(METRIC_ACK_WAIT, time.perf_counter() - start)
+        else:
+            tx_status = self._raw_receive(1, True)
+        # check if return code is OK
+        if tx_status[0] != SC_OK:
+            raise TinyProtoError('Transmission rejected: {0}'.format(tx_status))
+
+    def _transmit_stream_body(self, source, size, chunk_size):
+        'Returns number of bytes sent'
+        if hasattr(source, 'fileno') and hasattr(self.socket_o, 'sendfile'):
+            try:
+                offset = source.tell()
+                source.fileno()
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                pass
+            else:
+                # file goes straight from page cache into the socket
+                return self.socket_o.sendfile(source, offset, size)
+        sent = 0
+        for chunk in self._iter_stream_source(source, chunk_size):
+            chunk = self._prep_for_transmit(chunk)
+            if sent + len(chunk) > size:
+                break
+            self._raw_transmit(chunk)
+            sent += len(chunk)
+        return sent
+
+    def _transmit_stream(self, source, size, chunk_size):
+        with self._transmitting():
+            size = self._stream_source_size(source, size)
+            if len(self.plugin_list) == 0 and size is not None and size <= MSG_MAX_SIZE:
+                # size is known upfront, so stream goes out as a single message
+                self._transmit_size(size)
+                sent = self._transmit_stream_body(source, size, chunk_size)
+                if sent != size:
+                    # remote end still waits for the rest of the message, so it is lost
+                    self.shutdown = True
+                    raise TinyProtoError(f'Stream source provided {sent} bytes out of announced {size}')
+            elif self.is_pipelined:
+                self._transmit_control(CTRL_STREAM_BEGIN)
+                pipeline = TinyProtoPluginPipeline(self.plugin_list)
+                for chunk in self._iter_stream_source(source, chunk_size):
+                    self._transmit_frames(pipeline.feed(chunk))
+                self._transmit_frames(pipeline.finish())
+                self._transmit_control(CTRL_STREAM_END)
+            else:
+                raise TinyProtoError('Streaming with plugins, or of unknown size, requires pipelined framing negotiated with remote end')
+
+    def _transmit_many(self, msgs):
+        results = [False] * len(msgs)
+        with self._transmitting():
+            if not self.is_pipelined:
+                # every message still needs its own approval
+                for idx, msg in enumerate(msgs):
+                    try:
+                        self._transmit(msg)
+                        results[idx] = True
+                    except TinyProtoError as e:
+                        log.error('Message {} of a batch not transmitted due to error {}'.format(idx, e))
+                return results
+            for first in range(0, len(msgs), BATCH_MAX_SIZE):
+                frames = []
+                sent = []
+                for idx in range(first, min(first + BATCH_MAX_SIZE, len(msgs))):
+                    try:
+                        msg = self._prep_for_transmit(self._process_plugins_transmit(msgs[idx]))
+                    except Exception as e:
+                        log.error('Message {} of a batch not transmitted due to error {}'.format(idx, e))
+                        continue
+                    frames.append(self._s_to_ba(len(msg)))
+                    frames.append(msg)
+                    sent.append(idx)
+                if len(sent) == 0:
+                    continue
+                frames.insert(0, self._s_to_ba((CTRL_BATCH << 24) | len(sent)))
+                self._raw_transmit_vectored(frames)
+                self._transmit_seq = (self._transmit_seq + len(sent)) & 0xffff
+                if self.metrics is not None:
+                    self.metrics.count_out(0, len(sent))
+                for idx in sent:
+                    results[idx] = True
+        return results
+
+    def _transmit_frames(self, chunks):
+        'Sends chunks which already went through plugins, skipping empty ones'
+        for chunk in chunks:
+            if len(chunk) > 0:
+                # frames of a stream always go through the socket
+                self._transmit_frame(chunk, shared=False)
+
+    def _transmit_prefixed(self, kind, param, msg):
+        'Sends a control frame together with the message frame it announces'
+        msg = self._prep_for_transmit(msg)
+        with self.transmit_lock:
+            self._raw_transmit_vectored((self._s_to_ba((kind << 24) | param), self._s_to_ba(len(msg)), msg))
+            self._transmit_seq = (self._transmit_seq + 1) & 0xffff
+            if self.metrics is not None:
+                self.metrics.count_out(0, 1)
+
+    def _transmit_next_channel_frame(self):
+        'Sends a single frame of the channel whose turn it is'
+        with self.transmit_lock:
+            with self._channel_lock:
+                if len(self._channel_ready) == 0:
+                    return
+                channel = self._channel_ready.popleft()
+                pending = channel._outbox[0]
+                view, offset = pending[0], pending[1]
+                fragment = view[offset:offset + CHANNEL_FRAME_SIZE]
+                pending[1] = offset + len(fragment)
+                final = pending[1] >= len(view)
+                if final:
+                    channel._outbox.popleft()
+                if len(channel._outbox) > 0:
+                    # back in the line, after all other waiting channels
+                    self._channel_ready.append(channel)
+            self._transmit_prefixed(CTRL_CHANNEL, channel.channel_id | (CHANNEL_FINAL if final else 0), fragment)
+            if final:
+                pending[2] = True
+
+    def _channel_transmit(self, channel, msg):
+        if not self.is_pipelined:
+            raise TinyProtoError('Channels require pipelined framing negotiated with remote end')
+        if not channel.is_open:
+            raise TinyProtoError(f'Channel {channel.channel_id} is closed')
+        msg = self._prep_for_transmit(self._process_plugins_transmit(msg))
+        pending = [msg, 0, False]
+        with self._channel_lock:
+            channel._outbox.append(pending)
+            if len(channel._outbox) == 1:
+                self._channel_ready.append(channel)
+        try:
+            # every transmitting thread sends frames of all channels in turns,
+            # until the last frame of its own message is out
+            while not pending[2] and not self.shutdown:
+                self._transmit_next_channel_frame()
+        except OSError as e:
+            log.error('Shutting down connection on transmit due to error {}'.format(e))
+            self.shutdown = True
+
+    def request(self, msg, timeout: typing.Optional[float] = None) -> Future:
+        '''Sends a request, returns a Future completed with the response of the remote end.
+
+        Any number of requests can wait for their responses at the same time.
+        Requires pipelined framing. Without a response within timeout seconds
+        the Future fails with TimeoutError.'''
+        if not self.is_pipelined:
+            raise TinyProtoError('Requests require pipelined framing negotiated with remote end')
+        future = Future()
+        future.set_running_or_notify_cancel()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._request_lock:
+            request_id = self._next_request_id
+            while request_id in self._requests:
+                request_id = (request_id + 1) & RPC_ID_MASK
+            self._next_request_id = (request_id + 1) & RPC_ID_MASK
+            self._requests[request_id] = (future, deadline)
+        if deadline is not None:
+            # connection loop has to pick up the new deadline
+            self.wake()
+        try:
+            self._transmit_prefixed(CTRL_RPC, request_id, self._process_plugins_transmit(msg))
+        except Exception as e:
+            with self._request_lock:
+                self._requests.pop(request_id, None)
+            if isinstance(e, OSError):
+                log.error('Shutting down connection on transmit due to error {}'.format(e))
+                self.shutdown = True
+            future.set_exception(e)
+        return future
+
+    async def request_async(self, msg, timeout: typing.Optional[float] = None):
+        'Awaitable variant of request, returns the response'
+        return await asyncio.wrap_future(self.request(msg, timeout))
+
+    def _channel_receive(self, channel, timeout):
+        if self.is_alive():
+            try:
+                return channel._inbox.get(timeout=timeout)
+            except queue.Empty:
+                return None
+        # nothing else reads from the connection, so frames are received
+        # here, keeping messages outside of channels for receive
+        try:
+            with self.connection_lock:
+                while channel._inbox.empty() and not self.shutdown:
+                    msg_a = self._receive_frame()
+                    if msg_a is not None:
+                        self._received_backlog.append(msg_a)
+                    if self._received_batch is not None:
+                        self._received_backlog.extend(self._received_batch)
+                        self._received_batch = None
+        except OSError as e:
+            self.shutdown = True
+            log.error('Shutting down connection on receive due to error {}'.format(e))
+        try:
+            return channel._inbox.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _close_channel(self, channel):
+        with self._channel_lock:
+            channel.is_open = False
+            if self._channels.get(channel.channel_id) is channel:
+                del(self._channels[channel.channel_id])
+        channel._inbox.put(None)
+
+    def open_channel(self, channel_id: typing.Optional[int] = None) -> TinyProtoChannel:
+        '''Returns a channel multiplexed over this connection, which requires pipelined framing.
+
+        Without channel_id the next free one is allocated, odd on the connecting
+        end and even on the accepting end. Channel already opened by the
+        remote end is returned as it is.'''
+        with self._channel_lock:
+            if channel_id is None:
+                channel_id = self._next_channel_id
+                while channel_id in self._channels:
+                    channel_id += 2
+                self._next_channel_id = channel_id + 2
+            if channel_id <= 0 or channel_id > CHANNEL_ID_MASK:
+                raise ValueError(f'Channel id must be between 1 and {CHANNEL_ID_MASK}')
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                channel = TinyProtoChannel(self, channel_id)
+                self._channels[channel_id] = channel
+            return channel
+
+    def _transmit(self, msg):
+        with self._transmitting():
             # before we can even begin calculating anything, we have to process all plugins
             # because the size might change in the process
-            msg = self._process_plugins_transmit(msg)
+            self._transmit_frame(self._process_plugins_transmit(msg))
+
+    def _transmit_frame(self, msg, shared=True):
+        with self._transmitting():
+            msg = self._prep_for_transmit(msg)
             # first prepare and send 4 byte size of a transmission
             size_ba = self._s_to_ba(len(msg))
+            if self.metrics is not None:
+                self.metrics.count_out(0, 1)
+            if self.is_pipelined:
+                # size and message go out together, rejections
+                # come back asynchronously as CTRL_ERROR frames
+                frames = self._shm_frames(msg) if shared else None
+                self._raw_transmit_vectored(frames or (size_ba, msg))
+                self._transmit_seq = (self._transmit_seq + 1) & 0xffff
+                return
             self._raw_transmit(size_ba)
-            # check if return code is OK
-            tx_status = self._raw_receive(1)
-            if tx_status[0] != SC_OK:
-                raise TinyProtoError('Transmission rejected: {0}'.format(tx_status))
+            self._receive_ack()
             self._raw_transmit(msg)
 
+    def _flush_outbound(self):
+        'Sends messages queued by transmit_nowait, completing their futures'
+        if len(self._outbound) == 0:
+            return
+        with self._transmitting():
+            items = []
+            while len(self._outbound) > 0:
+                items.append(self._outbound.popleft())
+            sent = 0
+            try:
+                if self.is_pipelined:
+                    # everything queued so far goes out with a single vectored write
+                    frames = []
+                    for header, msg, future in items:
+                        shm_frames = self._shm_frames(msg)
+                        if shm_frames is not None:
+                            frames.extend(shm_frames)
+                            continue
+                        frames.append(header)
+                        frames.append(msg)
+                    self._raw_transmit_vectored(frames)
+                    self._transmit_seq = (self._transmit_seq + len(items)) & 0xffff
+                    if self.metrics is not None:
+                        self.metrics.count_out(0, len(items))
+                    sent = len(items)
+                else:
+                    for header, msg, future in items:
+                        try:
+                            self._transmit_frame(msg)
+                        except TinyProtoError as e:
+                            future.set_exception(e)
+                        sent += 1
+            except OSError as e:
+                log.error('Shutting down connection on transmit due to error {}'.format(e))
+                self.shutdown = True
+                for header, msg, future in items[sent:]:
+                    future.set_exception(e)
+                items = items[:sent]
+        for header, msg, future in items:
+            if not future.done():
+                future.set_result(None)
+
+    def _fail_outbound(self):
+        while len(self._outbound) > 0:
+            try:
+                header, msg, future = self._outbound.popleft()
+            except IndexError:
+                break
+            future.set_exception(TinyProtoError('Connection closed before message was sent'))
+
+    def transmit_nowait(self, msg) -> Future:
+        '''Queues a message to be sent by the connection loop, and returns right away.
+
+        Returns a Future completed once the message is written to the socket,
+        or failed if it could not be sent. Plugins run in the calling thread,
+        and the message should not be modified until the Future is done.'''
+        try:
+            msg = self._prep_for_transmit(self._process_plugins_transmit(msg))
+        except Exception as e:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            future.set_exception(e)
+            return future
+        return self._queue_outbound(self._s_to_ba(len(msg)), msg)
+
+    def _queue_outbound(self, header, msg) -> Future:
+        'Queues message which already went through plugins, together with its size header'
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._outbound.append((header, msg, future))
+        if self.shutdown:
+            self._fail_outbound()
+        else:
+            self.wake()
+        return future
+
+    async def send_async(self, msg):
+        'Awaitable variant of transmit_nowait, returns once the message is sent'
+        await asyncio.wrap_future(self.transmit_nowait(msg))
+
     def receive(self):
         try:
             return self._receive()
@@ -185,37 +1526,239 @@ class TinyProtoConnection:
             log.error('Shutting down connection on receive due to error {}'.format(e))
             return bytearray()
 
+    def receive_into(self, buffer) -> int:
+        '''Receives next message straight into provided writable buffer, like a
+        bytearray or mmap, and returns size of the message.
+
+        A message not fitting into the buffer raises TinyProtoError. Only with classic
+        framing and no plugins is it rejected before it is sent, otherwise it is
+        read and discarded first.'''
+        try:
+            return self._receive_into(buffer)
+        except OSError as e:
+            self.shutdown = True
+            log.error('Shutting down connection on receive due to error {}'.format(e))
+            return 0
+
     def transmit(self, msg):
+        '''Sends a message, returning once it is written to the socket.
+
+        Called from the reactor thread, eg. from a hook of a connection using a reactor,
+        the message is queued like with transmit_nowait instead, so waiting for the
+        socket or for the OK signal doesn't hold back other connections of the reactor.'''
+        if self._reactor is not None and self._reactor._is_reactor_thread():
+            msg = self._prep_for_transmit(self._process_plugins_transmit(msg))
+            self._queue_outbound(self._s_to_ba(len(msg)), msg)
+            return
         try:
             self._transmit(msg)
         except OSError as e:
             log.error('Shutting down connection on transmit due to error {}'.format(e))
             self.shutdown = True
 
-    def _initialise_connection(self):
-        if not self.is_socket_up and self.remote_details is not None:
-            self.socket_o.connect( self.remote_details.socket_connect_details )
-            self.is_socket_up = True
-        self._raw_transmit(SC_OK)
+    def transmit_many(self, msgs) -> typing.List[bool]:
+        '''Transmits all messages under a single lock, returning per message success.
+
+        With pipelined framing the whole batch is flushed with vectored I/O and
+        delivered to `transmissions_received` of the remote end at once, otherwise
+        messages are transmitted one by one. Plugins run once per message.'''
+        msgs = list(msgs)
+        try:
+            return self._transmit_many(msgs)
+        except OSError as e:
+            log.error('Shutting down connection on transmit due to error {}'.format(e))
+            self.shutdown = True
+            return [False] * len(msgs)
+
+    def receive_stream(self, chunk_size: int = STREAM_CHUNK_SIZE):
+        '''Generator yielding next message in chunks, so memory use stays flat
+        whatever the size of the message. Chunks may be views into a reused
+        buffer, valid only until the next chunk is requested. The connection
+        stays locked until the generator is exhausted or closed.'''
+        try:
+            yield from self._receive_stream(chunk_size)
+        except OSError as e:
+            self.shutdown = True
+            log.error('Shutting down connection on receive due to error {}'.format(e))
+
+    def receive_to_file(self, file_object, chunk_size: int = STREAM_CHUNK_SIZE) -> int:
+        'Writes next message into a binary file object, returns number of bytes written'
+        written = 0
+        for chunk in self.receive_stream(chunk_size):
+            file_object.write(chunk)
+            written += len(chunk)
+        return written
+
+    def transmit_stream(self, source, size: typing.Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE):
+        '''Sends a binary file object, or an iterable of bytes-like chunks, as a single message.
+
+        When the size is known ( files, or provided explicitly ) and there are no
+        plugins, it goes out as a regular message, files through socket.sendfile.
+        Otherwise chunks are pushed through the plugins one by one as they are read,
+        and sent as separate frames, which requires pipelined framing negotiated
+        with remote end.'''
+        try:
+            self._transmit_stream(source, size, chunk_size)
+        except OSError as e:
+            log.error('Shutting down connection on transmit due to error {}'.format(e))
+            self.shutdown = True
+
+    def _handshake(self, offer_capabilities):
+        if offer_capabilities:
+            # the offer goes out together with the handshake,
+            # so the remote end sees it before it runs pre_loop
+            probe = self._s_to_ba((CTRL_CAPS << 24) | self._local_capabilities())
+            self._raw_transmit(bytearray((SC_OK, )) + probe)
+        else:
+            self._raw_transmit(SC_OK)
         res = self._raw_receive(1)
         if res[0] != SC_OK:
             raise TinyProtoError('Initialisation error: {0}'.format(res))
+
+    def _negotiate_capabilities(self):
+        'Returns False if remote end does not understand capability exchange'
+        res = self._raw_receive(1)
+        if res[0] != CTRL_CAPS:
+            # classic implementations reject the offer as oversized message
+            return False
+        self.capabilities = self._ba_to_s(bytearray(1) + self._raw_receive(3)) & self._local_capabilities()
+        self._start_shared_memory()
+        return True
+
+    def _reconnect(self):
+        timeout = self.socket_o.gettimeout()
+        family, kind = self.socket_o.family, self.socket_o.type
+        self.socket_o.close()
+        self.socket_o = socket.socket(family, kind)
+        self.socket_o.settimeout(timeout)
+        if self.socket_options is not None:
+            self.socket_options.apply(self.socket_o)
+        self._connect_remote()
+
+    def _connect_remote(self):
+        'Connects to remote end, trying all of its addresses if more of them are known'
+        if len(self.remote_details.addresses) > 1:
+            timeout = self.socket_o.gettimeout()
+            self.socket_o.close()
+            self.socket_o = self.remote_details.create_connection(timeout, socket_options=self.socket_options)
+        else:
+            self.socket_o.connect( self.remote_details.socket_connect_details )
+
+    def _answer_pending_offer(self):
+        'Answers capability offer sent together with the handshake, if it is already there'
+        if not self._socket_readable():
+            return
+        pending = self.socket_o.recv(1, socket.MSG_PEEK)
+        if len(pending) == 1 and pending[0] == CTRL_CAPS:
+            self._receive_frame()
+
+    def _initialise_connection(self):
+        if not self.is_socket_up and self.remote_details is not None:
+            self._connect_remote()
+            self.is_socket_up = True
+        self._handshake(self.negotiate_capabilities)
+        if self.negotiate_capabilities:
+            if not self._negotiate_capabilities():
+                if self.remote_details is None:
+                    raise TinyProtoError('Remote end does not support capability negotiation')
+                # remote end dropped the connection after rejecting the offer,
+                # fall back to the classic protocol on a fresh one
+                log.info('Remote end does not support capability negotiation, reconnecting with classic protocol')
+                self._reconnect()
+                self._handshake(False)
+        else:
+            self._answer_pending_offer()
         self.peername_details = self.socket_o.getpeername()
+        self._selector = selectors.DefaultSelector()
         self._selector.register(self.socket_o, selectors.EVENT_READ)
+        self._waker = TinyProtoWaker()
+        self._selector.register(self._waker, selectors.EVENT_READ)
+        self._last_received = self._ping_sent = time.monotonic()
+
+    def _loop_receive(self):
+        try:
+            return self._receive_frame()
+        except OSError as e:
+            self.shutdown = True
+            log.error('Shutting down connection on receive due to error {}'.format(e))
+            return None
+        except TinyProtoError as e:
+            if not self.shutdown:
+                raise
+            # remote end closed the connection, possibly after dropping this one as dead
+            log.info('Shutting down connection closed by remote end: {}'.format(e))
+            return None
+
+    def _next_timeout(self, receiving: bool = False) -> typing.Optional[float]:
+        'Returns how long the loop can wait for something to happen, None if there is nothing due'
+        timeout = self.loop_interval
+        deadline = self._liveness_deadline(receiving)
+        if deadline is not None:
+            remaining = max(0.0, deadline - time.monotonic())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if len(self._requests) > 0:
+            with self._request_lock:
+                deadlines = [deadline for future, deadline in self._requests.values() if deadline is not None]
+            if len(deadlines) > 0:
+                remaining = max(0.0, min(deadlines) - time.monotonic())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def _socket_readable(self) -> bool:
+        readable, writable, failed = select.select((self.socket_o, ), (), (), 0)
+        return len(readable) > 0
+
+    def _wait_readable(self) -> bool:
+        'Waits for data, wake or the next timeout without holding the lock, returns True if the socket got readable'
+        readable = False
+        for key, key_mask in self._selector.select(self._next_timeout()):
+            if key.fileobj is self._waker:
+                self._waker.drain()
+            else:
+                readable = True
+        return readable
 
     def _connection_loop(self):
+        reading = True
+        readable = False
         while not self.shutdown:
             with self.connection_lock:
-                selected_keys = self._selector.select(0.03)
-                if len(selected_keys) > 0 and selected_keys[0][0].fileobj == self.socket_o:
-                    msg_a = self.receive()
-                    if msg_a is not False:
-                        self.transmission_received(msg_a)
+                # transmitting thread could have taken the data in the meantime
+                if readable and self._socket_readable():
+                    self._dispatch_received(self._loop_receive())
+                self._flush_outbound()
+                self._expire_requests()
+                self._check_liveness()
                 self.loop_pass()
+            # with too many messages waiting for the executor, socket is taken out
+            # of the selector, so the remote end is slowed down by TCP flow control
+            if reading == self._dispatch_full():
+                reading = not reading
+                if reading:
+                    self._selector.register(self.socket_o, selectors.EVENT_READ)
+                else:
+                    self._selector.unregister(self.socket_o)
+            readable = not self.shutdown and self._wait_readable()
 
     def _cleanup_connection(self):
         self.socket_o.close()
-        self._selector.close()
+        self._ready.set()
+        for channel in tuple(self._channels.values()):
+            # wakes up anyone waiting for a message on the channel
+            channel._inbox.put(None)
+        self._fail_requests()
+        self._fail_outbound()
+        self._close_shared_memory()
+        if self._selector is not None:
+            self._selector.close()
+        if self._waker is not None:
+            self._waker.close()
+
+    def _notify_terminated(self):
+        'Marks the connection as no longer alive, and lets its owner know about it'
+        self._terminated = True
+        if self._on_terminated is not None:
+            self._on_terminated()
 
     def register_plugin(self, plugin):
         try:
@@ -230,17 +1773,75 @@ class TinyProtoConnection:
                 raise ValueError('Not a subclass of TinyProtoPlugin')
 
     def _connection_thread_runner(self):
-        self._initialise_connection()
-        self.pre_loop()
-        self._connection_loop()
-        self.post_loop()
-        self._cleanup_connection()
+        try:
+            try:
+                self._initialise_connection()
+            finally:
+                self._ready.set()
+            self.pre_loop()
+            self._connection_loop()
+            self.post_loop()
+            self._cleanup_connection()
+        finally:
+            self._notify_terminated()
+
+    def use_reactor(self, reactor):
+        'Hands the connection over to a TinyProtoReactor instead of a dedicated thread, must be called before start'
+        self._reactor = reactor
+
+    def use_executor(
+        self,
+        executor: Executor,
+        queue_size: int = 64,
+        ordered: bool = True,
+        handler: typing.Optional[typing.Callable] = None
+    ):
+        '''Hands received messages over to an executor, instead of handling them within the connection loop, must be called before start.
+
+        Up to queue_size messages can wait for the executor, above that the connection
+        stops reading from its socket. With ordered, messages of this connection are
+        handled one at a time, in order of arrival. By default transmission_received runs
+        in the executor, which requires a thread pool. With handler, the executor runs
+        handler(msg) instead, which can be used with a process pool when handler can be
+        pickled, and its result is passed to transmission_processed.'''
+        if queue_size < 1:
+            raise ValueError('Queue size must be at least 1')
+        self._executor = executor
+        self._dispatch_limit = queue_size
+        self._dispatch_ordered = ordered
+        self._dispatch_handler = handler
 
     def is_alive(self) -> bool:
-        return self._connection_loop_thread.is_alive()
+        if self._reactor is not None:
+            return self._reactor.is_registered(self)
+        return self._connection_loop_thread.is_alive() and not self._terminated
+
+    def wait_ready(self, timeout: typing.Optional[float] = None) -> bool:
+        'Waits for the handshake of a started connection, returns True if it completed'
+        self._ready.wait(timeout)
+        return self.peername_details is not None and not self.shutdown
+
+    def is_healthy(self) -> bool:
+        'Checks if the connection is up, and the remote end has not closed it in the meantime'
+        if self.shutdown or self.peername_details is None or not self.is_alive():
+            return False
+        try:
+            readable, writable, failed = select.select((self.socket_o, ), (), (), 0)
+            if len(readable) == 0 or _MSG_DONTWAIT is None:
+                return True
+            # readable socket with nothing to read was closed by remote end
+            return len(self.socket_o.recv(1, socket.MSG_PEEK | _MSG_DONTWAIT)) > 0
+        except BlockingIOError:
+            # connection loop took the data first
+            return True
+        except (OSError, ValueError):
+            return False
 
     def start(self):
-        self._connection_loop_thread.start()
+        if self._reactor is not None:
+            self._reactor.register(self)
+        else:
+            self._connection_loop_thread.start()
 
     def pre_loop(self):
         pass
@@ -249,4 +1850,37 @@ class TinyProtoConnection:
     def loop_pass(self):
         pass
     def transmission_received(self, msg):
+        'With shared memory in use, large messages come as read-only views, valid until this returns'
+        pass
+    def transmission_processed(self, msg, result):
+        'Called with the result of executor handler given to use_executor, from the thread which completed it'
         pass
+    def transmissions_received(self, msgs):
+        'Called with all messages of a batch sent with transmit_many, by default passes them on one by one'
+        for msg in msgs:
+            self.transmission_received(msg)
+    def stream_chunk_received(self, chunk):
+        'Called for every chunk of a streamed message, by default gathers them until the stream is finished'
+        if self._stream_buffer is None:
+            self._stream_buffer = bytearray()
+        self._stream_buffer += chunk
+    def stream_finished(self):
+        'Called once streamed message is complete, returned message is passed on as any other received message'
+        msg_a = self._stream_buffer if self._stream_buffer is not None else bytearray()
+        self._stream_buffer = None
+        return msg_a
+    def channel_opened(self, channel):
+        'Called when remote end sends a message on a channel not opened on this end yet'
+        pass
+    def channel_transmission_received(self, channel, msg):
+        'Called with every message received on a channel, by default queues it for channel receive'
+        channel._inbox.put(msg)
+    def request_received(self, msg):
+        '''Called with every request sent with request, returned value is sent back as the response.
+
+        Returning a concurrent.futures.Future sends the response once it completes,
+        and an exception raised here fails the request on the remote end.'''
+        raise TinyProtoError('Requests are not supported on this connection')
+    def transmission_rejected(self, seq, status):
+        'Called when remote end rejected a pipelined transmission, seq counts transmitted messages modulo 0x10000'
+        log.error('Transmission {} rejected by remote end with status {:#x}'.format(seq, status))
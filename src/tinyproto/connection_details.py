@@ -14,16 +14,115 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 #
+from collections import OrderedDict
+from threading import Lock
+import errno
+import os
+import selectors
 import socket
+import stat
+import time
+import typing
 from .errors import TinyProtoError
+from .socket_options import TinyProtoSocketOptions
 
 TINY_PROTO_SUPPORTED_ADDRESS_FAMILY = (socket.AddressFamily.AF_INET, socket.AddressFamily.AF_INET6)
 TINY_PROTO_SUPPORTED_SOCKET_KIND = (socket.SocketKind.SOCK_STREAM, )
 
+# delay before the next address is tried, while the previous attempt is still pending
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+_CONNECT_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)}
+
+
+class TinyProtoResolutionCache:
+    '''Keeps results of socket.getaddrinfo for a limited time.
+
+    Least recently used entries are evicted once max_entries is reached.'''
+    __slots__ = ('max_entries', '_entries', '_lock')
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries: int = max_entries
+        # (host, port) -> (expiry time, getaddrinfo results)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def resolve(self, host: str, port: int, ttl: float) -> list:
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+        # resolving can take a while, so it happens outside of the lock
+        res = socket.getaddrinfo(host, port)
+        with self._lock:
+            self._entries[key] = (now + ttl, res)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return res
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+RESOLUTION_CACHE = TinyProtoResolutionCache()
+
+
+def _interleave_families(addresses):
+    'Alternates address families, starting with the one resolver put first'
+    if len(addresses) == 0:
+        return []
+    first_family = addresses[0][0]
+    preferred = [a for a in addresses if a[0] == first_family]
+    others = [a for a in addresses if a[0] != first_family]
+    res = []
+    for idx in range(max(len(preferred), len(others))):
+        res.extend(preferred[idx:idx + 1])
+        res.extend(others[idx:idx + 1])
+    return res
+
+
+def remove_stale_unix_socket(path):
+    'Removes socket file left behind by a process which is no longer listening on it'
+    if not isinstance(path, str) or path.startswith('\0'):
+        # abstract addresses disappear together with their last socket
+        return
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    except OSError:
+        pass
+    finally:
+        probe.close()
+
+
 class TinyProtoConnectionDetails:
-    __slots__ = ('host', 'port', 'socket_connect_details', 'address_family', 'socket_kind', 'socket_proto')
+    __slots__ = ('host', 'port', 'socket_connect_details', 'address_family', 'socket_kind', 'socket_proto', 'addresses', 'socket_options')
 
-    def __init__(self, host: str, port: int):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        cache_ttl: typing.Optional[float] = None,
+        all_addresses: bool = False,
+        socket_options: typing.Optional[TinyProtoSocketOptions] = None
+    ):
+        '''With cache_ttl, results of resolving the host are kept in RESOLUTION_CACHE for that many seconds.
+        With all_addresses, every resolved address is kept in addresses, and connecting tries them all.'''
         if port < 1 or port > 65535:
             raise TinyProtoError(f'Incorrect port number: {port}. Port number should be between 1 and 65535')
         self.port: int = port
@@ -31,7 +130,10 @@ class TinyProtoConnectionDetails:
         self.host: str = host
 
         try:
-            res = socket.getaddrinfo(host, port)
+            if cache_ttl is not None:
+                res = RESOLUTION_CACHE.resolve(host, port, cache_ttl)
+            else:
+                res = socket.getaddrinfo(host, port)
         except socket.gaierror as e:
             raise TinyProtoError(f'Could not resolv host/port combination for {host}:{port}, due to error {e}')
         
@@ -47,3 +149,116 @@ class TinyProtoConnectionDetails:
         self.address_family: socket.AddressFamily = a_family
         self.socket_kind: socket.SocketKind = s_type
         self.socket_proto = s_proto
+        'Resolved addresses as (family, kind, proto, address) in order of connection attempts'
+        self.addresses: typing.List[tuple] = [(a_family, s_type, s_proto, conn_details)]
+        if all_addresses:
+            self.addresses = _interleave_families([(d[0], d[1], d[2], d[4]) for d in res])
+        'When set, used for sockets to and from this address instead of the profile of the client or server'
+        self.socket_options: typing.Optional[TinyProtoSocketOptions] = socket_options
+
+    @classmethod
+    def unix(cls, path: str, socket_options: typing.Optional[TinyProtoSocketOptions] = None) -> 'TinyProtoConnectionDetails':
+        '''Returns details of a unix domain socket, for connections within the same host.
+
+        Path starting with a null byte is an address in the abstract namespace ( linux only ),
+        which doesn't need a file, and goes away together with the listening socket.'''
+        if not hasattr(socket, 'AF_UNIX'):
+            raise TinyProtoError('Unix domain sockets are not supported on this platform')
+        if len(path) == 0:
+            raise TinyProtoError('Empty path given for unix domain socket')
+        details = cls.__new__(cls)
+        details.host = path
+        details.port = None
+        details.socket_connect_details = path
+        details.address_family = socket.AF_UNIX
+        details.socket_kind = socket.SOCK_STREAM
+        details.socket_proto = 0
+        details.addresses = [(socket.AF_UNIX, socket.SOCK_STREAM, 0, path)]
+        details.socket_options = socket_options
+        return details
+
+    @property
+    def is_unix(self) -> bool:
+        return self.port is None
+
+    def __str__(self) -> str:
+        if self.is_unix:
+            return 'unix:' + self.host.replace('\0', '@', 1)
+        return f'{self.host}:{self.port}'
+
+    def create_connection(
+        self,
+        timeout: typing.Optional[float] = None,
+        attempt_delay: float = CONNECTION_ATTEMPT_DELAY,
+        socket_options: typing.Optional[TinyProtoSocketOptions] = None
+    ) -> socket.socket:
+        '''Returns socket connected to the first address which answered.
+
+        Addresses are tried in turns, alternating address families, with the next
+        attempt started after attempt_delay or as soon as the previous one failed,
+        while earlier attempts are still allowed to finish. Sockets get socket_options
+        of these details, or the ones given, before they connect.'''
+        if self.socket_options is not None:
+            socket_options = self.socket_options
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        selector = selectors.DefaultSelector()
+        pending = []
+        next_idx = 0
+        next_attempt = time.monotonic()
+        last_error = None
+        try:
+            while True:
+                now = time.monotonic()
+                if next_idx < len(self.addresses) and (now >= next_attempt or len(pending) == 0):
+                    family, kind, proto, address = self.addresses[next_idx]
+                    next_idx += 1
+                    next_attempt = now + attempt_delay
+                    sock = socket.socket(family, kind, proto)
+                    sock.setblocking(False)
+                    if socket_options is not None:
+                        socket_options.apply(sock)
+                    err = sock.connect_ex(address)
+                    if err == 0:
+                        pending.append(sock)
+                        return self._connection_established(sock, pending, timeout)
+                    if err in _CONNECT_IN_PROGRESS:
+                        pending.append(sock)
+                        selector.register(sock, selectors.EVENT_WRITE)
+                    else:
+                        last_error = OSError(err, f'Could not connect to {address}')
+                        sock.close()
+                    continue
+                if len(pending) == 0:
+                    raise last_error if last_error is not None else OSError(f'No addresses to connect to for {self}')
+                wait = None
+                if next_idx < len(self.addresses):
+                    wait = max(next_attempt - now, 0)
+                if deadline is not None:
+                    if deadline <= now:
+                        raise socket.timeout(f'Could not connect to {self} within {timeout} seconds')
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                for key, mask in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        return self._connection_established(sock, pending, timeout)
+                    last_error = OSError(err, f'Could not connect to {sock}')
+                    pending.remove(sock)
+                    sock.close()
+                    # failed attempt lets the next one start right away
+                    next_attempt = time.monotonic()
+        except BaseException:
+            for sock in pending:
+                sock.close()
+            raise
+        finally:
+            selector.close()
+
+    def _connection_established(self, sock, pending, timeout):
+        pending.remove(sock)
+        for other in pending:
+            other.close()
+        pending.clear()
+        sock.settimeout(timeout)
+        return sock
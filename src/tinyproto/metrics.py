@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+import typing
+import logging
+
+log = logging.getLogger(__name__)
+
+# latencies measured by connections, all of them in seconds
+METRIC_ACK_WAIT = 'ack_wait'
+METRIC_RECEIVE = 'receive'
+METRIC_PLUGINS = 'plugins'
+METRIC_HANDLER = 'handler'
+METRIC_RTT = 'rtt'
+LATENCY_METRICS = (METRIC_ACK_WAIT, METRIC_RECEIVE, METRIC_PLUGINS, METRIC_HANDLER, METRIC_RTT)
+
+COUNTER_METRICS = ('bytes_in', 'bytes_out', 'messages_in', 'messages_out')
+
+SNAPSHOT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class TinyProtoHistogram:
+    '''Log-linear histogram in the style of HdrHistogram.
+
+    Values are integers ( nanoseconds for latencies ), and every power of two
+    is split into 2 ** (significant_bits - 1) buckets, so reported quantiles
+    stay within 2 ** -(significant_bits - 1) of the recorded value, whatever
+    its magnitude. Recording is a few integer operations and a dict update.'''
+    __slots__ = ('significant_bits', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, significant_bits: int = 6):
+        self.significant_bits: int = significant_bits
+        # bucket index -> number of values
+        self.counts: typing.Dict[int, int] = {}
+        self.count: int = 0
+        self.total: int = 0
+        self.min: typing.Optional[int] = None
+        self.max: typing.Optional[int] = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.significant_bits
+        if shift <= 0:
+            return value
+        half = 1 << (self.significant_bits - 1)
+        return (shift + 1) * half + (value >> shift) - half
+
+    def _highest_value(self, idx):
+        'Highest value falling into given bucket'
+        full = 1 << self.significant_bits
+        if idx < full:
+            return idx
+        half = full >> 1
+        shift = idx // half - 1
+        mantissa = idx % half + half
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        idx = self._index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other: 'TinyProtoHistogram'):
+        if other.significant_bits != self.significant_bits:
+            raise ValueError('Only histograms of the same precision can be merged')
+        for idx, count in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q: float) -> int:
+        if self.count == 0:
+            return 0
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(self._highest_value(idx), self.max)
+        return self.max
+
+
+class TinyProtoMetrics:
+    '''Counters and latency histograms of a connection, or merged from many of them.
+
+    Connections record into it only when it's assigned to their metrics
+    attribute, otherwise instrumentation costs a single attribute check.'''
+    __slots__ = ('bytes_in', 'bytes_out', 'messages_in', 'messages_out', 'histograms', '_lock')
+
+    def __init__(self):
+        self.bytes_in: int = 0
+        self.bytes_out: int = 0
+        self.messages_in: int = 0
+        self.messages_out: int = 0
+        self.histograms: typing.Dict[str, TinyProtoHistogram] = {name: TinyProtoHistogram() for name in LATENCY_METRICS}
+        self._lock = Lock()
+
+    def count_in(self, size: int, messages: int = 0):
+        with self._lock:
+            self.bytes_in += size
+            self.messages_in += messages
+
+    def count_out(self, size: int, messages: int = 0):
+        with self._lock:
+            self.bytes_out += size
+            self.messages_out += messages
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self.histograms[name].record(int(seconds * 1e9))
+
+    def merge(self, other: 'TinyProtoMetrics'):
+        with other._lock:
+            counters = (other.bytes_in, other.bytes_out, other.messages_in, other.messages_out)
+            histograms = {}
+            for name, histogram in other.histograms.items():
+                histograms[name] = TinyProtoHistogram(histogram.significant_bits)
+                histograms[name].merge(histogram)
+        with self._lock:
+            self.bytes_in += counters[0]
+            self.bytes_out += counters[1]
+            self.messages_in += counters[2]
+            self.messages_out += counters[3]
+            for name, histogram in histograms.items():
+                self.histograms[name].merge(histogram)
+
+    def snapshot(self) -> dict:
+        'Returns plain dict with all counters, and count, sum and quantiles of every latency in seconds'
+        with self._lock:
+            res = {
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'messages_in': self.messages_in,
+                'messages_out': self.messages_out
+            }
+            for name, histogram in self.histograms.items():
+                latency = {
+                    'count': histogram.count,
+                    'sum': histogram.total / 1e9,
+                    'min': (histogram.min or 0) / 1e9,
+                    'max': (histogram.max or 0) / 1e9
+                }
+                for q in SNAPSHOT_QUANTILES:
+                    latency[str(q)] = histogram.quantile(q) / 1e9
+                res[name + '_seconds'] = latency
+        return res
+
+
+class TinyProtoServerMetrics:
+    'Connection counters of a server, together with metrics of connections closed so far'
+    __slots__ = ('accepted', 'rejected', 'closed', '_lock')
+
+    def __init__(self):
+        self.accepted: int = 0
+        self.rejected: int = 0
+        self.closed: TinyProtoMetrics = TinyProtoMetrics()
+        self._lock = Lock()
+
+    def connection_accepted(self):
+        with self._lock:
+            self.accepted += 1
+
+    def connection_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self, active_metrics: typing.Iterable[TinyProtoMetrics]) -> dict:
+        'Merges metrics of given active connections with the ones of closed connections'
+        active_metrics = list(active_metrics)
+        merged = TinyProtoMetrics()
+        merged.merge(self.closed)
+        for metrics in active_metrics:
+            merged.merge(metrics)
+        res = merged.snapshot()
+        with self._lock:
+            res['connections_accepted'] = self.accepted
+            res['connections_rejected'] = self.rejected
+        res['connections_active'] = len(active_metrics)
+        return res
+
+
+def format_prometheus(snapshot: dict, prefix: str = 'tinyproto') -> str:
+    'Renders a snapshot in Prometheus text exposition format, latencies as summaries'
+    lines = []
+    for name, value in snapshot.items():
+        metric = '{}_{}'.format(prefix, name)
+        if isinstance(value, dict):
+            lines.append('# TYPE {} summary'.format(metric))
+            for q in SNAPSHOT_QUANTILES:
+                lines.append('{}{{quantile="{}"}} {}'.format(metric, q, value[str(q)]))
+            lines.append('{}_sum {}'.format(metric, value['sum']))
+            lines.append('{}_count {}'.format(metric, value['count']))
+        elif name == 'connections_active':
+            lines.append('# TYPE {} gauge'.format(metric))
+            lines.append('{} {}'.format(metric, value))
+        else:
+            lines.append('# TYPE {}_total counter'.format(metric))
+            lines.append('{}_total {}'.format(metric, value))
+    return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(snapshot: typing.Callable[[], dict], port: int, host: str = '127.0.0.1', prefix: str = 'tinyproto') -> HTTPServer:
+    '''Serves snapshots in Prometheus text format over HTTP from a daemon thread.
+
+    Returns the HTTP server, which stops serving once its shutdown method is called.'''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = format_prometheus(snapshot(), prefix).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    httpd = _ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
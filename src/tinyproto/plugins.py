@@ -14,8 +14,276 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 #
+import lzma
+import typing
+import zlib
+
+from .errors import TinyProtoError
+
+
 class TinyProtoPlugin:
     def msg_transmit(self, msg):
         return msg
     def msg_receive(self, msg):
         return msg
+
+
+class TinyProtoStreamPlugin(TinyProtoPlugin):
+    '''Plugin processing messages chunk by chunk, so it never needs a whole message in memory.
+
+    begin methods return a state object kept for the duration of a single
+    message, which is then handed to every chunk and end call. Those return
+    an iterable of output chunks, which can be of any size, or empty.
+    Input chunks may be views into reused buffers, valid only during the call.
+    Whole messages are handled by running a single chunk through all three steps.'''
+
+    def transmit_begin(self):
+        return None
+    def transmit_chunk(self, state, chunk):
+        return (chunk, )
+    def transmit_end(self, state):
+        return ()
+    def receive_begin(self):
+        return None
+    def receive_chunk(self, state, chunk):
+        return (chunk, )
+    def receive_end(self, state):
+        return ()
+
+    def msg_transmit(self, msg):
+        state = self.transmit_begin()
+        return b''.join(list(self.transmit_chunk(state, msg)) + list(self.transmit_end(state)))
+    def msg_receive(self, msg):
+        state = self.receive_begin()
+        return b''.join(list(self.receive_chunk(state, msg)) + list(self.receive_end(state)))
+
+
+class TinyProtoWholeMessageAdapter(TinyProtoStreamPlugin):
+    'Gathers all chunks of a message for a plugin which only works on whole messages'
+    __slots__ = ('plugin', )
+
+    def __init__(self, plugin: TinyProtoPlugin):
+        self.plugin: TinyProtoPlugin = plugin
+
+    def transmit_begin(self):
+        return bytearray()
+    def transmit_chunk(self, state, chunk):
+        state += chunk
+        return ()
+    def transmit_end(self, state):
+        return (self.plugin.msg_transmit(state), )
+    def receive_begin(self):
+        return bytearray()
+    def receive_chunk(self, state, chunk):
+        state += chunk
+        return ()
+    def receive_end(self, state):
+        return (self.plugin.msg_receive(state), )
+
+    def msg_transmit(self, msg):
+        return self.plugin.msg_transmit(msg)
+    def msg_receive(self, msg):
+        return self.plugin.msg_receive(msg)
+
+
+class TinyProtoPluginPipeline:
+    '''Pushes a single message through a chain of plugins chunk by chunk.
+
+    Every chunk travels through the whole chain as soon as it is fed, so
+    no stage builds a full size copy of the message, unless it is a whole
+    message plugin which needs one anyway.'''
+    __slots__ = ('_stages', '_states', '_receiving')
+
+    def __init__(self, plugin_list: typing.List[TinyProtoPlugin], receiving: bool = False):
+        stages = []
+        for plugin in plugin_list:
+            if not isinstance(plugin, TinyProtoStreamPlugin):
+                plugin = TinyProtoWholeMessageAdapter(plugin)
+            stages.append(plugin)
+        if receiving:
+            # received messages go through plugins in reversed order
+            stages.reverse()
+        self._stages: typing.List[TinyProtoStreamPlugin] = stages
+        self._receiving: bool = receiving
+        self._states = [s.receive_begin() if receiving else s.transmit_begin() for s in stages]
+
+    def _push(self, idx, chunks):
+        stage, state = self._stages[idx], self._states[idx]
+        output = []
+        for chunk in chunks:
+            if self._receiving:
+                output.extend(stage.receive_chunk(state, chunk))
+            else:
+                output.extend(stage.transmit_chunk(state, chunk))
+        return output
+
+    def feed(self, chunk) -> list:
+        'Returns chunks which came out at the end of the chain'
+        chunks = [chunk]
+        for idx in range(len(self._stages)):
+            chunks = self._push(idx, chunks)
+            if len(chunks) == 0:
+                break
+        return chunks
+
+    def finish(self) -> list:
+        'Ends the message at every stage, returns the remaining chunks'
+        chunks = []
+        for idx, stage in enumerate(self._stages):
+            chunks = self._push(idx, chunks)
+            if self._receiving:
+                chunks.extend(stage.receive_end(self._states[idx]))
+            else:
+                chunks.extend(stage.transmit_end(self._states[idx]))
+        return chunks
+
+
+COMPRESSION_FLAG_RAW = 0x00
+COMPRESSION_FLAG_ZLIB = 0x01
+COMPRESSION_FLAG_LZMA = 0x02
+# same as MSG_MAX_SIZE of connection, which imports this module
+DECOMPRESSED_MAX_SIZE = 0xf0ffffff
+
+
+class _CompressionState:
+    __slots__ = ('codec', 'started', 'size')
+
+    def __init__(self, codec=None):
+        self.codec = codec
+        self.started: bool = False
+        # bytes of streamed message decompressed so far
+        self.size: int = 0
+
+
+class CompressionPlugin(TinyProtoStreamPlugin):
+    '''Compresses messages with zlib or lzma from the standard library.
+
+    Every message is prefixed with a single flag byte, telling whether and
+    how it was compressed. Messages below threshold, or which would not get
+    any smaller, are sent as they are. zlib can use a preset dictionary,
+    which has to be the same on both ends, and pays off for small, highly
+    repetitive messages. Streamed messages are always compressed, chunk
+    by chunk, as their size is not known upfront. A message, streamed or
+    not, which would decompress to more than max_length bytes is rejected
+    with TinyProtoError, before more than that is decompressed.'''
+
+    def __init__(
+        self,
+        algorithm: str = 'zlib',
+        threshold: int = 256,
+        level: typing.Optional[int] = None,
+        dictionary: typing.Optional[bytes] = None,
+        max_length: int = DECOMPRESSED_MAX_SIZE
+    ):
+        if algorithm not in ('zlib', 'lzma'):
+            raise ValueError(f'Unsupported compression algorithm {algorithm}')
+        if algorithm == 'lzma' and dictionary is not None:
+            raise ValueError('Preset dictionary is only supported with zlib')
+        self.algorithm: str = algorithm
+        self.threshold: int = threshold
+        self.level: typing.Optional[int] = level
+        self.dictionary: typing.Optional[bytes] = dictionary
+        self.max_length: int = max_length
+
+    def _compressor(self):
+        if self.algorithm == 'lzma':
+            preset = self.level if self.level is not None else lzma.PRESET_DEFAULT
+            return lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=preset)
+        level = self.level if self.level is not None else zlib.Z_DEFAULT_COMPRESSION
+        if self.dictionary is not None:
+            return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+        return zlib.compressobj(level)
+
+    def _decompressor(self, flag):
+        if flag == COMPRESSION_FLAG_ZLIB:
+            if self.dictionary is not None:
+                return zlib.decompressobj(zlib.MAX_WBITS, self.dictionary)
+            return zlib.decompressobj()
+        elif flag == COMPRESSION_FLAG_LZMA:
+            return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        raise TinyProtoError(f'Unsupported compression flag {flag:#x}')
+
+    def _compress(self, msg):
+        compressor = self._compressor()
+        return compressor.compress(msg) + compressor.flush()
+
+    def _decompress_bounded(self, codec, data, limit):
+        'Decompresses data, raises TinyProtoError as soon as the output would exceed limit'
+        try:
+            # one byte over the limit is enough to tell it was exceeded
+            output = codec.decompress(data, limit + 1)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise TinyProtoError(f'Could not decompress message due to error {e}')
+        if len(output) > limit:
+            raise TinyProtoError(f'Decompressed message exceeds allowed size of {self.max_length}')
+        return output
+
+    def _decompress(self, flag, msg):
+        decompressor = self._decompressor(flag)
+        msg = self._decompress_bounded(decompressor, msg, self.max_length)
+        if flag == COMPRESSION_FLAG_ZLIB:
+            try:
+                tail = decompressor.flush()
+            except zlib.error as e:
+                raise TinyProtoError(f'Could not decompress message due to error {e}')
+            if len(msg) + len(tail) > self.max_length:
+                raise TinyProtoError(f'Decompressed message exceeds allowed size of {self.max_length}')
+            msg += tail
+        return msg
+
+    @property
+    def _flag(self):
+        return COMPRESSION_FLAG_LZMA if self.algorithm == 'lzma' else COMPRESSION_FLAG_ZLIB
+
+    def msg_transmit(self, msg):
+        if len(msg) >= self.threshold:
+            compressed = self._compress(msg)
+            if len(compressed) < len(msg):
+                return bytes((self._flag, )) + compressed
+        return bytes((COMPRESSION_FLAG_RAW, )) + bytes(msg)
+
+    def msg_receive(self, msg):
+        if len(msg) == 0:
+            raise TinyProtoError('Compressed message is missing its flag byte')
+        flag = msg[0]
+        payload = memoryview(msg)[1:]
+        if flag == COMPRESSION_FLAG_RAW:
+            return bytes(payload)
+        return self._decompress(flag, payload)
+
+    def transmit_begin(self):
+        return _CompressionState(self._compressor())
+    def transmit_chunk(self, state, chunk):
+        output = state.codec.compress(chunk)
+        if not state.started:
+            state.started = True
+            return (bytes((self._flag, )), output)
+        return (output, )
+    def transmit_end(self, state):
+        if not state.started:
+            state.started = True
+            return (bytes((self._flag, )), state.codec.flush())
+        return (state.codec.flush(), )
+
+    def receive_begin(self):
+        return _CompressionState()
+    def receive_chunk(self, state, chunk):
+        if len(chunk) == 0:
+            return ()
+        if not state.started:
+            state.started = True
+            flag = chunk[0]
+            chunk = memoryview(chunk)[1:]
+            if flag != COMPRESSION_FLAG_RAW:
+                state.codec = self._decompressor(flag)
+        if state.codec is None:
+            return (bytes(chunk), )
+        output = self._decompress_bounded(state.codec, chunk, self.max_length - state.size)
+        state.size += len(output)
+        return (output, )
+    def receive_end(self, state):
+        if not state.started:
+            raise TinyProtoError('Compressed message is missing its flag byte')
+        if state.codec is not None and not state.codec.eof:
+            raise TinyProtoError('Compressed message ended before the end of the compressed stream')
+        return ()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+from collections import deque
+from threading import Condition
+import time
+import typing
+import logging
+
+from .errors import TinyProtoError
+from .connection_details import TinyProtoConnectionDetails
+from .connection import TinyProtoConnection
+
+log = logging.getLogger(__name__)
+
+
+class TinyProtoConnectionPool:
+    '''Keeps established connections to a single remote end for reuse.
+
+    Connections are opened on demand up to max_size. Once all of them are
+    checked out, further checkouts wait for one to be checked in. Idle
+    connections above min_size are closed after idle_timeout seconds, and
+    every idle connection is checked for health before it's reused.'''
+    __slots__ = (
+        'connection_details',
+        'min_size',
+        'max_size',
+        'idle_timeout',
+        'closed',
+        '_connect',
+        '_idle',
+        '_size',
+        '_condition'
+    )
+
+    def __init__(
+        self,
+        connection_details: TinyProtoConnectionDetails,
+        connect: typing.Callable[[TinyProtoConnectionDetails], TinyProtoConnection],
+        min_size: int = 0,
+        max_size: int = 4,
+        idle_timeout: float = 60.0
+    ):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError('Pool size limits must satisfy 0 <= min_size <= max_size and max_size >= 1')
+        self.connection_details: TinyProtoConnectionDetails = connection_details
+        self.min_size: int = min_size
+        self.max_size: int = max_size
+        self.idle_timeout: float = idle_timeout
+        self.closed: bool = False
+        # opens a new connection, already started and past the handshake
+        self._connect = connect
+        # idle connections with the time they were checked in, most recent last
+        self._idle: deque = deque()
+        # all connections of the pool, idle, checked out or being opened
+        self._size: int = 0
+        self._condition = Condition()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    def _discard(self, connection):
+        'Must be called with condition held'
+        self._size -= 1
+        connection.shutdown = True
+        self._condition.notify()
+
+    def _open(self):
+        try:
+            return self._connect(self.connection_details)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def fill(self):
+        'Opens connections until there are min_size of them'
+        while True:
+            with self._condition:
+                if self.closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            connection = self._open()
+            self.checkin(connection)
+
+    def checkout(self, timeout: typing.Optional[float] = None) -> TinyProtoConnection:
+        'Returns a healthy connection, waiting up to timeout seconds if all of them are in use'
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while True:
+                if self.closed:
+                    raise TinyProtoError('Connection pool is closed')
+                while len(self._idle) > 0:
+                    # most recently used connection is the least likely to be stale
+                    connection, idle_since = self._idle.pop()
+                    if connection.is_healthy():
+                        return connection
+                    log.info('Dropping unhealthy connection to {} from pool'.format(self.connection_details))
+                    self._discard(connection)
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise TinyProtoError(f'No connection to {self.connection_details} available within {timeout} seconds')
+                self._condition.wait(remaining)
+        return self._open()
+
+    def checkin(self, connection: TinyProtoConnection):
+        'Returns connection to the pool, closing it if it is no longer usable'
+        with self._condition:
+            if self.closed or connection.shutdown or not connection.is_alive():
+                self._discard(connection)
+                return
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+        self.evict_idle()
+
+    def evict_idle(self):
+        'Closes connections idle for longer than idle_timeout, keeping min_size of them'
+        limit = time.monotonic() - self.idle_timeout
+        with self._condition:
+            while len(self._idle) > 0 and self._size > self.min_size and self._idle[0][1] <= limit:
+                connection, idle_since = self._idle.popleft()
+                self._discard(connection)
+
+    def next_eviction(self) -> typing.Optional[float]:
+        'Returns number of seconds until evict_idle has a connection to close, None if there is none to close'
+        with self._condition:
+            if len(self._idle) == 0 or self._size <= self.min_size:
+                return None
+            return max(0.0, self._idle[0][1] + self.idle_timeout - time.monotonic())
+
+    def close(self):
+        'Closes idle connections, checked out ones get closed when checked in'
+        with self._condition:
+            self.closed = True
+            while len(self._idle) > 0:
+                connection, idle_since = self._idle.popleft()
+                self._discard(connection)
+            self._condition.notify_all()
@@ -0,0 +1,646 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+from threading import Thread, Lock, current_thread
+from collections import deque
+import heapq
+import itertools
+import socket
+import select
+import time
+import selectors
+import typing
+import logging
+
+from .errors import TinyProtoError
+from .connection import TinyProtoConnection, SC_OK, CTRL_CAPS, DISCARD_CHUNK_SIZE, SENDMSG_MAX_BUFFERS
+from .wakeup import TinyProtoWaker
+
+log = logging.getLogger(__name__)
+
+PHASE_HANDSHAKE = 0
+PHASE_HEADER = 1
+PHASE_PAYLOAD = 2
+PHASE_DISCARD = 3
+
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', None)
+
+LOCK_RETRY_INTERVAL = 0.01 # loop pass or queued messages of a connection postponed until its lock is free
+
+
+class TinyProtoReactorState:
+    'Receiving state of a single connection owned by a reactor'
+    __slots__ = (
+        'connection', 'phase', 'buffer', 'view', 'filled', 'remaining', 'holds_lock', 'header_buffer', 'header_view', 'paused', 'offer_pending', 'deadline',
+        'events', 'sending', 'send_views', 'send_payload', 'send_futures', 'ack_pending'
+    )
+
+    def __init__(self, connection: TinyProtoConnection):
+        self.connection: TinyProtoConnection = connection
+        self.holds_lock: bool = False
+        # socket taken out of the selector until executor catches up
+        self.paused: bool = False
+        # capability offer came together with the handshake, pre_loop waits until it is answered
+        self.offer_pending: bool = False
+        # monotonic time of the next pass this connection needs on its own, if any
+        self.deadline: typing.Optional[float] = None
+        # events the socket is registered for in the selector, 0 if it is not
+        self.events: int = 0
+        # queued messages are being written, with locks of the connection taken until they are
+        self.sending: bool = False
+        self.send_views: deque = deque()
+        # with classic framing, message waiting for the OK signal to its size
+        self.send_payload = None
+        self.send_futures: list = []
+        self.ack_pending: bool = False
+        self.remaining: int = 0
+        self.header_buffer = bytearray(4)
+        self.header_view = memoryview(self.header_buffer)
+        self.expect(PHASE_HANDSHAKE, 1)
+
+    def expect(self, phase: int, size: int):
+        self.phase = phase
+        if phase == PHASE_HEADER:
+            # size header is read into the same buffer for every frame
+            self.buffer = self.header_buffer
+            self.view = self.header_view
+        else:
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+        self.filled = 0
+
+    def expect_discard(self, size: int):
+        'Rejected payload is read in bounded chunks and thrown away'
+        self.remaining = size
+        self.expect(PHASE_DISCARD, min(size, DISCARD_CHUNK_SIZE))
+
+    @property
+    def is_complete(self) -> bool:
+        return self.filled == len(self.buffer)
+
+
+class TinyProtoReactor:
+    '''Event loop thread owning many connection sockets in a single selector.
+
+    Every connection is driven as a non-blocking state machine: handshake,
+    4 byte size, OK signal, payload. `transmission_received` and `loop_pass`
+    of each connection are called from the reactor thread. A pass is only
+    run over connections which received data, were woken up, or reached
+    their next deadline, so idle connections cost nothing. Messages queued
+    for a connection are written as far as its socket takes them, and the
+    rest once it gets writable, so a remote end which stopped reading
+    doesn't hold back the others.
+    '''
+    __slots__ = (
+        '_shutdown', 'reactor_id', '_selector', '_waker', '_connections', '_pending', '_registry_lock', '_reactor_thread',
+        '_woken', '_wake_all', '_deadlines', '_deadline_seq'
+    )
+
+    def __init__(self, reactor_id: int = 0):
+        self._shutdown: bool = False
+        self.reactor_id: int = reactor_id
+        self._selector = selectors.DefaultSelector()
+        self._waker = TinyProtoWaker()
+        self._selector.register(self._waker, selectors.EVENT_READ)
+        self._connections: typing.Dict[TinyProtoConnection, TinyProtoReactorState] = {}
+        self._pending: typing.List[TinyProtoConnection] = []
+        self._registry_lock = Lock()
+        # connections woken up from other threads, guarded by _registry_lock
+        self._woken: typing.Set[TinyProtoConnection] = set()
+        self._wake_all: bool = False
+        # heap of deadlines of connections, entries replaced since are skipped when popped
+        self._deadlines: typing.List[typing.Tuple[float, int, TinyProtoConnection]] = []
+        self._deadline_seq = itertools.count()
+        self._reactor_thread: Thread = Thread(target=self._reactor_thread_runner, daemon=True)
+
+    @property
+    def shutdown(self) -> bool:
+        return self._shutdown
+    @shutdown.setter
+    def shutdown(self, newval: bool):
+        self._shutdown = newval
+        if newval:
+            self.wake()
+
+    def wake(self, connection: typing.Optional[TinyProtoConnection] = None):
+        'Thread safe, makes the reactor run a pass over given connection right away, or over all of them'
+        with self._registry_lock:
+            if connection is None:
+                self._wake_all = True
+            else:
+                self._woken.add(connection)
+        self._waker.wake()
+
+    def _is_reactor_thread(self) -> bool:
+        return current_thread() is self._reactor_thread
+
+    def register(self, connection: TinyProtoConnection):
+        'Thread safe, connection is picked up by the reactor on its next pass'
+        with self._registry_lock:
+            self._pending.append(connection)
+        self._waker.wake()
+
+    def is_registered(self, connection: TinyProtoConnection) -> bool:
+        with self._registry_lock:
+            return connection in self._connections or connection in self._pending
+
+    def connection_count(self) -> int:
+        with self._registry_lock:
+            return len(self._connections) + len(self._pending)
+
+    def _adopt_pending(self):
+        with self._registry_lock:
+            pending = self._pending
+            self._pending = []
+        for conn in pending:
+            state = TinyProtoReactorState(conn)
+            conn._last_received = conn._ping_sent = time.monotonic()
+            try:
+                conn._raw_transmit(SC_OK)
+                self._update_interest(state)
+            except OSError as e:
+                log.error('Could not adopt connection due to error {}'.format(e))
+                conn.shutdown = True
+                conn._cleanup_connection()
+                conn._notify_terminated()
+                continue
+            with self._registry_lock:
+                self._connections[conn] = state
+                self._woken.add(conn)
+
+    def _recv_available(self, state: TinyProtoReactorState) -> int:
+        sock = state.connection.socket_o
+        if _MSG_DONTWAIT is not None:
+            try:
+                return sock.recv_into(state.view[state.filled:], 0, _MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return -1
+        # data might have been consumed by another thread in the meantime
+        r, w, x = select.select((sock, ), (), (), 0)
+        if len(r) == 0:
+            return -1
+        return sock.recv_into(state.view[state.filled:])
+
+    def _frame_done(self, state: TinyProtoReactorState):
+        state.expect(PHASE_HEADER, 4)
+        if state.holds_lock:
+            state.holds_lock = False
+            state.connection.connection_lock.release()
+
+    def _offer_waiting(self, conn: TinyProtoConnection) -> bool:
+        'Checks without blocking if a capability offer is already waiting behind the handshake'
+        sock = conn.socket_o
+        try:
+            if _MSG_DONTWAIT is not None:
+                pending = sock.recv(1, socket.MSG_PEEK | _MSG_DONTWAIT)
+            else:
+                r, w, x = select.select((sock, ), (), (), 0)
+                pending = sock.recv(1, socket.MSG_PEEK) if len(r) > 0 else b''
+        except (BlockingIOError, InterruptedError):
+            return False
+        return len(pending) == 1 and pending[0] == CTRL_CAPS
+
+    def _deliver(self, conn: TinyProtoConnection, msg_a):
+        conn._dispatch_received(msg_a)
+
+    def _update_interest(self, state: TinyProtoReactorState):
+        'Registers socket for what the connection waits for, or takes it out of the selector'
+        if state.ack_pending:
+            events = selectors.EVENT_READ
+        elif len(state.send_views) > 0:
+            # nothing is read until the message is out, so the remote end
+            # is slowed down by TCP flow control in the meantime
+            events = selectors.EVENT_WRITE
+        elif state.paused:
+            events = 0
+        else:
+            events = selectors.EVENT_READ
+        if events == state.events:
+            return
+        sock = state.connection.socket_o
+        if state.events == 0:
+            self._selector.register(sock, events, state)
+        elif events == 0:
+            self._selector.unregister(sock)
+        else:
+            self._selector.modify(sock, events, state)
+        state.events = events
+
+    def _start_sending(self, state: TinyProtoReactorState):
+        'Starts writing messages queued by transmit_nowait, unless another thread is transmitting'
+        conn = state.connection
+        if len(conn._outbound) == 0 or not conn.transmit_lock.acquire(blocking=False):
+            return
+        # both locks are held until everything is written, so no other
+        # thread gets between the bytes of a half written message
+        conn.connection_lock.acquire()
+        state.sending = True
+        self._prepare_send(state)
+        self._continue_sending(state)
+
+    def _prepare_send(self, state: TinyProtoReactorState):
+        conn = state.connection
+        if conn.is_pipelined:
+            # everything queued so far goes out together
+            items = []
+            while len(conn._outbound) > 0:
+                items.append(conn._outbound.popleft())
+            frames = []
+            for header, msg, future in items:
+                shm_frames = conn._shm_frames(msg)
+                if shm_frames is not None:
+                    frames.extend(shm_frames)
+                    continue
+                frames.append(header)
+                frames.append(msg)
+            conn._transmit_seq = (conn._transmit_seq + len(items)) & 0xffff
+        else:
+            items = [conn._outbound.popleft()]
+            header, msg, future = items[0]
+            frames = [header]
+            state.send_payload = conn._prep_for_transmit(msg)
+        state.send_futures = [future for header, msg, future in items]
+        state.send_views.extend(v for v in map(conn._prep_for_transmit, frames) if len(v) > 0)
+        if conn.metrics is not None:
+            conn.metrics.count_out(0, len(items))
+
+    def _send_available(self, state: TinyProtoReactorState) -> bool:
+        'Writes as much as the socket takes without blocking, returns False once it is full'
+        conn = state.connection
+        sock = conn.socket_o
+        views = state.send_views
+        try:
+            if _MSG_DONTWAIT is None:
+                # writable socket takes at least a part of the buffer right away
+                r, w, x = select.select((), (sock, ), (), 0)
+                if len(w) == 0:
+                    return False
+                sent = sock.send(views[0])
+            elif hasattr(sock, 'sendmsg'):
+                sent = sock.sendmsg(list(itertools.islice(views, SENDMSG_MAX_BUFFERS)), (), _MSG_DONTWAIT)
+            else:
+                sent = sock.send(views[0], _MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return False
+        if conn.metrics is not None:
+            conn.metrics.count_out(sent)
+        # skip over everything sent in full, and advance into partially sent buffer
+        while len(views) > 0 and sent >= len(views[0]):
+            sent -= len(views.popleft())
+        if sent > 0:
+            views[0] = views[0][sent:]
+        return True
+
+    def _continue_sending(self, state: TinyProtoReactorState):
+        'Writes queued messages until the socket is full, the OK signal is awaited, or nothing is left'
+        conn = state.connection
+        while state.sending:
+            if len(state.send_views) > 0:
+                if not self._send_available(state):
+                    break
+            elif state.send_payload is not None:
+                # with classic framing, message follows once the remote end approves its size
+                state.ack_pending = True
+                break
+            else:
+                self._settle_sent(state)
+                if len(conn._outbound) == 0:
+                    self._end_sending(state)
+                else:
+                    self._prepare_send(state)
+        self._update_interest(state)
+
+    def _receive_send_ack(self, state: TinyProtoReactorState):
+        'Reads the OK signal to the size of a message being written'
+        conn = state.connection
+        try:
+            try:
+                if _MSG_DONTWAIT is not None:
+                    status = conn.socket_o.recv(1, _MSG_DONTWAIT)
+                else:
+                    status = conn.socket_o.recv(1)
+            except (BlockingIOError, InterruptedError):
+                return
+            if len(status) == 0:
+                conn.shutdown = True
+                return
+            conn._last_received = time.monotonic()
+            if conn.metrics is not None:
+                conn.metrics.count_in(1)
+            state.ack_pending = False
+            if status[0] == SC_OK:
+                state.send_views.append(state.send_payload)
+            else:
+                state.send_futures[0].set_exception(TinyProtoError('Transmission rejected: {0}'.format(bytearray(status))))
+            state.send_payload = None
+            self._continue_sending(state)
+        except OSError as e:
+            log.error('Shutting down connection on transmit due to error {}'.format(e))
+            conn.shutdown = True
+
+    def _handle_writable(self, state: TinyProtoReactorState):
+        try:
+            self._continue_sending(state)
+        except OSError as e:
+            log.error('Shutting down connection on transmit due to error {}'.format(e))
+            state.connection.shutdown = True
+
+    def _settle_sent(self, state: TinyProtoReactorState, error: typing.Optional[Exception] = None):
+        for future in state.send_futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        state.send_futures = []
+
+    def _end_sending(self, state: TinyProtoReactorState, error: typing.Optional[Exception] = None):
+        'Releases locks taken for writing, failing messages not written in full with given error'
+        self._settle_sent(state, error)
+        state.send_views.clear()
+        state.send_payload = None
+        state.ack_pending = False
+        state.sending = False
+        state.connection.connection_lock.release()
+        state.connection.transmit_lock.release()
+
+    def _finish_sending(self, conn: TinyProtoConnection):
+        '''Completes a write left half way, before anything else is sent on the connection.
+
+        Only the reactor thread itself can get here in the middle of one, eg. transmitting
+        from a hook of another connection, as other threads wait for the locks.'''
+        state = self._connections.get(conn)
+        if state is None or not state.sending:
+            return
+        views, payload = list(state.send_views), state.send_payload
+        state.send_views.clear()
+        state.send_payload = None
+        # connection sends on its own from now on, locks are still held until done
+        state.sending = False
+        try:
+            conn._raw_transmit_vectored(views)
+            if payload is not None:
+                conn._receive_ack()
+                conn._raw_transmit(payload)
+        except TinyProtoError as e:
+            # rejected by the remote end
+            self._end_sending(state, e)
+        except OSError as e:
+            self._end_sending(state, e)
+            raise
+        else:
+            self._end_sending(state)
+        self._update_interest(state)
+        if len(conn._outbound) > 0:
+            # messages queued in the meantime are left for the next pass
+            self.wake(conn)
+
+    def _send_stall_timeout(self, conn: TinyProtoConnection) -> typing.Optional[float]:
+        'Shuts down connection which is not read from for idle_timeout while its write is stuck, returns time left'
+        if conn.idle_timeout is None:
+            return None
+        left = conn._last_received + conn.idle_timeout - time.monotonic()
+        if left <= 0:
+            log.info('Shutting down connection which stopped reading, idle for {:.3f} seconds'.format(conn.idle_timeout - left))
+            conn.shutdown = True
+        return max(0.0, left)
+
+    def _handle_readable(self, state: TinyProtoReactorState):
+        conn = state.connection
+        if state.ack_pending:
+            self._receive_send_ack(state)
+            return
+        if state.phase == PHASE_HEADER and state.filled == 0 and conn._dispatch_full():
+            # socket is left unread until the executor catches up,
+            # so the remote end is slowed down by TCP flow control
+            state.paused = True
+            self._update_interest(state)
+            return
+        # another thread is in the middle of a transmission on this connection
+        if not conn.connection_lock.acquire(blocking=False):
+            return
+        try:
+            received = self._recv_available(state)
+            if received < 0:
+                return
+            if received == 0:
+                conn.shutdown = True
+                return
+            conn._last_received = time.monotonic()
+            if conn.metrics is not None:
+                conn.metrics.count_in(received)
+            if not state.holds_lock:
+                # keep the connection locked until the whole frame is in,
+                # otherwise a transmit from other thread could eat our bytes
+                conn.connection_lock.acquire()
+                state.holds_lock = True
+            state.filled += received
+            if not state.is_complete:
+                return
+
+            if state.phase == PHASE_HANDSHAKE:
+                if state.buffer[0] != SC_OK:
+                    raise TinyProtoError('Initialisation error: {0}'.format(state.buffer))
+                conn.peername_details = conn.socket_o.getpeername()
+                conn._ready.set()
+                self._frame_done(state)
+                if self._offer_waiting(conn):
+                    # as with a connection thread, the offer is answered first,
+                    # so pre_loop already transmits with the agreed framing
+                    state.offer_pending = True
+                else:
+                    conn.pre_loop()
+            elif state.phase == PHASE_HEADER:
+                recv_count = conn._accept_size(int.from_bytes(state.buffer, 'big'))
+                if recv_count is None:
+                    # control frame, already handled by the connection
+                    self._frame_done(state)
+                    self._deliver(conn, conn._control_frame_done())
+                    if state.offer_pending:
+                        state.offer_pending = False
+                        conn.pre_loop()
+                elif conn._reject_status is not None:
+                    state.expect_discard(recv_count)
+                elif recv_count > 0:
+                    state.expect(PHASE_PAYLOAD, recv_count)
+                else:
+                    self._frame_done(state)
+                    self._deliver(conn, conn._complete_receive(bytearray()))
+            elif state.phase == PHASE_DISCARD:
+                state.remaining -= len(state.buffer)
+                if state.remaining > 0:
+                    state.expect_discard(state.remaining)
+                else:
+                    self._frame_done(state)
+                    self._deliver(conn, conn._complete_receive(None))
+            else:
+                msg_a = state.buffer
+                self._frame_done(state)
+                self._deliver(conn, conn._complete_receive(msg_a))
+        except (OSError, TinyProtoError) as e:
+            log.error('Shutting down connection on receive due to error {}'.format(e))
+            conn.shutdown = True
+        except Exception:
+            # error in hooks of one connection must not take down the others
+            log.exception('Shutting down connection on unhandled error while handling received data')
+            conn.shutdown = True
+        finally:
+            conn.connection_lock.release()
+
+    def _schedule(self, conn: TinyProtoConnection, state: TinyProtoReactorState, timeout: typing.Optional[float]):
+        'Sets when the connection needs its next pass, None if only when something happens'
+        state.deadline = time.monotonic() + timeout if timeout is not None else None
+        if state.deadline is not None:
+            heapq.heappush(self._deadlines, (state.deadline, next(self._deadline_seq), conn))
+
+    def _due_connections(self, ready: typing.Set[TinyProtoConnection]) -> typing.Set[TinyProtoConnection]:
+        'Adds connections woken up, or with their deadline reached, to the ones which received data'
+        with self._registry_lock:
+            if self._wake_all:
+                self._wake_all = False
+                ready.update(self._connections.keys())
+            ready.update(self._woken)
+            self._woken.clear()
+        now = time.monotonic()
+        while len(self._deadlines) > 0 and self._deadlines[0][0] <= now:
+            deadline, seq, conn = heapq.heappop(self._deadlines)
+            state = self._connections.get(conn)
+            if state is not None and state.deadline == deadline:
+                ready.add(conn)
+        return ready
+
+    def _next_select_timeout(self) -> typing.Optional[float]:
+        'Returns how long the reactor can wait for something to happen, None if there is nothing due'
+        with self._registry_lock:
+            if self._wake_all or len(self._woken) > 0:
+                return 0
+        while len(self._deadlines) > 0:
+            deadline, seq, conn = self._deadlines[0]
+            state = self._connections.get(conn)
+            if state is not None and state.deadline == deadline:
+                return max(0.0, deadline - time.monotonic())
+            # replaced by a later deadline, or connection is gone
+            heapq.heappop(self._deadlines)
+        return None
+
+    def _loop_pass_connections(self, ready: typing.Set[TinyProtoConnection]):
+        'Runs a pass over connections which received data, were woken up, or reached their deadline'
+        for conn in self._due_connections(ready):
+            if conn not in self._connections:
+                continue
+            if conn.shutdown:
+                self._close_connection(conn)
+                continue
+            state = self._connections[conn]
+            # handshake, or a frame which started arriving, is still incomplete
+            receiving = state.phase != PHASE_HEADER or state.filled > 0
+            if state.paused and not conn._dispatch_full():
+                state.paused = False
+                self._update_interest(state)
+            if state.sending:
+                # rest of the pass waits until queued messages are written,
+                # so nothing gets between their bytes
+                conn_timeout = self._send_stall_timeout(conn)
+            elif not conn.connection_lock.acquire(blocking=False):
+                # some other thread is transmitting, try again shortly
+                conn_timeout = LOCK_RETRY_INTERVAL
+            else:
+                try:
+                    # with classic framing sending waits for approval, which can't be
+                    # read in the middle of receiving a frame, before the handshake,
+                    # or before the capability offer is answered
+                    if state.phase != PHASE_HANDSHAKE and not state.offer_pending and (not state.holds_lock or conn.is_pipelined):
+                        self._start_sending(state)
+                    conn._expire_requests()
+                    if not state.sending:
+                        conn._check_liveness(receiving)
+                        conn.loop_pass()
+                except (OSError, TinyProtoError) as e:
+                    log.error('Shutting down connection on loop pass due to error {}'.format(e))
+                    conn.shutdown = True
+                except Exception:
+                    log.exception('Shutting down connection on unhandled error in loop pass')
+                    conn.shutdown = True
+                finally:
+                    conn.connection_lock.release()
+                if state.sending:
+                    conn_timeout = self._send_stall_timeout(conn)
+                else:
+                    conn_timeout = conn._next_timeout(receiving) if len(conn._outbound) == 0 else LOCK_RETRY_INTERVAL
+            self._schedule(conn, state, conn_timeout)
+
+    def _close_connection(self, conn: TinyProtoConnection):
+        state = self._connections[conn]
+        if state.holds_lock:
+            state.holds_lock = False
+            conn.connection_lock.release()
+        if state.sending:
+            self._end_sending(state, TinyProtoError('Connection closed before message was sent'))
+        try:
+            self._selector.unregister(conn.socket_o)
+        except (KeyError, ValueError):
+            pass
+        try:
+            if state.phase != PHASE_HANDSHAKE and not state.offer_pending:
+                conn.post_loop()
+        except Exception:
+            log.exception('Unhandled error in post_loop of closed connection')
+        finally:
+            conn._cleanup_connection()
+            with self._registry_lock:
+                del(self._connections[conn])
+            conn._notify_terminated()
+
+    def _reactor_loop(self):
+        while not self.shutdown:
+            self._adopt_pending()
+            ready = set()
+            for key, key_mask in self._selector.select(self._next_select_timeout()):
+                if key.fileobj is self._waker:
+                    self._waker.drain()
+                    continue
+                try:
+                    if key_mask & selectors.EVENT_WRITE:
+                        self._handle_writable(key.data)
+                    else:
+                        self._handle_readable(key.data)
+                except Exception:
+                    # error on one socket must not take down the others
+                    log.exception('Shutting down connection on unhandled error in reactor')
+                    key.data.connection.shutdown = True
+                ready.add(key.data.connection)
+            self._loop_pass_connections(ready)
+
+    def _reactor_thread_runner(self):
+        try:
+            self._reactor_loop()
+        finally:
+            self._adopt_pending()
+            for conn in tuple(self._connections.keys()):
+                conn.shutdown = True
+                self._close_connection(conn)
+            self._selector.close()
+            self._waker.close()
+
+    def is_alive(self) -> bool:
+        return self._reactor_thread.is_alive()
+
+    def start(self):
+        self._reactor_thread.start()
+
+    def join(self, timeout: typing.Optional[float] = None):
+        self._reactor_thread.join(timeout)
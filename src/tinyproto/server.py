@@ -14,20 +14,56 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 #
+from concurrent.futures import Executor, Future
+from collections import deque
+from functools import partial
+import multiprocessing
+import multiprocessing.connection
+import os
 import selectors
+import signal
 import socket
+import threading
+import time
 import typing
+import errno
+import logging
 from uuid import uuid4 as uuid
 from uuid import UUID
 
 from .errors import TinyProtoError
 from .plugins import TinyProtoPlugin
-from .connection_details import TinyProtoConnectionDetails
-from .connection import TinyProtoConnection
+from .connection_details import TinyProtoConnectionDetails, remove_stale_unix_socket
+from .socket_options import TinyProtoSocketOptions, DEFAULT_SOCKET_OPTIONS
+from .connection import TinyProtoConnection, SHM_DEFAULT_THRESHOLD, SC_CONLIMIT
+from .reactor import TinyProtoReactor
+from .metrics import TinyProtoMetrics, TinyProtoServerMetrics
+from .wakeup import TinyProtoWaker
+
+log = logging.getLogger(__name__)
+
+WORKER_CONN_INIT = 'conn_init'
+WORKER_CONN_SHUTDOWN = 'conn_shutdown'
+
+WORKER_RESTART_DELAY = 0.1 # first restart of a crashed worker, doubled for every next crash in a row
+WORKER_RESTART_MAX_DELAY = 30.0 # cap of the restart delay, and run time after which a crash is not in a row
+
+BROADCAST_DROP = 'drop' # message is not queued for a connection falling behind
+BROADCAST_DISCONNECT = 'disconnect' # connection falling behind is shut down
 
 
 class TinyProtoServer:
-    __slots__ = ('shutdown', 'listen_addrs', 'listen_socks', 'active_connections', 'connection_handler', 'connection_limit', 'connection_plugin_list', '_selector')
+    'When set, loop_pass is called at least every that many seconds, otherwise only when something happened'
+    loop_interval: typing.Optional[float] = None
+
+    __slots__ = (
+        '_shutdown', 'listen_addrs', 'listen_socks', 'active_connections', 'connection_handler', 'connection_limit', 'connection_plugin_list',
+        'reactor_threads', '_reactors', '_next_reactor', '_selector', '_waker', '_terminated_connections',
+        'worker_processes', 'worker_id', '_workers', '_worker_events',
+        'executor', 'executor_queue_size', 'executor_ordered', 'metrics',
+        'broadcast_queue_limit', 'broadcast_overflow', 'socket_options', 'shared_memory_size', 'shared_memory_threshold',
+        'heartbeat_interval', 'idle_timeout', 'read_timeout'
+    )
 
     def __init__(
         self,
@@ -35,9 +71,24 @@ class TinyProtoServer:
         connection_handler: TinyProtoConnection = TinyProtoConnection,
         connection_limit: typing.Optional[int] = None,
         connection_plugin_list: typing.List[TinyProtoPlugin] = [],
+        reactor_threads: int = 0,
+        worker_processes: int = 0,
+        executor: typing.Optional[Executor] = None,
+        executor_queue_size: int = 64,
+        executor_ordered: bool = True,
+        metrics: bool = False,
+        broadcast_queue_limit: int = 1024,
+        broadcast_overflow: str = BROADCAST_DROP,
+        socket_options: typing.Optional[TinyProtoSocketOptions] = None,
+        shared_memory_size: int = 0,
+        shared_memory_threshold: int = SHM_DEFAULT_THRESHOLD,
+        heartbeat_interval: typing.Optional[float] = None,
+        idle_timeout: typing.Optional[float] = None,
+        read_timeout: typing.Optional[float] = None,
     ):
 
 
+        self._waker: typing.Optional[TinyProtoWaker] = None
         'Whenever this flag is raised to true, server loop will terminate, and shutdown will be initiated'
         self.shutdown=False
         'The list used to hold 2-element-tuples containing ip addr and port on which to listen to for connections'
@@ -46,6 +97,8 @@ class TinyProtoServer:
         self.listen_socks: typing.List[socket.socket]=[]
         'The dictionary used to store connection objects based on TinyProtoConnection class by their UUID'
         self.active_connections: typing.Dict[UUID, TinyProtoConnection] = {}
+        # ids of connections which reported their termination, waiting to be reaped
+        self._terminated_connections: deque = deque()
 
         self.set_conn_handler(connection_handler)
 
@@ -55,18 +108,83 @@ class TinyProtoServer:
         for connection_plugin in connection_plugin_list:
             self.register_connection_plugin(connection_plugin)
 
+        'When above zero, all connections are shared between that many reactor threads instead of a thread per connection'
+        self.reactor_threads: int = reactor_threads
+        self._reactors: typing.List[TinyProtoReactor] = []
+        self._next_reactor: int = 0
+
+        'When above zero, start runs that many worker processes, each accepting connections on the same addresses'
+        self.worker_processes: int = worker_processes
+        'Number of the worker process running this server, None in the supervising process or without workers'
+        self.worker_id: typing.Optional[int] = None
+        self._workers: typing.Dict[int, multiprocessing.Process] = {}
+        self._worker_events = None
+
+        'When set, received messages of every connection are handled by this executor, see TinyProtoConnection.use_executor'
+        self.executor: typing.Optional[Executor] = executor
+        self.executor_queue_size: int = executor_queue_size
+        self.executor_ordered: bool = executor_ordered
+
+        'When metrics are enabled, connection counters of the server, and metrics of connections closed so far'
+        self.metrics: typing.Optional[TinyProtoServerMetrics] = TinyProtoServerMetrics() if metrics else None
+
+        'Connection with that many messages waiting to be sent is considered too slow for broadcast'
+        self.broadcast_queue_limit: int = broadcast_queue_limit
+        'What happens with a connection too slow for broadcast, BROADCAST_DROP or BROADCAST_DISCONNECT'
+        if broadcast_overflow not in (BROADCAST_DROP, BROADCAST_DISCONNECT):
+            raise ValueError(f'Unsupported broadcast overflow policy {broadcast_overflow}')
+        self.broadcast_overflow: str = broadcast_overflow
+        'Options set on listening and accepted sockets, unless connection details of the listening address have their own'
+        self.socket_options: TinyProtoSocketOptions = socket_options if socket_options is not None else DEFAULT_SOCKET_OPTIONS
+        'When above zero, connections from the same host which offer it, pass large messages through shared memory of that size'
+        self.shared_memory_size: int = shared_memory_size
+        self.shared_memory_threshold: int = shared_memory_threshold
+        'Heartbeat interval, idle and read timeouts of accepted connections, see TinyProtoConnection'
+        self.heartbeat_interval: typing.Optional[float] = heartbeat_interval
+        self.idle_timeout: typing.Optional[float] = idle_timeout
+        self.read_timeout: typing.Optional[float] = read_timeout
+
         self._selector = selectors.DefaultSelector()
 
+    @property
+    def shutdown(self) -> bool:
+        return self._shutdown
+    @shutdown.setter
+    def shutdown(self, newval: bool):
+        self._shutdown = newval
+        if newval:
+            self.wake()
+
+    def wake(self):
+        'Thread safe, makes the server loop run loop_pass right away'
+        if self._waker is not None:
+            self._waker.wake()
+
     def _activate_l(self, connection_details: TinyProtoConnectionDetails):
-        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket = socket.socket(connection_details.address_family, connection_details.socket_kind, connection_details.socket_proto)
+        if connection_details.is_unix:
+            remove_stale_unix_socket(connection_details.socket_connect_details)
+        else:
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.worker_id is not None:
+                # every worker listens on its own socket, and the kernel spreads connections between them
+                listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        socket_options = self._listener_options(connection_details)
+        socket_options.apply_listener(listen_socket)
         listen_socket.bind( connection_details.socket_connect_details )
-        listen_socket.listen(5) # not sure if this value needs to be configurable, so it stays hardcoded for now
+        listen_socket.listen(socket_options.backlog)
+        # accept is repeated until nothing is left, which needs it not to block
+        listen_socket.setblocking(False)
 
-        self._selector.register(listen_socket, selectors.EVENT_READ)
+        self._selector.register(listen_socket, selectors.EVENT_READ, socket_options)
 
         self.listen_socks.append(listen_socket)
 
+    def _listener_options(self, connection_details: TinyProtoConnectionDetails) -> TinyProtoSocketOptions:
+        if connection_details.socket_options is not None:
+            return connection_details.socket_options
+        return self.socket_options
+
     def _activate_listeners(self):
         if len(self.listen_socks) != 0:
             raise TinyProtoError('There are already active listeners')
@@ -83,21 +201,45 @@ class TinyProtoServer:
         return False
 
     def _respond_with_limit_exceeded_code(self, socket_object: socket.socket):
-        socket_object.send(bytearray(SC_CONLIMIT))
-        socket_object.close()
+        try:
+            socket_object.send(bytes((SC_CONLIMIT, )))
+        except OSError as e:
+            log.info('Could not notify rejected connection due to error {}'.format(e))
+        finally:
+            socket_object.close()
 
     def _initialise_connection(self, con, addr):
         if self._is_limit_exceeded():
+            if self.metrics is not None:
+                self.metrics.connection_rejected()
             self._respond_with_limit_exceeded_code(con)
         else:
+            if self.metrics is not None:
+                self.metrics.connection_accepted()
             connection_id = uuid()
             connection_object = self.connection_handler(
                 socket_object=con,
                 socket_already_up=True,
                 connection_plugin_list=self.connection_plugin_list,
             )
+            # connection reports its own termination, so it gets reaped right away
+            connection_object._on_terminated = partial(self._connection_terminated, connection_id)
+
+            if len(self._reactors) > 0:
+                connection_object.use_reactor(self._reactors[self._next_reactor])
+                self._next_reactor = (self._next_reactor + 1) % len(self._reactors)
+            if self.metrics is not None:
+                connection_object.metrics = TinyProtoMetrics()
+            connection_object.shared_memory_size = self.shared_memory_size
+            connection_object.shared_memory_threshold = self.shared_memory_threshold
+            connection_object.heartbeat_interval = self.heartbeat_interval
+            connection_object.idle_timeout = self.idle_timeout
+            connection_object.read_timeout = self.read_timeout
+            if self.executor is not None:
+                connection_object.use_executor(self.executor, self.executor_queue_size, self.executor_ordered)
 
             self.conn_init(connection_id, connection_object)
+            self._report_worker_event(WORKER_CONN_INIT, connection_id, addr)
 
             connection_object.start()
 
@@ -105,21 +247,52 @@ class TinyProtoServer:
 
     def _server_loop(self):
         while not self.shutdown:
-            selected_keys = self._selector.select(0.03)
-            if len(selected_keys) > 0:
-                for active_socket_key, key_mask in selected_keys:
-                    new_socket, new_addr = active_socket_key.fileobj.accept()
-                    self._initialise_connection(new_socket, new_addr)
-            # cleanup closed connections
-            conn_uids = tuple(self.active_connections.keys())
-            for conn_id in conn_uids:
-                conn_o = self.active_connections.pop(conn_id)
-                if conn_o.is_alive():
-                    self.active_connections[conn_id] = conn_o
-                else:
-                    self.conn_shutdown(conn_id, conn_o)
+            for active_socket_key, key_mask in self._selector.select(self.loop_interval):
+                if active_socket_key.fileobj is self._waker:
+                    self._waker.drain()
+                    continue
+                self._accept_pending(active_socket_key.fileobj, active_socket_key.data)
+            self._reap_connections()
             self.loop_pass()
 
+    def _accept_pending(self, listen_socket: socket.socket, socket_options: TinyProtoSocketOptions):
+        'Accepts every connection waiting on the listening socket, so a burst of them costs a single select'
+        while True:
+            try:
+                new_socket, new_addr = listen_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if e.errno == errno.ECONNABORTED:
+                    # connection reset while still waiting in the queue
+                    continue
+                # most likely out of descriptors, the rest waits for the next pass
+                log.error('Could not accept connection due to error {}'.format(e))
+                return
+            # whether accepted socket inherits non blocking mode depends on the platform
+            new_socket.setblocking(True)
+            try:
+                socket_options.apply(new_socket)
+            except OSError as e:
+                log.error('Could not set socket options of accepted connection due to error {}'.format(e))
+            self._initialise_connection(new_socket, new_addr)
+
+    def _connection_terminated(self, conn_id: UUID):
+        'Called from the thread of the connection, or its reactor'
+        self._terminated_connections.append(conn_id)
+        self.wake()
+
+    def _reap_connections(self):
+        while len(self._terminated_connections) > 0:
+            conn_id = self._terminated_connections.popleft()
+            conn_o = self.active_connections.pop(conn_id, None)
+            if conn_o is None:
+                continue
+            if self.metrics is not None:
+                self.metrics.closed.merge(conn_o.metrics)
+            self.conn_shutdown(conn_id, conn_o)
+            self._report_worker_event(WORKER_CONN_SHUTDOWN, conn_id, conn_o.peername_details)
+
     def _shutdown_active_cons(self):
         conn_uids = tuple(self.active_connections.keys())
         for cuid in conn_uids:
@@ -128,11 +301,31 @@ class TinyProtoServer:
             conn_o.shutdown = True
             del(conn_o)
 
+    def _start_reactors(self):
+        for reactor_id in range(self.reactor_threads):
+            reactor = TinyProtoReactor(reactor_id)
+            reactor.start()
+            self._reactors.append(reactor)
+
+    def _stop_reactors(self):
+        for reactor in self._reactors:
+            reactor.shutdown = True
+        for reactor in self._reactors:
+            reactor.join()
+        self._reactors = []
+
     def _close_listeners(self):
         for x in range(len(self.listen_socks)):
             ls = self.listen_socks.pop(0)
+            path = ls.getsockname() if ls.family == getattr(socket, 'AF_UNIX', None) else None
             ls.close()
             del(ls)
+            # abstract addresses are returned as bytes, and need no cleanup
+            if isinstance(path, str) and len(path) > 0:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
 
     def set_conn_handler(self, handler: TinyProtoConnection):
         if not issubclass(handler, TinyProtoConnection):
@@ -151,14 +344,188 @@ class TinyProtoServer:
             else:
                 raise ValueError('Not a subclass of TinyProtoPlugin')
 
-    def start(self):
+    def broadcast(
+        self,
+        msg,
+        targets: typing.Optional[typing.Iterable[UUID]] = None,
+        exclude: typing.Optional[typing.Iterable[UUID]] = None
+    ) -> typing.Dict[UUID, Future]:
+        '''Queues a message for many connections at once, returns a Future for every one of them by connection id.
+
+        Plugins and size header are processed once for all connections sharing the
+        same plugins, and the result is shared between them. Every connection sends it
+        from its own loop, so a slow one doesn't hold back the others. Connection with
+        broadcast_queue_limit messages still waiting is skipped, or shut down with
+        BROADCAST_DISCONNECT, and its Future fails. Reaches connections of this process only.'''
+        if targets is None:
+            targets = tuple(self.active_connections.keys())
+        excluded = set(exclude) if exclude is not None else set()
+        # encoded message by plugins it went through
+        encoded = {}
+        res: typing.Dict[UUID, Future] = {}
+        for conn_id in targets:
+            conn_o = self.active_connections.get(conn_id)
+            if conn_id in excluded or conn_o is None:
+                continue
+            if len(conn_o._outbound) >= self.broadcast_queue_limit:
+                res[conn_id] = self._broadcast_overflow(conn_id, conn_o)
+                continue
+            plugins = tuple(id(p) for p in conn_o.plugin_list)
+            if plugins not in encoded:
+                payload = conn_o._prep_for_transmit(conn_o._process_plugins_transmit(msg))
+                encoded[plugins] = (conn_o._s_to_ba(len(payload)), payload)
+            res[conn_id] = conn_o._queue_outbound(*encoded[plugins])
+        return res
+
+    def _broadcast_overflow(self, conn_id: UUID, conn_o: TinyProtoConnection) -> Future:
+        future = Future()
+        future.set_running_or_notify_cancel()
+        if self.broadcast_overflow == BROADCAST_DISCONNECT:
+            log.info('Shutting down connection {} falling behind with broadcast messages'.format(conn_id))
+            conn_o.shutdown = True
+            future.set_exception(TinyProtoError(f'Connection {conn_id} shut down for falling behind with broadcast messages'))
+        else:
+            future.set_exception(TinyProtoError(f'Broadcast message dropped for connection {conn_id}, too many messages waiting to be sent'))
+        return future
+
+    def metrics_snapshot(self) -> dict:
+        'Returns metrics of all connections of the server, active and closed, merged together'
+        if self.metrics is None:
+            raise TinyProtoError('Metrics are not enabled on this server')
+        connections = tuple(self.active_connections.values())
+        return self.metrics.snapshot(c.metrics for c in connections if c.metrics is not None)
+
+    def _report_worker_event(self, event, conn_id, addr):
+        if self._worker_events is None:
+            return
+        try:
+            self._worker_events.send((event, self.worker_id, conn_id, addr))
+        except (OSError, ValueError) as e:
+            log.error('Could not report {} to supervising process due to error {}'.format(event, e))
+
+    def _stop_on_signal(self, signum, frame):
+        self.shutdown = True
+
+    def _worker_main(self, worker_id, worker_events):
+        self.worker_id = worker_id
+        self._worker_events = worker_events
+        self._workers = {}
+        # selector inherited from supervising process is shared with it, so it can not be used
+        self._selector = selectors.DefaultSelector()
+        signal.signal(signal.SIGTERM, self._stop_on_signal)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self._run()
+
+    def _start_worker(self, context, worker_id, worker_events):
+        worker = context.Process(target=self._worker_main, args=(worker_id, worker_events), name='tinyproto-worker-{}'.format(worker_id))
+        worker.start()
+        self._workers[worker_id] = worker
+        log.info('Started worker {} with pid {}'.format(worker_id, worker.pid))
+
+    def _dispatch_worker_events(self, events_reader):
+        while events_reader.poll():
+            event, worker_id, conn_id, addr = events_reader.recv()
+            if event == WORKER_CONN_INIT:
+                self.worker_conn_init(worker_id, conn_id, addr)
+            else:
+                self.worker_conn_shutdown(worker_id, conn_id, addr)
+
+    def _supervise(self):
+        if not hasattr(socket, 'SO_REUSEPORT') or 'fork' not in multiprocessing.get_all_start_methods():
+            raise TinyProtoError('Worker processes require SO_REUSEPORT and fork support of the platform')
+        if len(self.listen_addrs) == 0:
+            raise TinyProtoError('No addresses defined for listening')
+        if any(d.is_unix for d in self.listen_addrs):
+            raise TinyProtoError('Worker processes can not share unix domain socket addresses')
+        context = multiprocessing.get_context('fork')
+        # every event is pickled to far less than PIPE_BUF, so workers write it to the pipe
+        # in a single atomic write, and never block on it when the supervisor falls behind
+        events_reader, events_writer = context.Pipe(duplex=False)
+        os.set_blocking(events_writer.fileno(), False)
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGTERM, self._stop_on_signal)
+        self._waker = TinyProtoWaker()
+        started_at = {}
+        restart_delays = {}
+        restart_at = {}
+        for worker_id in range(self.worker_processes):
+            self._start_worker(context, worker_id, events_writer)
+            started_at[worker_id] = time.monotonic()
+        try:
+            while not self.shutdown:
+                waiting_for = [events_reader, self._waker]
+                waiting_for.extend(w.sentinel for i, w in self._workers.items() if i not in restart_at)
+                timeout = max(0, min(restart_at.values()) - time.monotonic()) if len(restart_at) > 0 else None
+                ready = multiprocessing.connection.wait(waiting_for, timeout)
+                if self._waker in ready:
+                    self._waker.drain()
+                if events_reader in ready:
+                    self._dispatch_worker_events(events_reader)
+                now = time.monotonic()
+                for worker_id, worker in tuple(self._workers.items()):
+                    if worker_id in restart_at or worker.is_alive() or self.shutdown:
+                        continue
+                    worker.join()
+                    # worker failing right away, eg. on bind, is restarted less and less often,
+                    # while one which was running for a long time gets restarted quickly
+                    if now - started_at[worker_id] >= WORKER_RESTART_MAX_DELAY:
+                        restart_delays[worker_id] = WORKER_RESTART_DELAY
+                    else:
+                        restart_delays[worker_id] = min(restart_delays.get(worker_id, WORKER_RESTART_DELAY / 2) * 2, WORKER_RESTART_MAX_DELAY)
+                    restart_at[worker_id] = now + restart_delays[worker_id]
+                    log.error('Worker {} exited with code {}, restarting it in {:.1f} seconds'.format(worker_id, worker.exitcode, restart_delays[worker_id]))
+                    self.worker_exited(worker_id, worker.exitcode)
+                for worker_id, at in tuple(restart_at.items()):
+                    if at > now or self.shutdown:
+                        continue
+                    del restart_at[worker_id]
+                    self._start_worker(context, worker_id, events_writer)
+                    started_at[worker_id] = time.monotonic()
+        finally:
+            for worker in self._workers.values():
+                if worker.is_alive():
+                    worker.terminate()
+            for worker_id, worker in self._workers.items():
+                worker.join(5)
+                if worker.is_alive():
+                    log.error('Worker {} did not stop in time, killing it'.format(worker_id))
+                    worker.kill()
+                    worker.join()
+            self._dispatch_worker_events(events_reader)
+            self._workers = {}
+            events_reader.close()
+            events_writer.close()
+            self._waker.close()
+            self._waker = None
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+            self._selector.close()
+
+    def _run(self):
+        self._waker = TinyProtoWaker()
+        self._selector.register(self._waker, selectors.EVENT_READ)
         self._activate_listeners()
+        self._start_reactors()
         self.pre_loop()
         self._server_loop()
         self.post_loop()
         self._shutdown_active_cons()
+        self._stop_reactors()
         self._close_listeners()
         self._selector.close()
+        self._waker.close()
+
+    def start(self):
+        '''Runs the server until shutdown is set.
+
+        With worker_processes, this process only supervises the workers, restarting
+        the ones which crashed, and stops all of them on shutdown. Hooks other than
+        worker_ ones are then called within the workers.'''
+        if self.worker_processes > 0:
+            self._supervise()
+        else:
+            self._run()
 
 
     def pre_loop(self):
@@ -171,3 +538,12 @@ class TinyProtoServer:
         pass
     def conn_shutdown(self, conn_id: UUID, conn_o: TinyProtoConnection):
         pass
+    def worker_conn_init(self, worker_id: int, conn_id: UUID, addr):
+        'Called in the supervising process for every connection established by one of the workers'
+        pass
+    def worker_conn_shutdown(self, worker_id: int, conn_id: UUID, addr):
+        'Called in the supervising process for every connection closed by one of the workers'
+        pass
+    def worker_exited(self, worker_id: int, exitcode: int):
+        'Called in the supervising process when a worker exits unexpectedly, before it is restarted with a backoff'
+        pass
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+from collections import OrderedDict
+from threading import Lock
+import typing
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python before 3.8
+    shared_memory = None
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+
+# names of segments created by this process, attaching to them must not untrack them
+_created_segments: typing.Set[str] = set()
+
+
+def is_supported() -> bool:
+    return shared_memory is not None
+
+
+def attach_segment(name: str):
+    'Attaches segment created by the other end of a connection, leaving its cleanup to the creator'
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python before 3.13 always tracks attached segments, and would remove them at exit
+        segment = shared_memory.SharedMemory(name=name)
+    if resource_tracker is not None and name not in _created_segments:
+        try:
+            resource_tracker.unregister(getattr(segment, '_name', name), 'shared_memory')
+        except Exception:
+            pass
+    return segment
+
+
+class TinyProtoShmRing:
+    '''Shared memory segment written by one end of a connection, and read by the other one.
+
+    Messages are placed one after another, wrapping around at the end of
+    the segment. Every slot is reference counted, and its space is reused
+    once all of the references are released, and so are all of the slots
+    written before it.'''
+    __slots__ = ('segment', 'size', 'ready', '_slots', '_next_slot', '_max_slot', '_lock', '_unlinked')
+
+    def __init__(self, size: int, max_slot: int = 0x1fffff):
+        self.segment = shared_memory.SharedMemory(create=True, size=size)
+        _created_segments.add(self.segment.name)
+        self.size: int = size
+        'Set once the other end attached to the segment'
+        self.ready: bool = False
+        # slot id -> [offset, end, references], in order of allocation
+        self._slots: OrderedDict = OrderedDict()
+        self._next_slot: int = 0
+        self._max_slot: int = max_slot
+        self._lock = Lock()
+        self._unlinked: bool = False
+
+    @property
+    def name(self) -> str:
+        return self.segment.name
+
+    def __len__(self) -> int:
+        'Number of slots still in use'
+        return len(self._slots)
+
+    def _find_space(self, size: int) -> typing.Optional[int]:
+        if len(self._slots) == 0:
+            return 0 if size <= self.size else None
+        if len(self._slots) > self._max_slot:
+            # slot ids would be reused while still in use
+            return None
+        first = next(iter(self._slots.values()))
+        last = next(reversed(self._slots.values()))
+        tail, head = first[0], last[1]
+        if last[0] >= tail:
+            # used space doesn't wrap around, free space is after it, and before it
+            if self.size - head >= size:
+                return head
+            if tail >= size:
+                return 0
+            return None
+        if tail - head >= size:
+            return head
+        return None
+
+    def allocate(self, size: int, references: int = 1) -> typing.Optional[typing.Tuple[int, int]]:
+        'Returns slot id and offset of space for a message, None if the ring is full'
+        if size == 0:
+            return None
+        with self._lock:
+            offset = self._find_space(size)
+            if offset is None:
+                return None
+            slot_id = self._next_slot
+            self._next_slot = (slot_id + 1) & self._max_slot
+            self._slots[slot_id] = [offset, offset + size, references]
+            return slot_id, offset
+
+    def write(self, msg: memoryview, references: int = 1) -> typing.Optional[typing.Tuple[int, int]]:
+        'Copies message into a new slot, returns its id and offset, None if the ring is full'
+        slot = self.allocate(len(msg), references)
+        if slot is not None:
+            self.segment.buf[slot[1]:slot[1] + len(msg)] = msg
+        return slot
+
+    def release(self, slot_id: int):
+        'Drops a reference to the slot, freeing it once none are left'
+        with self._lock:
+            slot = self._slots.get(slot_id)
+            if slot is None:
+                return
+            slot[2] -= 1
+            # space is reused in order, so a slot freed early waits for the older ones
+            while len(self._slots) > 0 and next(iter(self._slots.values()))[2] <= 0:
+                self._slots.popitem(last=False)
+
+    def unlink(self):
+        'Removes the name of the segment, memory stays mapped at both ends'
+        if self._unlinked:
+            return
+        self._unlinked = True
+        _created_segments.discard(self.segment.name)
+        try:
+            self.segment.unlink()
+        except OSError:
+            pass
+
+    def close(self):
+        self.unlink()
+        close_segment(self.segment)
+
+
+def close_segment(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # a view of the memory is still around, it gets unmapped together with it
+        pass
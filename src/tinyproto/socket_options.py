@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+import socket
+import typing
+
+# family of sockets to which TCP level options apply
+_TCP_FAMILIES = tuple(getattr(socket, name) for name in ('AF_INET', 'AF_INET6') if hasattr(socket, name))
+# idle time before the first keepalive probe is called TCP_KEEPALIVE on macOS
+_TCP_KEEPIDLE = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+
+
+class TinyProtoSocketOptions:
+    '''Profile of socket options used by servers and clients.
+
+    Options left as None keep the defaults of the operating system. TCP level
+    options are skipped for sockets of other families, and options the platform
+    does not know are skipped as well.'''
+    __slots__ = (
+        'backlog', 'nodelay', 'send_buffer', 'receive_buffer',
+        'keepalive', 'keepalive_idle', 'keepalive_interval', 'keepalive_count', 'quickack'
+    )
+
+    def __init__(
+        self,
+        backlog: int = socket.SOMAXCONN,
+        nodelay: typing.Optional[bool] = True,
+        send_buffer: typing.Optional[int] = None,
+        receive_buffer: typing.Optional[int] = None,
+        keepalive: typing.Optional[bool] = None,
+        keepalive_idle: typing.Optional[int] = None,
+        keepalive_interval: typing.Optional[int] = None,
+        keepalive_count: typing.Optional[int] = None,
+        quickack: typing.Optional[bool] = None
+    ):
+        'Length of the queue of connections waiting for accept on listening sockets'
+        self.backlog: int = backlog
+        'Disables Nagle algorithm, so small frames like size headers and approvals leave right away'
+        self.nodelay: typing.Optional[bool] = nodelay
+        'SO_SNDBUF and SO_RCVBUF in bytes'
+        self.send_buffer: typing.Optional[int] = send_buffer
+        self.receive_buffer: typing.Optional[int] = receive_buffer
+        'SO_KEEPALIVE, with seconds before the first probe, seconds between probes and number of probes before the connection is dropped'
+        self.keepalive: typing.Optional[bool] = keepalive
+        self.keepalive_idle: typing.Optional[int] = keepalive_idle
+        self.keepalive_interval: typing.Optional[int] = keepalive_interval
+        self.keepalive_count: typing.Optional[int] = keepalive_count
+        'TCP_QUICKACK, linux only, acknowledges received data right away, it is set once and linux clears it on its own, so it mostly affects the first exchanges'
+        self.quickack: typing.Optional[bool] = quickack
+
+    def __repr__(self) -> str:
+        options = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__ if getattr(self, name) is not None)
+        return f'TinyProtoSocketOptions({options})'
+
+    def _options(self, sock: socket.socket) -> typing.List[typing.Tuple[int, int, int]]:
+        options = []
+        if self.send_buffer is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer))
+        if self.receive_buffer is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer))
+        if self.keepalive is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(self.keepalive)))
+        if sock.family not in _TCP_FAMILIES:
+            return options
+        for value, name in (
+            (self.nodelay, getattr(socket, 'TCP_NODELAY', None)),
+            (self.keepalive_idle, _TCP_KEEPIDLE),
+            (self.keepalive_interval, getattr(socket, 'TCP_KEEPINTVL', None)),
+            (self.keepalive_count, getattr(socket, 'TCP_KEEPCNT', None)),
+            (self.quickack, getattr(socket, 'TCP_QUICKACK', None)),
+        ):
+            if value is not None and name is not None:
+                options.append((socket.IPPROTO_TCP, name, int(value)))
+        return options
+
+    def apply(self, sock: socket.socket):
+        'Sets options on a connection socket, before it connects, or right after it was accepted'
+        for level, name, value in self._options(sock):
+            sock.setsockopt(level, name, value)
+
+    def apply_listener(self, sock: socket.socket):
+        '''Sets options on a listening socket, before it starts listening.
+
+        Buffer sizes are set here as well, as accepted sockets inherit them,
+        and window scaling is agreed during the handshake, before accept returns.'''
+        if self.send_buffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.receive_buffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+
+# profile used when none is given
+DEFAULT_SOCKET_OPTIONS = TinyProtoSocketOptions()
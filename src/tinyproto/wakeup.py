@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 - 2023 Spajderix <spajderix@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+import socket
+
+
+class TinyProtoWaker:
+    '''Wakes a selector loop up from other threads.
+
+    Reading end is registered in the selector next to the sockets of the loop.
+    Every wake writes a single byte to it, unless an earlier one is still
+    waiting to be drained, so waking a busy loop many times costs one write.'''
+    __slots__ = ('_reader', '_writer', '_pending', 'closed')
+
+    def __init__(self):
+        # socket pair instead of a pipe, so it works with select on every platform,
+        # and writing after close raises instead of reaching a reused descriptor
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+        self._pending: bool = False
+        self.closed: bool = False
+
+    def fileno(self) -> int:
+        return self._reader.fileno()
+
+    def wake(self):
+        'Thread safe, makes the next select of the loop return right away'
+        if self._pending or self.closed:
+            return
+        self._pending = True
+        try:
+            self._writer.send(b'\0')
+        except OSError:
+            # buffer already full, or closed in the meantime,
+            # either way there is nothing more to do
+            pass
+
+    def drain(self):
+        'Called by the loop once select returned the waker'
+        self._pending = False
+        try:
+            while len(self._reader.recv(256)) > 0:
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.closed = True
+        self._reader.close()
+        self._writer.close()